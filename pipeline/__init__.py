@@ -1,10 +1,44 @@
-from .label import LabelStorage  # noqa: F401
-from .ocr import OCR  # noqa: F401
-from .inspection import FertilizerInspection  # noqa: F401
-from .gpt import GPT  # noqa: F401
+from __future__ import annotations
 
-import os
-from datetime import datetime
+from typing import TYPE_CHECKING
+
+from .artifacts import ArtifactBuffer, DirectorySink, new_run_id
+
+if TYPE_CHECKING:
+    from .gpt import GPT
+    from .inspection import FertilizerInspection
+    from .label import LabelStorage
+    from .ocr import OCR
+    from .routing import ModelRouter
+
+# The public classes are imported on first access, so that `import pipeline`
+# does not pay for dspy, litellm, the Azure SDK or reportlab up front.
+_LAZY_ATTRIBUTES = {
+    "LabelStorage": "label",
+    "OCR": "ocr",
+    "FertilizerInspection": "inspection",
+    "GPT": "gpt",
+    "ModelRouter": "routing",
+}
+
+
+def __getattr__(name: str):
+    if name in _LAZY_ATTRIBUTES:
+        # Same as `from .module import name`, visible to -X importtime
+        module = __import__(
+            _LAZY_ATTRIBUTES[name], globals(), fromlist=[name], level=1
+        )
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
+
+# Artifacts of the latest analyses of the process
+ARTIFACTS = ArtifactBuffer()
 
 def save_text_to_file(text: str, output_path: str): # pragma: no cover
     """
@@ -20,66 +54,113 @@ def save_image_to_file(image_bytes: bytes, output_path: str): # pragma: no cover
     with open(output_path, 'wb') as output_file:
         output_file.write(image_bytes)
 
-def analyze(label_storage: LabelStorage, ocr: OCR, gpt: GPT, log_dir_path: str = './logs') -> FertilizerInspection:
-    """
-    Analyze a fertiliser label using an OCR and an LLM.
-    It returns the data extracted from the label in a FertiliserForm.
-    """
-    if not os.path.exists(log_dir_path):
-        print('create path')
-        os.mkdir(path=log_dir_path)
-
-    document = label_storage.get_document()
+def _run_stages(ocr: OCR, gpt: GPT, document, record) -> FertilizerInspection:
     result = ocr.extract_text(document=document)
 
     # Logs the results from document intelligence
-    now = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-    save_text_to_file(result.content, f"{log_dir_path}/{now}.md")
+    record("md", result.content)
 
     # Generate inspection from extracted text
     prediction = gpt.create_inspection(result.content)
 
-    # Check the coninspectionity of the JSON
+    # Check the conformity of the JSON
     inspection = prediction.inspection
 
-    # Logs the results from GPT
-    save_text_to_file(prediction.reasoning, f"{log_dir_path}/{now}.txt")
-    save_text_to_file(inspection.model_dump_json(indent=2), f"{log_dir_path}/{now}.json")
+    # Logs the results from GPT, only rendered if they are flushed
+    record("txt", prediction.get("reasoning", ""))
+    record("json", lambda: inspection.model_dump_json(indent=2))
 
-    # Clear the label cache
-    label_storage.clear()
+    return inspection
 
-    # Delete the logs if there's no error
-    os.remove(f"{log_dir_path}/{now}.md")   
-    os.remove(f"{log_dir_path}/{now}.txt")     
-    os.remove(f"{log_dir_path}/{now}.json")
+def analyze(label_storage: LabelStorage, ocr: OCR, gpt: GPT, log_dir_path: str = './logs', artifacts: ArtifactBuffer | None = None) -> FertilizerInspection:
+    """
+    Analyze a fertiliser label using an OCR and an LLM.
+    It returns the data extracted from the label in a FertiliserForm.
+    The logs of the analysis are kept in the artifacts buffer, ARTIFACTS by
+    default, and only written to its sink, or to log_dir_path, on error.
+    It is safe to call from concurrent threads, even on a shared storage:
+    each call takes the images present when it starts, and puts them back
+    if it fails.
+    """
+    if artifacts is None:
+        artifacts = ARTIFACTS
+    run_id = new_run_id()
+    with artifacts.recording(run_id, artifacts.sink or DirectorySink(log_dir_path)) as record:
+        # The images are taken from the label cache, and put back on error.
+        # Images added by other threads meanwhile are left for a later call.
+        images = label_storage.take()
+        try:
+            document = label_storage.get_document(images=images)
+            inspection = _run_stages(ocr, gpt, document, record)
+        except BaseException:
+            # Also when the analysis is cancelled, e.g. on a timeout
+            label_storage.restore(images)
+            raise
 
     return inspection
 
-def analyze_document(document: bytes, ocr: OCR, gpt: GPT, log_dir_path: str = './logs') -> FertilizerInspection:
+def analyze_document(document: bytes, ocr: OCR, gpt: GPT, log_dir_path: str = './logs', artifacts: ArtifactBuffer | None = None) -> FertilizerInspection:
     """
     Analyze the raw document of the fertiliser label using an OCR and an LLM.
     It returns the data extracted from the label in a FertiliserForm.
+    The logs are handled as in analyze.
     """
-    result = ocr.extract_text(document=document)
-
-    # Logs the results from document intelligence
-    now = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-    save_text_to_file(result.content, f"{log_dir_path}/{now}.md")
-
-    # Generate inspection from extracted text
-    prediction = gpt.create_inspection(result.content)
-
-    # Check the coninspectionity of the JSON
+    if artifacts is None:
+        artifacts = ARTIFACTS
+    run_id = new_run_id()
+    with artifacts.recording(run_id, artifacts.sink or DirectorySink(log_dir_path)) as record:
+        return _run_stages(ocr, gpt, document, record)
+
+async def _run_stages_async(ocr: OCR, gpt: GPT, document, record) -> FertilizerInspection:
+    import asyncio
+
+    # OCRs and LLMs without an async API are run in a thread
+    if hasattr(ocr, "extract_text_async"):
+        result = await ocr.extract_text_async(document=document)
+    else:
+        result = await asyncio.to_thread(ocr.extract_text, document=document)
+    record("md", result.content)
+
+    if hasattr(gpt, "acreate_inspection"):
+        prediction = await gpt.acreate_inspection(result.content)
+    else:
+        prediction = await asyncio.to_thread(gpt.create_inspection, result.content)
     inspection = prediction.inspection
 
-    # Logs the results from GPT
-    save_text_to_file(prediction.reasoning, f"{log_dir_path}/{now}.txt")
-    save_text_to_file(inspection.model_dump_json(indent=2), f"{log_dir_path}/{now}.json")
+    record("txt", prediction.get("reasoning", ""))
+    record("json", lambda: inspection.model_dump_json(indent=2))
+
+    return inspection
 
-    # Delete the logs if there's no error
-    os.remove(f"{log_dir_path}/{now}.md")   
-    os.remove(f"{log_dir_path}/{now}.txt")     
-    os.remove(f"{log_dir_path}/{now}.json")
+async def analyze_async(label_storage: LabelStorage, ocr: OCR, gpt: GPT, log_dir_path: str = './logs', artifacts: ArtifactBuffer | None = None) -> FertilizerInspection:
+    """
+    Async counterpart of analyze, so that one event loop can serve many
+    labels at once. The document is built in a thread, the OCR and the LLM
+    are awaited, and the logs are flushed with ArtifactBuffer.aflush.
+    """
+    import asyncio
+
+    if artifacts is None:
+        artifacts = ARTIFACTS
+    run_id = new_run_id()
+    async with artifacts.arecording(run_id, artifacts.sink or DirectorySink(log_dir_path)) as record:
+        images = label_storage.take()
+        try:
+            document = await asyncio.to_thread(label_storage.get_document, images=images)
+            inspection = await _run_stages_async(ocr, gpt, document, record)
+        except BaseException:
+            # Also when the analysis is cancelled, e.g. on a timeout
+            label_storage.restore(images)
+            raise
 
     return inspection
+
+async def analyze_document_async(document: bytes, ocr: OCR, gpt: GPT, log_dir_path: str = './logs', artifacts: ArtifactBuffer | None = None) -> FertilizerInspection:
+    """
+    Async counterpart of analyze_document.
+    """
+    if artifacts is None:
+        artifacts = ARTIFACTS
+    run_id = new_run_id()
+    async with artifacts.arecording(run_id, artifacts.sink or DirectorySink(log_dir_path)) as record:
+        return await _run_stages_async(ocr, gpt, document, record)
@@ -0,0 +1,171 @@
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime
+
+
+def new_run_id() -> str:
+    """
+    Unique ID of an analysis, which names its artifacts. It starts with the
+    time, so that logs sort chronologically, and ends with a random suffix,
+    so that concurrent analyses never share one.
+    """
+    return f"{datetime.now():%Y-%m-%d_%H-%M-%S}_{uuid.uuid4().hex[:12]}"
+
+
+class DirectorySink:
+    """
+    Write the artifacts of a failed analysis to a directory, as
+    <run_id>.<name> files. The directory is created on the first flush.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __call__(self, run_id: str, artifacts: dict[str, str]):
+        os.makedirs(self.path, exist_ok=True)
+        for name, content in artifacts.items():
+            with open(os.path.join(self.path, f"{run_id}.{name}"), "w") as file:
+                file.write(content)
+
+
+class ArtifactBuffer:
+    """
+    Debugging artifacts (OCR text, reasoning, inspection) of the latest
+    analyses, kept in memory instead of on disk. Only the last maxlen
+    finished runs are kept, on top of the runs in progress. The artifacts of
+    a run are only written out, to a sink, when one of its stages raises.
+
+    A sink is called with the run ID and the artifacts of the run, by name.
+    It may be a coroutine function, e.g. to upload them.
+    """
+
+    def __init__(self, maxlen: int = 32, sink=None):
+        if maxlen < 1:
+            raise ValueError("The buffer must keep at least one run.")
+        self.maxlen = maxlen
+        self.sink = sink
+        self._runs = OrderedDict()
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._runs)
+
+    def record(self, run_id: str, name: str, content):
+        """
+        Keep an artifact of a run. The content may be a callable returning
+        the text, so that it is only rendered if the run is flushed or read.
+        """
+        with self._lock:
+            run = self._runs.get(run_id)
+            if run is None:
+                run = self._runs[run_id] = {}
+                self._evict()
+            run[name] = content
+
+    def _evict(self):
+        # Oldest finished runs first, the artifacts of a run in progress are
+        # kept until it ends
+        excess = len(self._runs) - len(self._active) - self.maxlen
+        if excess > 0:
+            finished = [r for r in self._runs if r not in self._active][:excess]
+            for run_id in finished:
+                del self._runs[run_id]
+
+    def get(self, run_id: str) -> dict[str, str]:
+        """Artifacts of a run still in the buffer, rendered, by name."""
+        with self._lock:
+            run = dict(self._runs.get(run_id, {}))
+        return {name: content() if callable(content) else content for name, content in run.items()}
+
+    def _pop(self, run_id: str) -> dict[str, str]:
+        artifacts = self.get(run_id)
+        with self._lock:
+            self._runs.pop(run_id, None)
+        return artifacts
+
+    def flush(self, run_id: str, sink=None):
+        """
+        Write the artifacts of a run to the sink, by default the sink of the
+        buffer, and drop them from the buffer. A coroutine sink is run to
+        completion, or scheduled if an event loop is running in this thread.
+        """
+        sink = sink or self.sink
+        artifacts = self._pop(run_id)
+        if sink is None or not artifacts:
+            return
+        result = sink(run_id, artifacts)
+        if hasattr(result, "__await__"):
+            import asyncio
+
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                asyncio.run(result)
+            else:
+                _pending.add(task := loop.create_task(result))
+                task.add_done_callback(_pending.discard)
+
+    async def aflush(self, run_id: str, sink=None):
+        """
+        Same as flush, awaiting a coroutine sink. Other sinks, e.g. a
+        DirectorySink, run in a thread, off the event loop.
+        """
+        import asyncio
+
+        sink = sink or self.sink
+        artifacts = self._pop(run_id)
+        if sink is None or not artifacts:
+            return
+        result = await asyncio.to_thread(sink, run_id, artifacts)
+        if hasattr(result, "__await__"):
+            await result
+
+    @contextmanager
+    def recording(self, run_id: str, sink=None):
+        """
+        Yield a function recording the artifacts of a run, as record(name,
+        content). If the block raises, the artifacts recorded so far are
+        flushed to the sink before the exception propagates. A cancelled or
+        interrupted run is not flushed, its artifacts are kept as those of
+        a finished run.
+        """
+        with self._lock:
+            self._active.add(run_id)
+        try:
+            yield lambda name, content: self.record(run_id, name, content)
+        except Exception:
+            with self._lock:
+                self._active.discard(run_id)
+            self.flush(run_id, sink)
+            raise
+        finally:
+            # Also when the run is cancelled (a BaseException): it is no
+            # longer in progress, its artifacts can be evicted
+            with self._lock:
+                self._active.discard(run_id)
+                self._evict()
+
+    @asynccontextmanager
+    async def arecording(self, run_id: str, sink=None):
+        """Same as recording, awaiting the flush with aflush."""
+        with self._lock:
+            self._active.add(run_id)
+        try:
+            yield lambda name, content: self.record(run_id, name, content)
+        except Exception:
+            with self._lock:
+                self._active.discard(run_id)
+            await self.aflush(run_id, sink)
+            raise
+        finally:
+            with self._lock:
+                self._active.discard(run_id)
+                self._evict()
+
+
+# Tasks of coroutine sinks scheduled by flush, kept until they are done
+_pending = set()
@@ -0,0 +1,67 @@
+import re
+
+# Rough average for English/French text with the OpenAI tokenizers.
+CHARS_PER_TOKEN = 4
+
+# Markdown headings produced by Document Intelligence, or blank lines.
+SECTION_BOUNDARY = re.compile(r"\n(?=#{1,6} )|\n[ \t]*\n")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap estimate of the number of tokens in a text, without a tokenizer.
+    """
+    if not text:
+        return 0
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def split_sections(text: str) -> list[str]:
+    """
+    Split OCR markdown on headings and paragraphs.
+    """
+    return [section.strip() for section in SECTION_BOUNDARY.split(text) if section.strip()]
+
+
+def _split_oversized(section: str, max_tokens: int) -> list[str]:
+    # A section over budget is cut on lines, then on characters as a last resort
+    max_chars = max(max_tokens - 1, 1) * CHARS_PER_TOKEN
+    pieces = []
+    for line in section.splitlines():
+        while len(line) > max_chars:
+            pieces.append(line[:max_chars])
+            line = line[max_chars:]
+        if line.strip():
+            pieces.append(line)
+    return pieces
+
+
+def split_text(text: str, max_tokens: int) -> list[str]:
+    """
+    Split a text into chunks of at most max_tokens (estimated), cutting at
+    section boundaries whenever possible. Sections are packed greedily so
+    that the number of chunks stays small.
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return [text]
+
+    pieces = []
+    for section in split_sections(text):
+        if estimate_tokens(section) > max_tokens:
+            pieces.extend(_split_oversized(section, max_tokens))
+        else:
+            pieces.append(section)
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        candidate = f"{current}\n\n{piece}" if current else piece
+        if current and estimate_tokens(candidate) > max_tokens:
+            chunks.append(current)
+            current = piece
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+
+    return chunks
@@ -0,0 +1,67 @@
+"""
+Versioned serialization of inspections, to store and ship many of them.
+
+An inspection is written as a [SCHEMA_VERSION, inspection] envelope, in JSON
+or in msgpack. The inspection is pydantic's own dump, without indentation and
+without the fields that were never set, so that decoding gives back the same
+model_fields_set (explicit nulls included) and exclude_unset dumps agree.
+
+Encoding and decoding run in pydantic-core: a layout of field arrays was
+tried, and, though half the size, it was slower both ways, being built and
+read back in Python.
+"""
+
+import json
+
+from pipeline.inspection import FertilizerInspection
+
+# The payload follows the fields of FertilizerInspection and of its nested
+# models: bump the version whenever one of them changes.
+SCHEMA_VERSION = 2
+
+FORMATS = ("json", "msgpack")
+
+_JSON_PREFIX = f"[{SCHEMA_VERSION},".encode()
+
+
+def _check_format(format: str):
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format {format!r}, expected one of {FORMATS}.")
+
+
+def _check_envelope(envelope) -> dict:
+    if not isinstance(envelope, list) or len(envelope) != 2:
+        raise ValueError("Not an encoded inspection.")
+    version, payload = envelope
+    if version != SCHEMA_VERSION:
+        raise ValueError(
+            f"Inspection encoded with schema version {version}, expected {SCHEMA_VERSION}."
+        )
+    return payload
+
+
+def encode_inspection(inspection: FertilizerInspection, format: str = "json") -> bytes:
+    """Encode an inspection, with the version of the schema."""
+    _check_format(format)
+    if format == "msgpack":
+        import msgpack
+
+        payload = inspection.model_dump(mode="json", exclude_unset=True)
+        return msgpack.packb([SCHEMA_VERSION, payload])
+    return _JSON_PREFIX + inspection.model_dump_json(exclude_unset=True).encode() + b"]"
+
+
+def decode_inspection(data: bytes, format: str = "json") -> FertilizerInspection:
+    """
+    Decode an inspection encoded by encode_inspection, validating it again.
+    Raises a ValueError for data encoded with another version of the schema.
+    """
+    _check_format(format)
+    if format == "msgpack":
+        import msgpack
+
+        return FertilizerInspection.model_validate(_check_envelope(msgpack.unpackb(data)))
+    if data.startswith(_JSON_PREFIX) and data.endswith(b"]"):
+        # Parsed and validated in one pass, without decoding the envelope
+        return FertilizerInspection.model_validate_json(data[len(_JSON_PREFIX) : -1])
+    return FertilizerInspection.model_validate(_check_envelope(json.loads(data)))
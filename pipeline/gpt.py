@@ -1,25 +1,66 @@
+import asyncio
+import contextvars
+import json
+import threading
+import time
+import types
+import typing
+import uuid
+import weakref
+from collections.abc import AsyncIterator, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from typing import Optional
+
 import dspy
 import dspy.adapters
 import dspy.utils
+import litellm
+import pydantic
 from dspy import Prediction
-from openinference.instrumentation.dspy import DSPyInstrumentor
-from phoenix.otel import register
+from dspy.adapters.chat_adapter import parse_value
 
-from pipeline.inspection import FertilizerInspection
+from pipeline.chunking import split_text
+from pipeline.inspection import (
+    FertilizerInspection,
+    PartialJSON,
+    merge_inspections,
+    repair_json,
+    salvage_inspection,
+)
+from pipeline.pre_extraction import SCHEMA_FIELDS, cross_check, pre_extract, prefill
+from pipeline.scheduling import estimate_request_tokens, get_rate_limiter
+from pipeline.tracing import instrument, lm_span
+from pipeline.usage import USAGE, CallUsage, attempt_usage, cached_prompt_tokens
 
 SUPPORTED_MODELS = {
     "gpt-3.5-turbo": {
         "max_tokens": 12000,
+        "chunk_tokens": 4000,
         "api_version": "2024-02-01",
         "response_format": {"type": "json_object"},
+        # USD per million tokens, used to route requests
+        "cost": {"prompt": 0.5, "completion": 1.5},
     },
     "gpt-4o": {
         "max_tokens": None,
-        "api_version": "2024-02-15-preview",
-        "response_format": {"type": "json_object"},
+        "chunk_tokens": 8000,
+        # Structured outputs need API version 2024-08-01-preview or later
+        "api_version": "2024-08-01-preview",
+        "response_format": {"type": "json_schema"},
+        "cost": {"prompt": 2.5, "completion": 10.0},
     },
 }
 
+# "reasoning" writes a chain of thought before the JSON, "direct" only the JSON.
+EXTRACTION_MODES = ("reasoning", "direct")
+
+# Use of the values found in the text by pre_extract: "check" reports where
+# the LLM disagrees with them, "prefill" also fills the fields the LLM left
+# empty, "replace" leaves SCHEMA_FIELDS out of the LLM schema and uses them.
+PRE_EXTRACTION_MODES = ("check", "prefill", "replace")
+
 REQUIREMENTS = """
 The content of keys with the suffix _en must be in English.
 The content of keys with the suffix _fr must be in French.
@@ -36,17 +77,516 @@ class ProduceLabelForm(dspy.Signature):
     Your response should be accurate, intelligible, information in JSON, and contain all the text from the provided text.
     """
 
-    text: str = dspy.InputField(
-        desc="The text of the fertilizer label extracted using OCR."
-    )
+    # The static requirements come before the label text, so that every
+    # prompt starts with the same bytes and can hit the provider prompt cache.
     requirements: str = dspy.InputField(
         desc="The instructions and guidelines to follow."
     )
+    text: str = dspy.InputField(
+        desc="The text of the fertilizer label extracted using OCR."
+    )
     inspection: FertilizerInspection = dspy.OutputField(desc="The inspection results.")
 
 
+# Independent groups of FertilizerInspection fields, extracted concurrently
+# by create_inspection_sectioned.
+INSPECTION_SECTIONS = {
+    "organizations": [
+        "organizations",
+        "fertiliser_name",
+        "registration_number",
+        "lot_number",
+        "npk",
+    ],
+    "guaranteed_analysis": ["guaranteed_analysis_en", "guaranteed_analysis_fr"],
+    "cautions_instructions": [
+        "cautions_en",
+        "cautions_fr",
+        "instructions_en",
+        "instructions_fr",
+    ],
+    "ingredients_weights": [
+        "ingredients_en",
+        "ingredients_fr",
+        "weight",
+        "density",
+        "volume",
+    ],
+}
+
+
+def _section_signature(section: str, fields: list[str]) -> type[dspy.Signature]:
+    """
+    ProduceLabelForm restricted to some of the keys of FertilizerInspection.
+    """
+    model = pydantic.create_model(
+        "".join(word.title() for word in section.split("_")) + "Section",
+        **{
+            name: (Optional[FertilizerInspection.model_fields[name].annotation], None)
+            for name in fields
+        },
+    )
+    signature = ProduceLabelForm.with_updated_fields("inspection", type_=model)
+    return signature.with_instructions(
+        signature.instructions
+        + f"\nOnly extract the following keys: {', '.join(fields)}."
+    )
+
+
+SECTION_SIGNATURES = {
+    section: _section_signature(section, fields)
+    for section, fields in INSPECTION_SECTIONS.items()
+}
+
+# Without the fields that pre_extract finds in the text
+PRE_EXTRACTED_SIGNATURE = _section_signature(
+    "label", [name for name in FertilizerInspection.model_fields if name not in SCHEMA_FIELDS]
+)
+PRE_EXTRACTED_SECTION_SIGNATURES = {
+    section: _section_signature(section, [name for name in fields if name not in SCHEMA_FIELDS])
+    for section, fields in INSPECTION_SECTIONS.items()
+}
+
+INSPECTION_HEADER = "[[ ## inspection ## ]]"
+
+# Usage of the LM requests made by the adapters in the current context
+_lm_attempts: contextvars.ContextVar[list | None] = contextvars.ContextVar(
+    "lm_attempts", default=None
+)
+
+
+class _RecordingLMAttempts:
+    def __enter__(self) -> list:
+        self.attempts = []
+        self.token = _lm_attempts.set(self.attempts)
+        return self.attempts
+
+    def __exit__(self, *exc):
+        _lm_attempts.reset(self.token)
+
+
+def _is_malformed(answer) -> bool:
+    # Whether an inspection answer is not JSON, once unwrapped from its code
+    # fence as TypedPredictor does
+    if not isinstance(answer, str):
+        return False
+    text = answer.strip()
+    if text.startswith("```json") and text.endswith("```") and len(text) >= 10:
+        text = text[7:-3]
+    try:
+        json.loads(text)
+    except ValueError:
+        return True
+    return False
+
+
+class InspectionAdapter(dspy.ChatAdapter):
+    """
+    dspy's ChatAdapter, recording the latency and token usage of each LM
+    request it makes, retries of the typed predictors included. Requests wait
+    for the rate limiter of the deployment, if any, before being sent.
+    Malformed inspections, e.g. cut off at max_tokens, are salvaged instead
+    of being retried. With lean_schema, the JSON schemas of the output models
+    are replaced by their compact rendering in the prompt.
+    """
+
+    def __init__(self, limiter=None, lean_schema=True):
+        self.limiter = limiter
+        self.lean_schema = lean_schema
+
+    def format(self, signature, demos, inputs):
+        messages = super().format(signature, demos, inputs)
+        if self.lean_schema:
+            messages[0] = {
+                **messages[0],
+                "content": _with_lean_schemas(signature, messages[0]["content"]),
+            }
+        return messages
+
+    def __call__(self, lm, lm_kwargs, signature, demos, inputs, _parse_values=True):
+        # Same as Adapter.__call__, timing the LM request
+        messages = self.format(signature, demos, inputs)
+        if self.limiter is not None:
+            self.limiter.acquire(estimate_request_tokens(messages, inputs.get("text", "")))
+        start_time = time.perf_counter()
+        outputs = lm(messages=messages, **lm_kwargs)
+        latency = time.perf_counter() - start_time
+
+        attempt = None
+        attempts = _lm_attempts.get()
+        if attempts is not None:
+            # The history is shared by threads, find the entry of these messages
+            entry = next(
+                (e for e in reversed(lm.history) if e.get("messages") is messages), {}
+            )
+            attempt = attempt_usage(entry.get("usage"), latency)
+            attempts.append(attempt)
+
+        values = []
+        for output in outputs:
+            value, salvaged = self.parse_salvaging(
+                signature, output, _parse_values=_parse_values
+            )
+            if attempt is not None and salvaged:
+                attempt["salvaged"] = salvaged
+            if set(value) != set(signature.output_fields):
+                raise ValueError(f"Expected {signature.output_fields.keys()} but got {value.keys()}")
+            values.append(value)
+        return values
+
+    def lm_kwargs(self, signature) -> dict:
+        """Extra arguments of the LM request for a signature."""
+        return {}
+
+    def parse_salvaging(self, signature, completion, _parse_values=True) -> tuple[dict, dict]:
+        """
+        Same as parse, salvaging the inspection of the answer when it is
+        malformed JSON. Returns the output fields and the salvaged fields of
+        the inspection (see salvage_inspection), empty for a valid answer.
+        An answer that can't be salvaged is returned, or fails, as with parse.
+        """
+        try:
+            values = self.parse(signature, completion, _parse_values=_parse_values)
+        except ValueError as error:
+            try:
+                return self._salvage(signature, completion, _parse_values)
+            except ValueError:
+                raise error from None
+
+        if not any(_is_malformed(values.get(name)) for name in _inspection_fields(signature)):
+            return values, {}
+        try:
+            return self._salvage(signature, completion, _parse_values)
+        except ValueError:
+            return values, {}
+
+    def _raw_fields(self, signature, completion) -> dict:
+        # Value of each output field, and the number of containers left open in it
+        values = dspy.ChatAdapter.parse(self, signature, completion, _parse_values=False)
+        return {name: (value, 0) for name, value in values.items()}
+
+    def _salvage(self, signature, completion, _parse_values) -> tuple[dict, dict]:
+        raw_fields = self._raw_fields(signature, completion)
+        if set(raw_fields) != set(signature.output_fields):
+            raise ValueError(f"Expected {signature.output_fields.keys()} but got {raw_fields.keys()}")
+
+        fields = {}
+        salvaged = {}
+        for name, field in signature.output_fields.items():
+            value, open_containers = raw_fields[name]
+            if field.annotation is FertilizerInspection:
+                try:
+                    inspection, salvaged = salvage_inspection(value, open_containers)
+                except ValueError:
+                    if _parse_values:
+                        raise
+                    # Nothing to salvage: the malformed answer is left to the
+                    # parser of the typed predictor, which fails and asks again
+                    fields[name] = value if isinstance(value, str) else completion
+                    continue
+                fields[name] = inspection if _parse_values else inspection.model_dump_json()
+            elif not isinstance(value, str):
+                fields[name] = (
+                    pydantic.TypeAdapter(field.annotation).validate_python(value)
+                    if _parse_values
+                    else json.dumps(value)
+                )
+            else:
+                fields[name] = parse_value(value, field.annotation) if _parse_values else value
+        return fields, salvaged
+
+
+class JSONAdapter(InspectionAdapter):
+    """
+    Asks for the output fields as one JSON object, and constrains the answer
+    with the response_format of the deployment. With {"type": "json_schema"}
+    the schema is generated from the output fields of the signature, in
+    strict mode, so that the answer always parses and validates.
+    """
+
+    def __init__(self, response_format: dict, limiter=None, lean_schema=True):
+        super().__init__(limiter, lean_schema)
+        self.response_format = response_format
+
+    def lm_kwargs(self, signature) -> dict:
+        if self.response_format["type"] == "json_schema":
+            return {"response_format": structured_output_format(signature)}
+        return {"response_format": self.response_format}
+
+    def __call__(self, lm, lm_kwargs, signature, demos, inputs, _parse_values=True):
+        lm_kwargs = {**lm_kwargs, **self.lm_kwargs(signature)}
+        return super().__call__(
+            lm, lm_kwargs, signature, demos, inputs, _parse_values=_parse_values
+        )
+
+    def format(self, signature, demos, inputs):
+        messages = super().format(signature, demos, inputs)
+        # Replace the closing instruction of the chat format, the prefix is unchanged
+        content = messages[-1]["content"]
+        fields = ", ".join(f"`{name}`" for name in signature.output_fields)
+        messages[-1] = {
+            **messages[-1],
+            "content": content[: content.rindex("Respond with")]
+            + f"Respond with a JSON object with the fields {fields}, in this order.",
+        }
+        return messages
+
+    def parse(self, signature, completion, _parse_values=True):
+        if not completion.lstrip().startswith("{"):
+            # The deployment ignored the response format and used the chat format
+            return super().parse(signature, completion, _parse_values=_parse_values)
+
+        values = json.loads(completion)
+        fields = {}
+        for name, field in signature.output_fields.items():
+            if name not in values:
+                raise ValueError(f"Expected {signature.output_fields.keys()} but got {values.keys()}")
+            value = values[name]
+            if isinstance(value, str):
+                fields[name] = parse_value(value, field.annotation) if _parse_values else value
+            elif _parse_values:
+                fields[name] = pydantic.TypeAdapter(field.annotation).validate_python(value)
+            else:
+                fields[name] = json.dumps(value)
+        return fields
+
+    def _raw_fields(self, signature, completion) -> dict:
+        if not completion.lstrip().startswith("{"):
+            return super()._raw_fields(signature, completion)
+
+        repaired = repair_json(completion)
+        if repaired is None or not isinstance(repaired[0], dict):
+            raise ValueError("The answer is not a JSON object.")
+        values, open_containers = repaired
+        # Only the last field can have been cut off
+        last = next(reversed(values), None)
+        return {
+            name: (value, open_containers - 1 if name == last and open_containers > 1 else 0)
+            for name, value in values.items()
+        }
+
+
+_JSON_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean"}
+
+
+def _lean_type(annotation) -> str:
+    origin = typing.get_origin(annotation)
+    if origin in (typing.Union, types.UnionType):
+        # Every value can be null, which the schema says once
+        args = [a for a in typing.get_args(annotation) if a is not type(None)]
+        return " | ".join(_lean_type(a) for a in args)
+    if origin is list:
+        (item,) = typing.get_args(annotation)
+        return f"[{_lean_type(item)}]"
+    if isinstance(annotation, type) and issubclass(annotation, pydantic.BaseModel):
+        fields = []
+        for name, field in annotation.model_fields.items():
+            rendered = f"{name}: {_lean_type(field.annotation)}"
+            if field.description:
+                rendered += f" ({field.description.rstrip('.')})"
+            fields.append(rendered)
+        return "{" + ", ".join(fields) + "}"
+    return _JSON_TYPES.get(annotation, "string")
+
+
+@lru_cache(maxsize=None)
+def lean_schema(model: type[pydantic.BaseModel]) -> str:
+    """
+    Compact description of the JSON expected for a model, for the prompt:
+    the same fields, types and descriptions as its JSON schema, without the
+    $defs, null unions, titles and defaults. Computed once per model.
+
+    The lean prompt prefix (about 600 tokens) is under the 1024 tokens from
+    which Azure OpenAI caches prompts, so it is never served from the cache.
+    Sent in full, it still costs less than the cached prefix of the full
+    schemas (about 2,700 tokens) unless cached tokens are discounted by more
+    than about 80%.
+    """
+    return _lean_type(model) + " Any value can be null."
+
+
+def _with_lean_schemas(signature, content: str) -> str:
+    # dspy renders the JSON schema of an output model twice: in the
+    # description of the field, added by TypedPredictor, and in its format
+    for name, field in signature.output_fields.items():
+        model = field.annotation
+        if not (isinstance(model, type) and issubclass(model, pydantic.BaseModel)):
+            continue
+        schema = json.dumps(pydantic.TypeAdapter(model).json_schema())
+        content = content.replace(
+            f"JSON Schema: {schema}", f"Schema: {lean_schema(model)}"
+        ).replace(
+            f"must be pareseable according to the following JSON schema: {schema}",
+            f"must follow the schema of `{name}`",
+        )
+    return content
+
+
+def _inspection_fields(signature) -> list[str]:
+    return [
+        name
+        for name, field in signature.output_fields.items()
+        if field.annotation is FertilizerInspection
+    ]
+
+
+def _strict_schema(schema):
+    # Structured outputs in strict mode require every property, no extra
+    # property and no default value.
+    if isinstance(schema, list):
+        return [_strict_schema(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    schema = {
+        key: _strict_schema(value) for key, value in schema.items() if key != "default"
+    }
+    if "properties" in schema:
+        schema["required"] = list(schema["properties"])
+        schema["additionalProperties"] = False
+    return schema
+
+
+def structured_output_format(signature) -> dict:
+    """
+    response_format asking for a JSON object with the output fields of the
+    signature, following the JSON schema of their types.
+    """
+    properties = {}
+    defs = {}
+    for name, field in signature.output_fields.items():
+        schema = pydantic.TypeAdapter(field.annotation).json_schema()
+        defs.update(schema.pop("$defs", {}))
+        properties[name] = schema
+
+    schema = {"type": "object", "properties": properties}
+    if defs:
+        schema["$defs"] = defs
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "_".join(signature.output_fields),
+            "strict": True,
+            "schema": _strict_schema(schema),
+        },
+    }
+
+
+class _InspectionStream:
+    """
+    Accumulates the streamed answer of the LLM and validates the part of the
+    inspection generated so far.
+    """
+
+    def __init__(self, signature, adapter, complete=None):
+        self.signature = signature
+        self.adapter = adapter
+        # Applied to every inspection returned, e.g. to add pre-extracted values
+        self.complete = complete or (lambda inspection: inspection)
+        self.content = ""
+        self.last_dump = None
+        # Scanner of the JSON answer, once it started. Each delta is scanned
+        # once, and the answer is only parsed when a value was completed, so
+        # that a stream costs linear time.
+        self.partial = None
+        self.json_answer = False
+        self.searched = 0  # length of content searched for the inspection header
+
+    def _feed_partial(self, delta: str) -> bool:
+        # Whether the closed answer changed
+        if self.partial is not None:
+            return self.partial.feed(delta)
+        if self.content.lstrip().startswith("{"):
+            # JSON answer of the JSONAdapter
+            self.json_answer = True
+            self.partial = PartialJSON()
+            return self.partial.feed(self.content)
+        index = self.content.find(INSPECTION_HEADER, max(0, self.searched - len(INSPECTION_HEADER)))
+        self.searched = len(self.content)
+        if index == -1:
+            return False
+        self.partial = PartialJSON()
+        return self.partial.feed(self.content[index + len(INSPECTION_HEADER) :])
+
+    def _partial_answer(self) -> dict | None:
+        closed = self.partial.closed()
+        if closed is None:
+            return None
+        answer = json.loads(closed[0])
+        if self.json_answer:
+            answer = answer.get("inspection")
+        return answer if isinstance(answer, dict) else None
+
+    def feed(self, delta: str | None) -> FertilizerInspection | None:
+        """Return a new partial inspection if the delta changed it."""
+        if not delta:
+            return None
+        self.content += delta
+        if not self._feed_partial(delta):
+            return None
+
+        partial = self._partial_answer()
+        if partial is None:
+            return None
+        try:
+            inspection = FertilizerInspection.model_validate(partial)
+        except (pydantic.ValidationError, ValueError):
+            # Wait for more tokens, e.g. a registration number without identifier yet
+            return None
+
+        dump = inspection.model_dump_json()
+        if dump == self.last_dump:
+            return None
+        self.last_dump = dump
+        return self.complete(inspection)
+
+    def finish(self) -> FertilizerInspection:
+        parsed, _ = _parse_completion(self.adapter, self.signature, self.content)
+        return self.complete(parsed["inspection"])
+
+
+class InspectionBatch:
+    """
+    Outcome of GPT.create_inspections. Each entry of results is either the
+    Prediction or the exception raised for the text at the same position.
+    """
+
+    def __init__(self, results: list, elapsed: float):
+        self.results = results
+        self.elapsed = elapsed
+
+    @property
+    def predictions(self) -> list[Prediction | None]:
+        return [r if not isinstance(r, Exception) else None for r in self.results]
+
+    @property
+    def errors(self) -> dict[int, Exception]:
+        return {i: r for i, r in enumerate(self.results) if isinstance(r, Exception)}
+
+    @property
+    def throughput(self) -> float:
+        """Number of texts processed per second."""
+        if self.elapsed <= 0:
+            return 0.0
+        return len(self.results) / self.elapsed
+
+
 class GPT:
-    def __init__(self, api_endpoint, api_key, deployment_id, phoenix_endpoint=None):
+    def __init__(
+        self,
+        api_endpoint,
+        api_key,
+        deployment_id,
+        phoenix_endpoint=None,
+        max_concurrency=8,
+        mode="reasoning",
+        trace_sampling_ratio=1.0,
+        trace_payloads=True,
+        structured_output=True,
+        tokens_per_minute=None,
+        requests_per_minute=None,
+        pre_extraction=None,
+        lean_schema=True,
+    ):
         if not api_endpoint or not api_key or not deployment_id:
             raise ValueError(
                 "The API endpoint, key and deployment_id are required to instantiate the GPT class."
@@ -56,13 +596,28 @@ class GPT:
         if not config:
             raise ValueError(f"The deployment_id {deployment_id} is not supported.")
 
-        if phoenix_endpoint is not None:
-            tracer_provider = register(
-                project_name="gpt-fertiscan",  # Default is 'default'
-                endpoint=phoenix_endpoint,  # gRPC endpoint given by Phoenix when starting the server (default is "http://localhost:4317")
+        if mode not in EXTRACTION_MODES:
+            raise ValueError(
+                f"The mode {mode} is not supported, use one of {EXTRACTION_MODES}."
             )
+        self.mode = mode
 
-            DSPyInstrumentor().instrument(tracer_provider=tracer_provider)
+        if pre_extraction is not None and pre_extraction not in PRE_EXTRACTION_MODES:
+            raise ValueError(
+                f"The pre-extraction {pre_extraction} is not supported, use one of {PRE_EXTRACTION_MODES}."
+            )
+        self.pre_extraction = pre_extraction
+
+        self.deployment_id = deployment_id
+        self.config = config
+
+        if phoenix_endpoint is not None:
+            # Instrumentation is process-wide: only the first GPT sets it up
+            instrument(
+                endpoint=phoenix_endpoint,
+                sampling_ratio=trace_sampling_ratio,
+                hide_payloads=not trace_payloads,
+            )
 
         self.lm = dspy.LM(
             model=f"azure/{deployment_id}",
@@ -72,9 +627,482 @@ class GPT:
             api_version=config["api_version"],
         )
 
+        # Quotas are per deployment: every GPT of a deployment shares its limiter
+        self.limiter = get_rate_limiter(
+            api_endpoint, deployment_id, tokens_per_minute, requests_per_minute
+        )
+
+        # Structured outputs make the answer parse on the first try, which
+        # removes the retry round trips of the typed predictors.
+        if structured_output and config.get("response_format"):
+            self.adapter = JSONAdapter(config["response_format"], self.limiter, lean_schema)
+        else:
+            self.adapter = InspectionAdapter(self.limiter, lean_schema)
+
+        # Caps the number of in-flight async requests sent to this deployment.
+        # An asyncio semaphore only works in the event loop it was first used
+        # in, so each loop gets its own, dropped with the loop.
+        self.max_concurrency = max_concurrency
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._semaphores_lock = threading.Lock()
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        """Concurrency limit of the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._semaphores_lock:
+            semaphore = self._semaphores.get(loop)
+            if semaphore is None:
+                semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return semaphore
+
+    def _signature(self) -> type[dspy.Signature]:
+        # In "replace" mode the fields found by pre_extract leave the schema
+        if self.pre_extraction == "replace":
+            return PRE_EXTRACTED_SIGNATURE
+        return ProduceLabelForm
+
+    def _predictor(self, signature=None) -> dspy.Module:
+        signature = signature or self._signature()
+        if self.mode == "direct":
+            return dspy.TypedPredictor(signature)
+        return dspy.TypedChainOfThought(signature)
+
+    def _with_usage(
+        self, prediction: Prediction, usage: CallUsage, salvaged: dict | None = None
+    ) -> Prediction:
+        # prediction.retries is the number of LM requests after the first one,
+        # prediction.salvaged the fields salvaged from a malformed answer
+        prediction.usage = usage
+        prediction.retries = usage.retries
+        prediction.salvaged = usage.salvaged if salvaged is None else salvaged
+        return prediction
+
+    def _predict(self, signature, text, usages: list | None = None) -> Prediction:
+        # The usage is recorded as one extraction, or appended to usages when
+        # the request is part of a larger extraction that records it
+        with _RecordingLMAttempts() as attempts:
+            try:
+                with dspy.context(lm=self.lm, adapter=self.adapter, experimental=True):
+                    predictor = self._predictor(signature)
+                    prediction = predictor(requirements=REQUIREMENTS, text=text)
+            finally:
+                if usages is None:
+                    USAGE.record(self.deployment_id, CallUsage(attempts))
+                else:
+                    usages.append(CallUsage(attempts))
+        return self._with_usage(prediction, CallUsage(attempts))
+
     def create_inspection(self, text) -> Prediction:
-        with dspy.context(lm=self.lm, experimental=True):
-            predictor = dspy.TypedChainOfThought(ProduceLabelForm)
-            prediction = predictor(text=text, requirements=REQUIREMENTS)
+        return self._pre_extracted(self._predict(self._signature(), text), text)
 
+    def _apply_pre_extraction(self, inspection, extracted: dict) -> tuple[FertilizerInspection, dict]:
+        # The inspection completed with the values found by pre_extract, and
+        # the fields where the LLM disagrees with them, see cross_check
+        if self.pre_extraction == "replace":
+            values = inspection.model_dump(exclude_unset=True)
+            values.update({name: extracted[name] for name in SCHEMA_FIELDS})
+            inspection = FertilizerInspection.model_validate(values)
+            return inspection, cross_check(inspection, extracted)
+
+        discrepancies = cross_check(inspection, extracted)
+        if self.pre_extraction == "prefill":
+            inspection = prefill(inspection, extracted)
+        return inspection, discrepancies
+
+    def _pre_extracted(self, prediction: Prediction, text) -> Prediction:
+        # prediction.discrepancies are the fields where the LLM disagrees with
+        # the text, when pre_extraction is enabled
+        if self.pre_extraction is not None:
+            prediction.inspection, prediction.discrepancies = self._apply_pre_extraction(
+                prediction.inspection, pre_extract(text)
+            )
         return prediction
+
+    def create_inspections(self, texts: list[str], max_workers=8) -> InspectionBatch:
+        """
+        Run create_inspection over many texts with a bounded thread pool.
+        Results keep the order of the input and a failure only affects its item.
+        """
+
+        def run(text):
+            try:
+                return self.create_inspection(text)
+            except Exception as e:
+                return e
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(run, texts))
+
+        return InspectionBatch(results, time.perf_counter() - start_time)
+
+    def batch_requests(self, texts: list[str], custom_ids: list[str] | None = None) -> list[dict]:
+        """
+        Requests of a batch job (Azure OpenAI / OpenAI batch JSONL format),
+        one per text, with exactly the prompt create_inspection sends first.
+        The custom_id of a request defaults to the index of its text.
+        """
+        custom_ids = custom_ids or [str(i) for i in range(len(texts))]
+        if len(custom_ids) != len(texts) or len(set(custom_ids)) != len(texts):
+            raise ValueError("There must be one unique custom_id per text.")
+
+        signature = self._predictor()._prepare_signature()
+        lm_kwargs = {
+            key: value
+            for key, value in {**self.lm.kwargs, **self.adapter.lm_kwargs(signature)}.items()
+            if not key.startswith("api_") and value is not None
+        }
+        return [
+            {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/chat/completions",
+                "body": {
+                    # Batch deployments are addressed by name, as in the request URL
+                    "model": self.deployment_id,
+                    "messages": self.format_messages(text, signature),
+                    **lm_kwargs,
+                },
+            }
+            for custom_id, text in zip(custom_ids, texts)
+        ]
+
+    def write_batch_file(self, texts: list[str], path: str, custom_ids: list[str] | None = None) -> list[str]:
+        """
+        Write the batch job file of the texts and return their custom_ids.
+        """
+        requests = self.batch_requests(texts, custom_ids)
+        with open(path, "w", encoding="utf-8") as file:
+            for request in requests:
+                file.write(json.dumps(request, ensure_ascii=False) + "\n")
+        return [request["custom_id"] for request in requests]
+
+    def read_batch_results(
+        self, path: str, texts: dict[str, str] | None = None
+    ) -> dict[str, Prediction | Exception]:
+        """
+        Parse the output file of a batch job into validated inspections, by
+        custom_id. A request that failed, or whose answer is invalid, maps to
+        the exception explaining why; there is no retry in batch mode.
+        With pre_extraction, the texts of the requests, by custom_id, are
+        needed to apply it.
+        """
+        if self.pre_extraction is not None and texts is None:
+            raise ValueError("The texts of the batch are needed to apply pre_extraction.")
+        signature = self._predictor()._prepare_signature()
+        results = {}
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                custom_id = record["custom_id"]
+                response = record.get("response") or {}
+                if record.get("error") or response.get("status_code") != 200:
+                    error = record.get("error") or response.get("body", {}).get("error")
+                    results[custom_id] = RuntimeError(
+                        f"The batch request {custom_id} failed: {error}"
+                    )
+                    continue
+
+                body = response["body"]
+                try:
+                    parsed, salvaged = _parse_completion(
+                        self.adapter, signature, body["choices"][0]["message"]["content"]
+                    )
+                except (pydantic.ValidationError, ValueError) as e:
+                    results[custom_id] = e
+                    continue
+                prediction = Prediction.from_completions(
+                    {name: [value] for name, value in parsed.items()}
+                )
+                usage = CallUsage([attempt_usage(body.get("usage"), 0.0)])
+                prediction = self._with_usage(prediction, usage, salvaged)
+                if self.pre_extraction is not None:
+                    prediction = self._pre_extracted(prediction, texts[custom_id])
+                results[custom_id] = prediction
+        return results
+
+    def create_inspection_chunked(self, text, max_chunk_tokens=None) -> Prediction:
+        """
+        Extract an inspection from a long text by splitting it into chunks
+        under the token budget of the deployment, extracting each chunk
+        concurrently and merging the partial inspections in chunk order.
+        """
+        chunks = split_text(text, max_chunk_tokens or self.config["chunk_tokens"])
+        if len(chunks) == 1:
+            return self.create_inspection(text)
+
+        # The chunks are recorded as a single extraction
+        usages = []
+
+        def run(chunk):
+            return self._pre_extracted(self._predict(self._signature(), chunk, usages), chunk)
+
+        try:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                predictions = list(executor.map(run, chunks))
+        finally:
+            USAGE.record(self.deployment_id, CallUsage.combine(usages))
+
+        completions = {
+            "inspection": [merge_inspections([p.inspection for p in predictions])]
+        }
+        if self.mode == "reasoning":
+            completions["reasoning"] = ["\n\n".join(p.reasoning for p in predictions)]
+        prediction = Prediction.from_completions(completions)
+        usage = CallUsage.combine([p.usage for p in predictions])
+        salvaged = {}
+        for p in predictions:
+            salvaged.update(p.salvaged)
+        return self._with_usage(prediction, usage, salvaged)
+
+    def create_inspection_sectioned(self, text) -> Prediction:
+        """
+        Extract each group of INSPECTION_SECTIONS with its own smaller request,
+        all running concurrently on the same text, and combine them into one
+        inspection. Latency is bounded by the slowest section.
+        """
+
+        signatures = (
+            PRE_EXTRACTED_SECTION_SIGNATURES
+            if self.pre_extraction == "replace"
+            else SECTION_SIGNATURES
+        )
+
+        # The sections are recorded as a single extraction
+        usages = []
+
+        def run(signature):
+            return self._predict(signature, text, usages)
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(signatures)) as executor:
+                predictions = dict(zip(signatures, executor.map(run, signatures.values())))
+        finally:
+            USAGE.record(self.deployment_id, CallUsage.combine(usages))
+
+        values = {}
+        for prediction in predictions.values():
+            values.update(prediction.inspection.model_dump(exclude_unset=True))
+        # Validating the combined values applies the FertilizerInspection rules
+        completions = {"inspection": [FertilizerInspection.model_validate(values)]}
+        if self.mode == "reasoning":
+            completions["reasoning"] = [
+                "\n\n".join(
+                    f"{section}: {prediction.reasoning}"
+                    for section, prediction in predictions.items()
+                )
+            ]
+        prediction = Prediction.from_completions(completions)
+        usage = CallUsage.combine([p.usage for p in predictions.values()])
+        return self._pre_extracted(self._with_usage(prediction, usage), text)
+
+    def format_messages(self, text, signature=None) -> list[dict]:
+        """
+        Messages sent to the LLM for a text. Everything before the text is the
+        same for every label (see prompt_prefix).
+        """
+        signature = signature or self._predictor()._prepare_signature()
+        return self.adapter.format(
+            signature, [], {"requirements": REQUIREMENTS, "text": text}
+        )
+
+    def prompt_prefix(self) -> str:
+        """
+        Static part of the prompt, shared by all labels: the system message
+        and the user message up to the label text.
+        """
+        marker = "\x00"
+        system, user = self.format_messages(marker)
+        return system["content"] + user["content"].split(marker)[0]
+
+    def prompt_cache_report(self) -> dict:
+        """
+        Prompt tokens served from the provider prompt cache, over the calls
+        made by the LM of this instance.
+        """
+        return prompt_cache_usage(self.lm.history)
+
+    def _stream(self, text) -> tuple[_InspectionStream, list[dict]]:
+        signature = self._predictor()._prepare_signature()
+        complete = None
+        if self.pre_extraction is not None:
+            extracted = pre_extract(text)
+
+            def complete(inspection):
+                return self._apply_pre_extraction(inspection, extracted)[0]
+
+        stream = _InspectionStream(signature, self.adapter, complete)
+        return stream, self.format_messages(text, signature)
+
+    def stream_inspection(self, text) -> Iterator[FertilizerInspection]:
+        """
+        Streaming variant of create_inspection. Yields partial inspections as
+        soon as new fields are generated and validated; the last one yielded
+        is the complete inspection. There is no retry on an invalid answer.
+        In "direct" mode fields arrive right away, as no reasoning is written.
+        """
+        stream, messages = self._stream(text)
+        self.limiter.acquire(estimate_request_tokens(messages, text))
+        response = litellm.completion(
+            model=self.lm.model,
+            messages=messages,
+            stream=True,
+            **self.lm.kwargs,
+            **self.adapter.lm_kwargs(stream.signature),
+        )
+        for chunk in response:
+            if inspection := stream.feed(chunk.choices[0].delta.content):
+                yield inspection
+        yield stream.finish()
+
+    async def astream_inspection(self, text) -> AsyncIterator[FertilizerInspection]:
+        """
+        Async variant of stream_inspection, sharing the concurrency limit of
+        acreate_inspection.
+        """
+        stream, messages = self._stream(text)
+        async with self.semaphore:
+            await self.limiter.aacquire(estimate_request_tokens(messages, text))
+            response = await litellm.acompletion(
+                model=self.lm.model,
+                messages=messages,
+                stream=True,
+                **self.lm.kwargs,
+                **self.adapter.lm_kwargs(stream.signature),
+            )
+            async for chunk in response:
+                if inspection := stream.feed(chunk.choices[0].delta.content):
+                    yield inspection
+        yield stream.finish()
+
+    async def acreate_inspection(self, text) -> Prediction:
+        """
+        Async counterpart of create_inspection. The request is sent through
+        litellm's async client, so no thread is held while waiting on the LLM,
+        and is cached and recorded in the history of the LM as with the LM.
+        """
+        predictor = self._predictor()
+        signature = predictor._prepare_signature()
+        adapter = self.adapter
+        lm_kwargs = adapter.lm_kwargs(signature)
+        inputs = {"requirements": REQUIREMENTS, "text": text}
+
+        errors = {}
+        attempts = []
+        try:
+            for try_i in range(predictor.max_retries):
+                messages = adapter.format(signature, [], inputs)
+                async with self.semaphore:
+                    await self.limiter.aacquire(estimate_request_tokens(messages, text))
+                    start_time = time.perf_counter()
+                    response = await _acall_lm(self.lm, messages, **lm_kwargs)
+                    latency = time.perf_counter() - start_time
+                attempts.append(attempt_usage(getattr(response, "usage", None), latency))
+                completion = response.choices[0].message.content
+
+                try:
+                    parsed, salvaged = _parse_completion(adapter, signature, completion)
+                    if salvaged:
+                        attempts[-1]["salvaged"] = salvaged
+                    prediction = Prediction.from_completions(
+                        {name: [value] for name, value in parsed.items()}
+                    )
+                    break
+                except (pydantic.ValidationError, ValueError) as e:
+                    # Same feedback loop as TypedPredictor: show the error to the LM.
+                    error_field = f"error_general_{try_i}"
+                    errors["general"] = str(e)
+                    inputs[error_field] = str(e)
+                    signature = signature.append(
+                        error_field,
+                        dspy.InputField(
+                            prefix="Past Error in General:",
+                            desc="An error to avoid in the future",
+                        ),
+                    )
+            else:
+                raise ValueError(
+                    "Too many retries trying to get the correct output format.", errors
+                )
+        finally:
+            USAGE.record(self.deployment_id, CallUsage(attempts))
+        return self._pre_extracted(self._with_usage(prediction, CallUsage(attempts)), text)
+
+
+async def _acall_lm(lm: dspy.LM, messages: list[dict], **kwargs):
+    """
+    Async counterpart of dspy.LM.__call__, returning the litellm response.
+    The request uses the cache of the LM, is appended to its history and, when
+    tracing is enabled, gets a span as the instrumented calls do.
+    """
+    kwargs = {**lm.kwargs, **kwargs}
+    cache = kwargs.pop("cache", lm.cache)
+    with lm_span(lm, messages, kwargs) as record_outputs:
+        response = await litellm.acompletion(
+            model=lm.model,
+            messages=messages,
+            cache={"no-cache": not cache, "no-store": not cache},
+            **kwargs,
+        )
+        outputs = [choice.message.content for choice in response.choices]
+        record_outputs(outputs)
+
+    # Same entry as dspy.LM.__call__, without the API key
+    usage = getattr(response, "usage", None) or {}
+    lm.history.append(
+        {
+            "prompt": None,
+            "messages": messages,
+            "kwargs": {k: v for k, v in kwargs.items() if not k.startswith("api_")},
+            "response": response,
+            "outputs": outputs,
+            "usage": dict(usage) if isinstance(usage, dict) else dict(vars(usage)),
+            "cost": getattr(response, "_hidden_params", {}).get("response_cost"),
+            "timestamp": datetime.now().isoformat(),
+            "uuid": str(uuid.uuid4()),
+            "model": lm.model,
+            "model_type": lm.model_type,
+        }
+    )
+    return response
+
+
+def _parse_completion(adapter, signature, completion) -> tuple[dict, dict]:
+    # Output fields parsed as TypedPredictor does, and the salvaged fields
+    values, salvaged = adapter.parse_salvaging(signature, completion, _parse_values=False)
+    parsed = {
+        name: field.json_schema_extra["parser"](values[name])
+        for name, field in signature.output_fields.items()
+    }
+    return parsed, salvaged
+
+
+def prompt_cache_usage(history: list[dict]) -> dict:
+    """
+    Cached and uncached prompt tokens per call and in total, from an LM history.
+    """
+    calls = []
+    for entry in history:
+        usage = entry.get("usage") or {}
+        prompt_tokens = usage.get("prompt_tokens") or 0
+        cached_tokens = cached_prompt_tokens(usage)
+        calls.append(
+            {
+                "prompt_tokens": prompt_tokens,
+                "cached_tokens": cached_tokens,
+                "uncached_tokens": prompt_tokens - cached_tokens,
+            }
+        )
+
+    prompt_tokens = sum(call["prompt_tokens"] for call in calls)
+    cached_tokens = sum(call["cached_tokens"] for call in calls)
+    return {
+        "calls": calls,
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": cached_tokens,
+        "uncached_tokens": prompt_tokens - cached_tokens,
+        "hit_ratio": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+    }
@@ -1,11 +1,18 @@
+import copy
+import itertools
+import json
 import re
-from typing import List, Optional
+import typing
+from functools import lru_cache
+from typing import Iterable, Iterator, List, Optional
 
 import phonenumbers
 from pydantic import (
     BaseModel,
     ConfigDict,
     Field,
+    TypeAdapter,
+    ValidationError,
     field_validator,
     model_validator,
 )
@@ -15,13 +22,51 @@ class npkError(ValueError):
     pass
 
 
+# Compiled once, the validators run for every field of every inspection
+NUMBER_PATTERN = re.compile(r"\d+(\.\d+)?")
+NPK_PATTERN = re.compile(r"^\d+(\.\d+)?-\d+(\.\d+)?-\d+(\.\d+)?$")
+REGISTRATION_NUMBER_PATTERN = re.compile(r"^\d{7}[A-Z]$")
+MINIMAL_PATTERN = re.compile(r"\bminim\w*\b", re.IGNORECASE)
+
+REGISTRATION_NUMBER_TYPES = frozenset({"ingredient_component", "fertilizer_product"})
+
+
 def extract_first_number(string: str) -> Optional[str]:
     if string is not None:
-        match = re.search(r"\d+(\.\d+)?", string)
+        match = NUMBER_PATTERN.search(string)
         if match:
             return match.group()
     return None
 
+
+def _number_or_none(v):
+    # Numbers are passed as strings, for pydantic to parse them as floats
+    if isinstance(v, bool):
+        return None
+    elif isinstance(v, (int, float)):
+        return str(v)
+    elif isinstance(v, str):
+        return extract_first_number(v)
+    return None
+
+
+@lru_cache(maxsize=4096)
+def normalize_phone_number(v: str) -> Optional[str]:
+    """
+    The E.164 form of a phone number, Canadian by default, or None when it is
+    not a valid number. Labels of a manufacturer repeat the same numbers, so
+    the (slow) parsing is memoized.
+    """
+    try:
+        phone_number = phonenumbers.parse(v, "CA", _check_region=False)
+        if not phonenumbers.is_valid_number(phone_number):
+            return None
+        return phonenumbers.format_number(
+            phone_number, phonenumbers.PhoneNumberFormat.E164
+        )
+    except phonenumbers.phonenumberutil.NumberParseException:
+        return None
+
 class Organization(BaseModel):
     """
     Represents an organization such as a manufacturer, company, or any entity 
@@ -36,17 +81,11 @@ class Organization(BaseModel):
     def validate_phone_number(cls, v):
         if v is None:
             return None
-        try:
-            phone_number = phonenumbers.parse(v, "CA", _check_region=False)
-            if not phonenumbers.is_valid_number(phone_number):
-                return None
-            phone_number = phonenumbers.format_number(
-                phone_number, phonenumbers.PhoneNumberFormat.E164
-            )
-            return phone_number
-
-        except phonenumbers.phonenumberutil.NumberParseException:
-            return None
+        # Only strings reach the cache, other values (e.g. a list from a
+        # malformed answer) are invalid instead of unhashable
+        if not isinstance(v, str):
+            raise ValueError("The phone number must be a string.")
+        return normalize_phone_number(v)
         
     @field_validator("website", mode="before")
     def website_lowercase(cls, v):
@@ -64,13 +103,7 @@ class NutrientValue(BaseModel):
 
     @field_validator("value", mode="before", check_fields=False)
     def convert_value(cls, v):
-        if isinstance(v, bool):
-            return None
-        elif isinstance(v, (int, float)):
-            return str(v)
-        elif isinstance(v, (str)):
-            return extract_first_number(v)
-        return None
+        return _number_or_none(v)
 
 
 class Value(BaseModel):
@@ -79,13 +112,7 @@ class Value(BaseModel):
 
     @field_validator("value", mode="before", check_fields=False)
     def convert_value(cls, v):
-        if isinstance(v, bool):
-            return None
-        elif isinstance(v, (int, float)):
-            return str(v)
-        elif isinstance(v, (str)):
-            return extract_first_number(v)
-        return None
+        return _number_or_none(v)
 
 # class syntax
 
@@ -96,14 +123,13 @@ class RegistrationNumber(BaseModel):
     @field_validator("identifier", mode="before")
     def check_registration_number_format(cls, v):
         if v is not None:
-            pattern = r"^\d{7}[A-Z]$"
-            if re.match(pattern, v):
+            if REGISTRATION_NUMBER_PATTERN.match(v):
                 return v
         return None
 
     @field_validator("type", mode="before")
     def check_registration_number_type(cls, v):
-        if v not in ["ingredient_component", "fertilizer_product"]:
+        if not isinstance(v, str) or v not in REGISTRATION_NUMBER_TYPES:
             return None
         return v
 
@@ -123,9 +149,8 @@ class GuaranteedAnalysis(BaseModel):
 
     @model_validator(mode="after")
     def set_is_minimal(self):
-        pattern = r"\bminim\w*\b"
         if self.title:
-            self.is_minimal = re.search(pattern, self.title, re.IGNORECASE) is not None
+            self.is_minimal = MINIMAL_PATTERN.search(self.title) is not None
         return self
 
 
@@ -136,13 +161,7 @@ class Specification(BaseModel):
 
     @field_validator("humidity", "ph", "solubility", mode="before", check_fields=False)
     def convert_specification_values(cls, v):
-        if isinstance(v, bool):
-            return None
-        elif isinstance(v, (int, float)):
-            return str(v)
-        elif isinstance(v, (str)):
-            return extract_first_number(v)
-        return None
+        return _number_or_none(v)
 
 
 class FertilizerInspection(BaseModel):
@@ -167,8 +186,7 @@ class FertilizerInspection(BaseModel):
     @field_validator("npk", mode="before")
     def validate_npk(cls, v):
         if v is not None:
-            pattern = re.compile(r"^\d+(\.\d+)?-\d+(\.\d+)?-\d+(\.\d+)?$")
-            if not pattern.match(v):
+            if not NPK_PATTERN.match(v):
                 return None
         return v
 
@@ -188,3 +206,413 @@ class FertilizerInspection(BaseModel):
         if v is None:
             v = []
         return v
+
+
+# Built once: building a validator for the whole schema is slow
+_INSPECTION = TypeAdapter(FertilizerInspection)
+_JSON_ARRAY = TypeAdapter(list)
+
+
+# Each item is validated once, on its own: validating the whole list first
+# would have to start over, item by item, as soon as one LLM answer is invalid
+def _validate_each(raws: list, validate) -> list[FertilizerInspection | ValidationError]:
+    results = []
+    for raw in raws:
+        try:
+            results.append(validate(raw))
+        except ValidationError as error:
+            results.append(error)
+    return results
+
+
+def validate_inspections(
+    raws: list[dict],
+) -> list[FertilizerInspection | ValidationError]:
+    """
+    Validate many raw inspections (e.g. decoded LLM answers) at once. Returns,
+    in order, the inspection or the validation error of each one.
+    """
+    return _validate_each(raws, _INSPECTION.validate_python)
+
+
+def validate_inspections_json(
+    data: str | bytes,
+) -> list[FertilizerInspection | ValidationError]:
+    """
+    Validate a JSON array of raw inspections. Raises a ValidationError when
+    the document itself is not a JSON array.
+    """
+    # json.loads builds the Python objects faster than pydantic's parser,
+    # which only reports what is wrong with the document
+    try:
+        raws = _JSON_ARRAY.validate_python(json.loads(data))
+    except ValueError:
+        raws = _JSON_ARRAY.validate_json(data)
+    return _validate_each(raws, _INSPECTION.validate_python)
+
+
+def validate_inspections_ndjson(
+    lines: Iterable[str | bytes], batch_size: int = 1000
+) -> Iterator[FertilizerInspection | ValidationError]:
+    """
+    Validate newline-delimited JSON, one raw inspection per line, e.g. a file
+    opened in binary mode. Yields the inspection or the validation error of
+    each non-blank line, so malformed lines don't stop the stream. Lines are
+    validated by batches of batch_size.
+    """
+    lines = (line for line in lines if line.strip())
+    while batch := list(itertools.islice(lines, batch_size)):
+        yield from _validate_each(batch, _INSPECTION.validate_json)
+
+
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+class PartialJSON:
+    """
+    Incremental form of close_partial_json, for a text that grows, e.g. a
+    streamed LLM answer: each character is scanned once, however often the
+    closed document is asked for.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.start = None  # index of the first { or [
+        self.end = None  # end index of the document, once complete
+        self.i = 0  # next index to scan
+        self.stack = []  # open containers
+        self.expects = []  # next expected token of each open container
+        self.cut = None  # (end index, closing brackets) of the last complete value
+        self.in_string = self.escape = False
+        self.in_scalar = False
+
+    def _close_value(self, end):
+        self.expects[-1] = "comma"
+        self.cut = (end, "".join(_CLOSERS[c] for c in reversed(self.stack)))
+
+    def feed(self, text: str) -> bool:
+        """Add text, and return whether the closed document changed."""
+        self.text += text
+        text = self.text
+        before = (self.cut, self.end)
+        if self.start is None:
+            starts = [i for i in (text.find("{", self.i), text.find("[", self.i)) if i != -1]
+            if not starts:
+                self.i = len(text)
+                return False
+            self.start = self.i = min(starts)
+
+        stack, expects = self.stack, self.expects
+        i = self.i
+        while self.end is None and i < len(text):
+            char = text[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    if stack[-1] == "{" and expects[-1] == "key":
+                        expects[-1] = "colon"
+                    else:
+                        self._close_value(i + 1)
+            elif self.in_scalar:
+                if char in ",}] \t\r\n":
+                    self.in_scalar = False
+                    self._close_value(i)
+                    continue  # the delimiter is handled on the next pass
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                stack.append(char)
+                expects.append("key" if char == "{" else "value")
+                self.cut = (i + 1, "".join(_CLOSERS[c] for c in reversed(stack)))
+            elif char in "}]":
+                stack.pop()
+                expects.pop()
+                if not stack:
+                    self.end = i + 1
+                    break
+                self._close_value(i + 1)
+            elif char == ":":
+                expects[-1] = "value"
+            elif char == ",":
+                expects[-1] = "key" if stack[-1] == "{" else "value"
+            elif not char.isspace():
+                self.in_scalar = True
+            i += 1
+        self.i = i
+        return (self.cut, self.end) != before
+
+    def closed(self) -> Optional[tuple[str, int]]:
+        """The closed document, and the number of containers that had to be closed."""
+        if self.end is not None:
+            return self.text[self.start : self.end], 0
+        if self.cut is None:
+            return None
+        end, closing = self.cut
+        return self.text[self.start : end] + closing, len(closing)
+
+
+def _close_partial_json(text: str) -> Optional[tuple[str, int]]:
+    partial = PartialJSON()
+    partial.feed(text)
+    return partial.closed()
+
+
+def close_partial_json(text: str) -> Optional[str]:
+    """
+    Turn the beginning of a JSON document (e.g. an LLM answer still being
+    generated) into valid JSON. The text is cut after the last complete value
+    and every open object or array is closed. Incomplete keys, strings and
+    numbers are dropped. Returns None when no JSON document was started.
+    """
+    closed = _close_partial_json(text)
+    return closed[0] if closed is not None else None
+
+
+def _drop_trailing_commas(text: str) -> str:
+    # Commas followed by the end of an object or array, outside of strings
+    chars = []
+    comma = None  # index in chars of a comma that may be trailing
+    in_string = escape = False
+    for char in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+            comma = None
+        elif char in "}]":
+            if comma is not None:
+                chars[comma] = ""
+            comma = None
+        elif char == ",":
+            comma = len(chars)
+        elif not char.isspace():
+            comma = None
+        chars.append(char)
+    return "".join(chars)
+
+
+def repair_json(text: str) -> Optional[tuple[typing.Any, int]]:
+    """
+    Parse a malformed JSON answer of an LLM: cut off (e.g. at max_tokens),
+    with trailing commas, or surrounded by text or a code fence. Open objects
+    and arrays are closed and the incomplete trailing element is dropped.
+    Returns the value and the number of containers that were left open, 0 if
+    the document was complete, or None when there is no JSON document.
+    """
+    closed = _close_partial_json(_drop_trailing_commas(text))
+    if closed is None:
+        return None
+    repaired, open_containers = closed
+    try:
+        return json.loads(repaired), open_containers
+    except json.JSONDecodeError:
+        return None
+
+
+def _drop_invalid(data: dict, error: ValidationError) -> set[str]:
+    # Drop the list items, or else the fields, that failed validation.
+    # Returns the names of the affected fields.
+    items = {}
+    fields = set()
+    for detail in error.errors():
+        loc = detail["loc"]
+        if not loc or loc[0] not in data:
+            raise error
+        fields.add(loc[0])
+        last_index = max((i for i, key in enumerate(loc) if isinstance(key, int)), default=None)
+        if last_index is None:
+            items[loc[:1]] = None
+        else:
+            items[loc[: last_index + 1]] = None
+
+    # Deepest and last items first, so the other paths stay valid
+    for path in sorted(items, key=lambda p: (len(p), p[-1]), reverse=True):
+        container = data
+        for key in path[:-1]:
+            container = container.get(key) if isinstance(container, dict) else container[key]
+        if isinstance(container, list) or path[-1] in container:
+            del container[path[-1]]
+    return fields
+
+
+def salvage_inspection(
+    answer: str | dict, open_containers: int = 0
+) -> tuple[FertilizerInspection, dict[str, str]]:
+    """
+    Validate what can be saved of a malformed inspection answer instead of
+    asking the LLM again. The text is repaired with repair_json, then the list
+    items and fields that don't validate are dropped. An already repaired dict
+    can be given with the number of containers that were left open in it.
+
+    Returns the inspection and the salvaged fields, flagged "truncated" (the
+    answer was cut off in it), "missing" (the answer was cut off before it) or
+    "invalid" (its value, or some of its items, were dropped). Raises a
+    ValueError when there is no inspection to salvage, or when no field of
+    it could be salvaged, so that the LLM is asked again.
+    """
+    if isinstance(answer, str):
+        repaired = repair_json(answer)
+        if repaired is None:
+            raise ValueError("No JSON object in the answer.")
+        answer, open_containers = repaired
+    if not isinstance(answer, dict):
+        raise ValueError("The answer is not a JSON object.")
+
+    data = copy.deepcopy(answer)
+    flags = {}
+    if open_containers:
+        if open_containers > 1 and data:
+            flags[next(reversed(data))] = "truncated"
+        for name in FertilizerInspection.model_fields:
+            if name not in data:
+                flags[name] = "missing"
+
+    while True:
+        try:
+            inspection = FertilizerInspection.model_validate(data)
+        except ValidationError as error:
+            for name in _drop_invalid(data, error):
+                flags.setdefault(name, "invalid")
+        else:
+            break
+
+    if flags and _is_empty(inspection):
+        raise ValueError("No field of the inspection could be salvaged.")
+    return inspection, flags
+
+
+def _is_empty(value) -> bool:
+    if isinstance(value, BaseModel):
+        return all(_is_empty(v) for v in value.__dict__.values())
+    return value is None or value == "" or value == []
+
+
+MERGE_POLICIES = ("first", "last", "most_common")
+
+# Fields identifying an item of a list across partial inspections, in order
+# of preference. Items of other models are only merged when equal.
+_MERGE_KEYS = {
+    Organization: ("name", "website", "phone_number"),
+    RegistrationNumber: ("identifier",),
+    NutrientValue: ("nutrient",),
+}
+
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+def _normalize_key(text: str) -> str:
+    # Case, spacing and punctuation differ from one chunk to the other
+    return _NON_WORD.sub("", text.casefold())
+
+
+def _dedupe_key(item):
+    if isinstance(item, str):
+        return _normalize_key(item)
+    if isinstance(item, BaseModel):
+        for name in _MERGE_KEYS.get(type(item), ()):
+            value = getattr(item, name)
+            if value:
+                return name, _normalize_key(value)
+        return item.model_dump_json()
+    return item
+
+
+def _has_list_fields(model_class) -> bool:
+    return any(
+        typing.get_origin(field.annotation) is list
+        for field in model_class.model_fields.values()
+    )
+
+
+def _resolve(values: list, policy: str):
+    values = [v for v in values if not _is_empty(v)]
+    if not values:
+        return None
+    if policy == "last":
+        return values[-1]
+    if policy == "most_common":
+        # Ties go to the value seen first
+        counts = {}
+        for value in values:
+            key = _dedupe_key(value)
+            if key in counts:
+                counts[key][0] += 1
+            else:
+                counts[key] = [1, value]
+        return max(counts.values(), key=lambda count: count[0])[1]
+    return values[0]
+
+
+def _merge_items(values: list, policies: dict, default: str) -> list:
+    # Items sharing a key are grouped in one pass, then merged group by group
+    groups = {}
+    for value in values:
+        for item in value or []:
+            groups.setdefault(_dedupe_key(item), []).append(item)
+    items = []
+    for group in groups.values():
+        if len(group) > 1 and isinstance(group[0], BaseModel):
+            items.append(_merge_models(group, policies, default) or group[0])
+        else:
+            items.append(group[0])
+    return items
+
+
+def _merge_models(
+    models: list[BaseModel], policies: dict | None = None, default: str = "first"
+) -> BaseModel | None:
+    policies = policies or {}
+    models = [m for m in models if not _is_empty(m)]
+    if not models:
+        return None
+
+    model_class = type(models[0])
+    merged = {}
+    for name, field in model_class.model_fields.items():
+        values = [getattr(m, name) for m in models]
+        if typing.get_origin(field.annotation) is list:
+            # Union of every list, without duplicates, in first-seen order
+            merged[name] = _merge_items(values, policies, default)
+        elif any(isinstance(v, BaseModel) and _has_list_fields(type(v)) for v in values):
+            # Sections such as the guaranteed analysis are merged field by field
+            merged[name] = _merge_models(values, policies, default)
+        else:
+            merged[name] = _resolve(values, policies.get(name, default))
+
+    return model_class(**merged)
+
+
+def merge_inspections(
+    inspections: list[FertilizerInspection], policy: str | dict[str, str] = "first"
+) -> FertilizerInspection:
+    """
+    Merge partial inspections (e.g. one per chunk of a long label) into one,
+    in time linear in the number of items.
+    Lists are unioned in first-seen order. Organizations, registration
+    numbers, nutrients and strings are deduplicated by a normalized key (the
+    name, identifier or text, ignoring case, spacing and punctuation), and
+    the duplicates are merged field by field. Conflicting scalars are
+    resolved by the policy, one of MERGE_POLICIES, or a dict of policies by
+    field name, where "*" sets the default:
+    - first: the first non-null value
+    - last: the last non-null value
+    - most_common: the most frequent non-null value, the first one on ties
+    The result only depends on the order of the given inspections.
+    """
+    policies = dict(policy) if isinstance(policy, dict) else {"*": policy}
+    default = policies.pop("*", "first")
+    for name in [default, *policies.values()]:
+        if name not in MERGE_POLICIES:
+            raise ValueError(
+                f"Unsupported merge policy: {name!r}. Expected one of {MERGE_POLICIES}."
+            )
+    return _merge_models(inspections, policies, default) or FertilizerInspection()
@@ -1,26 +1,56 @@
+import threading
 from PIL import Image
 from io import BytesIO
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.utils import ImageReader
 
 class LabelStorage:
+    """
+    Images of a label. The storage can be shared between threads: images are
+    added, taken and removed under a lock, and documents are built from a
+    snapshot of the images.
+    """
+
     def __init__(self):
         self.images = []
+        self._lock = threading.Lock()
 
     def add_image(self, image_bytes: bytes):
         try:
             image = Image.open(BytesIO(image_bytes))
-            self.images.append(image)
         except Exception as e:
             raise ValueError(f"Invalid image data: {e}")
+        with self._lock:
+            self.images.append(image)
+
+    def snapshot(self) -> list:
+        """
+        Images currently in the storage, unaffected by later changes.
+        """
+        with self._lock:
+            return list(self.images)
+
+    def take(self) -> list:
+        """
+        Remove and return the images currently in the storage, so that no
+        other caller processes them too.
+        """
+        with self._lock:
+            images, self.images = self.images, []
+        return images
 
-    def _create_composite_image(self) -> Image:
-        if not self.images:
+    def restore(self, images: list):
+        """
+        Put back taken images, e.g. when their processing failed, ahead of
+        the ones added since.
+        """
+        with self._lock:
+            self.images = images + self.images
+
+    def _create_composite_image(self, images: list) -> Image:
+        if not images:
             raise ValueError("No images to merge.")
 
         # Get dimensions of images
-        widths, heights = zip(*(img.size for img in self.images))
+        widths, heights = zip(*(img.size for img in images))
 
         total_height = sum(heights)
         max_width = max(widths)
@@ -29,17 +59,22 @@ class LabelStorage:
         composite_image = Image.new('RGB', (max_width, total_height))
 
         y_offset = 0
-        for img in self.images:
+        for img in images:
             composite_image.paste(img, (0, y_offset))
             y_offset += img.height
 
         return composite_image
     
-    def _create_pdf_document(self) -> BytesIO:
+    def _create_pdf_document(self, images: list) -> BytesIO:
+        # reportlab is only needed for PDF documents
+        from reportlab.pdfgen import canvas
+        from reportlab.lib.pagesizes import letter
+        from reportlab.lib.utils import ImageReader
+
         pdf_buffer = BytesIO()
         c = canvas.Canvas(pdf_buffer, pagesize=letter)
 
-        for image in self.images:
+        for image in images:
             # Convert PIL image to bytes
             img_buffer = ImageReader(image)
 
@@ -53,19 +88,24 @@ class LabelStorage:
         return pdf_buffer
     
     def clear(self):
-        self.images = []
+        with self._lock:
+            self.images = []
+
+    def get_document(self, format='pdf', images: list = None) -> bytes:
+        # Built from a snapshot, so that images added meanwhile are left out
+        if images is None:
+            images = self.snapshot()
 
-    def get_document(self, format='pdf') -> bytes:
         # Ensure there are images to merge
-        if not self.images:
+        if not images:
             raise ValueError("No images to merge.")
         
         output = BytesIO()
         
         if format == 'pdf':
-            output = self._create_pdf_document()
+            output = self._create_pdf_document(images)
         elif format == 'png':
-            composite_image = self._create_composite_image()
+            composite_image = self._create_composite_image(images)
             composite_image.save(output, format='PNG')
         else:
             raise ValueError("Unknown document format output.")
@@ -7,9 +7,11 @@ class OCR:
         if not api_endpoint or not api_key:
             raise ValueError("API endpoint and key are required to instantiate the OCR class.")
 
+        self.api_endpoint = api_endpoint
+        self.credential = AzureKeyCredential(api_key)
         self.client = DocumentIntelligenceClient(
             endpoint=api_endpoint,
-            credential=AzureKeyCredential(api_key)
+            credential=self.credential
         )
 
     def extract_text(self, document: bytes) -> AnalyzeResult:
@@ -20,3 +22,20 @@ class OCR:
         )
         result = poller.result()
         return result
+
+    async def extract_text_async(self, document: bytes) -> AnalyzeResult:
+        """
+        Async counterpart of extract_text, polling the analysis without
+        holding a thread. The async client is bound to the running event
+        loop, so one is opened per call.
+        """
+        # The async client is only needed, and loaded, on this path
+        from azure.ai.documentintelligence.aio import DocumentIntelligenceClient as AsyncClient
+
+        async with AsyncClient(endpoint=self.api_endpoint, credential=self.credential) as client:
+            poller = await client.begin_analyze_document(
+                model_id="prebuilt-layout",
+                body=AnalyzeDocumentRequest(bytes_source=document),
+                output_content_format=DocumentContentFormat.MARKDOWN
+            )
+            return await poller.result()
@@ -0,0 +1,175 @@
+import re
+from typing import Optional
+
+import phonenumbers
+
+from pipeline.inspection import FertilizerInspection, Organization
+
+NPK = re.compile(
+    r"(?<![\w.-])(\d{1,2}(?:\.\d+)?)\s*-\s*(\d{1,2}(?:\.\d+)?)\s*-\s*(\d{1,2}(?:\.\d+)?)(?![\w.-])"
+)
+REGISTRATION_NUMBER = re.compile(r"\b\d{7}[A-Z]\b")
+WEBSITE = re.compile(
+    r"(?<![@\w.])(?:https?://)?((?:www\.)?[a-z0-9-]+(?:\.[a-z0-9-]+)*\.(?:ca|com|net|org))\b(?![@\w]|\.\w)",
+    re.IGNORECASE,
+)
+# Dates and lot numbers written like an NPK, e.g. "Lot 12-05-23"
+DATE_CONTEXT = re.compile(
+    r"\b(?:lot|date|exp\w*|mfg|manufactured|batch|fabriqu\w*|best before)\b[^\n]{0,20}$",
+    re.IGNORECASE,
+)
+NPK_CONTEXT = re.compile(r"n\s*-\s*p\s*-\s*k|guarantee|garanti", re.IGNORECASE)
+# A comma followed by exactly three digits separates thousands, "1,000 kg",
+# any other is a decimal comma, "2,5 kg". Units followed by a slash are
+# concentrations or densities, "20 g/L"
+WEIGHT = re.compile(
+    r"(?<![\w.,])(\d{1,3}(?:,\d{3})+(?![\d,])(?:\.\d+)?|\d+(?:[.,]\d+)?)\s*(kgs?|g|lbs?)\b(?!/)",
+    re.IGNORECASE,
+)
+# Grams are mostly doses, "Dissolve 50 g", and only a weight after a net
+# weight keyword, "Net wt. 327 g"
+NET_WEIGHT_CONTEXT = re.compile(
+    r"\b(?:net|weight|wt|poids)\b[^\n]{0,20}$", re.IGNORECASE
+)
+THOUSANDS = re.compile(r"\d{1,3}(?:,\d{3})+(?:\.\d+)?")
+
+# Fields of FertilizerInspection that the pre-extraction can fill on its own,
+# and which can be left out of the schema sent to the LLM
+SCHEMA_FIELDS = ("npk", "registration_number", "weight")
+
+
+def _unique(values: list) -> list:
+    return list(dict.fromkeys(values))
+
+
+def _looks_like_date(text: str, match: re.Match) -> bool:
+    # Date parts have a leading zero, "05", and dates follow a keyword
+    if any(len(v) > 1 and v[0] == "0" and v[1] != "." for v in match.groups()):
+        return True
+    line_start = text.rfind("\n", 0, match.start()) + 1
+    return DATE_CONTEXT.search(text[line_start : match.start()]) is not None
+
+
+def _npk(text: str) -> Optional[str]:
+    candidates = [
+        ("-".join(match.groups()), match.start())
+        for match in NPK.finditer(text)
+        if not _looks_like_date(text, match)
+    ]
+    npks = _unique(npk for npk, _ in candidates)
+    if len(npks) > 1:
+        # Keep the ones announced as an NPK or a guaranteed analysis
+        npks = _unique(
+            npk
+            for npk, start in candidates
+            if NPK_CONTEXT.search(text[max(0, start - 80) : start])
+        )
+    return npks[0] if len(npks) == 1 else None
+
+
+def _weight_value(value: str) -> float:
+    if THOUSANDS.fullmatch(value):
+        return float(value.replace(",", ""))
+    return float(value.replace(",", "."))
+
+
+def pre_extract(text: str) -> dict:
+    """
+    Values of the fields with a strict format, found in the label text with
+    the same rules as the FertilizerInspection validators, without an LLM:
+    npk (None when the label has several, dates left aside, and none of them
+    is introduced as an NPK or guaranteed analysis), registration_number and weight
+    as in FertilizerInspection, and the phone_number and website candidates
+    of the organizations.
+    """
+    weights = []
+    for match in WEIGHT.finditer(text):
+        value, unit = match.groups()
+        unit = unit.lower().rstrip("s")
+        if unit == "g":
+            line_start = text.rfind("\n", 0, match.start()) + 1
+            if NET_WEIGHT_CONTEXT.search(text[line_start : match.start()]) is None:
+                continue
+        weight = {"value": _weight_value(value), "unit": unit}
+        if weight not in weights:
+            weights.append(weight)
+    return {
+        "npk": _npk(text),
+        "registration_number": [
+            {"identifier": identifier, "type": None}
+            for identifier in _unique(REGISTRATION_NUMBER.findall(text))
+        ],
+        "weight": weights,
+        "phone_number": _unique(
+            phonenumbers.format_number(match.number, phonenumbers.PhoneNumberFormat.E164)
+            for match in phonenumbers.PhoneNumberMatcher(text, "CA")
+        ),
+        "website": _unique(
+            Organization.website_lowercase(website) for website in WEBSITE.findall(text)
+        ),
+    }
+
+
+def _normalized(inspection: FertilizerInspection, field: str) -> list:
+    # Comparable values of a field of the inspection, as pre_extract returns them
+    if field == "registration_number":
+        return sorted(r.identifier for r in inspection.registration_number if r.identifier)
+    if field == "weight":
+        return sorted(
+            (w.value, (w.unit or "").lower().rstrip("s")) for w in inspection.weight
+        )
+    if field in ("phone_number", "website"):
+        return sorted(
+            getattr(o, field) for o in inspection.organizations if getattr(o, field)
+        )
+    return [inspection.npk] if inspection.npk else []
+
+
+def _extracted(extracted: dict, field: str) -> list:
+    if field == "registration_number":
+        return sorted(r["identifier"] for r in extracted["registration_number"])
+    if field == "weight":
+        return sorted((w["value"], w["unit"]) for w in extracted["weight"])
+    if field in ("phone_number", "website"):
+        return sorted(extracted[field])
+    return [extracted["npk"]] if extracted["npk"] else []
+
+
+def cross_check(inspection: FertilizerInspection, extracted: dict) -> dict[str, dict]:
+    """
+    Fields where the inspection of the LLM disagrees with the values found in
+    the text by pre_extract, as {"llm": ..., "text": ...}. Fields that
+    pre_extract found nothing for are not checked.
+    """
+    discrepancies = {}
+    for field in ("npk", "registration_number", "weight", "phone_number", "website"):
+        found = _extracted(extracted, field)
+        if not found:
+            continue
+        llm = _normalized(inspection, field)
+        if field in ("phone_number", "website"):
+            # The text may list more numbers than the organizations keep
+            agrees = set(llm) <= set(found)
+        else:
+            agrees = llm == found
+        if not agrees:
+            discrepancies[field] = {"llm": llm, "text": found}
+    return discrepancies
+
+
+def prefill(inspection: FertilizerInspection, extracted: dict) -> FertilizerInspection:
+    """
+    Fill the fields the LLM left empty with the values found by pre_extract.
+    A phone number or website is only given to the organization when there
+    is exactly one of each.
+    """
+    values = inspection.model_dump()
+    for field in SCHEMA_FIELDS:
+        if not values[field] and extracted[field]:
+            values[field] = extracted[field]
+    if len(values["organizations"]) == 1:
+        organization = values["organizations"][0]
+        for field in ("phone_number", "website"):
+            if not organization[field] and len(extracted[field]) == 1:
+                organization[field] = extracted[field][0]
+    return FertilizerInspection.model_validate(values)
@@ -0,0 +1,168 @@
+import re
+import threading
+import time
+from collections import deque
+
+from dspy import Prediction
+
+from pipeline.chunking import estimate_tokens, split_sections
+from pipeline.gpt import GPT, SUPPORTED_MODELS
+
+# Quantities such as "20%", "1.2 kg" or "55 lb" on a label.
+QUANTITY = re.compile(r"\d+(?:[.,]\d+)?\s*(?:%|[a-zA-Z]{1,3}\b)")
+
+
+def label_complexity(text: str) -> int:
+    """
+    Rough complexity of a label: its number of sections plus its number of
+    quantities, which drive the size of the guaranteed analysis and weights.
+    """
+    return len(split_sections(text)) + len(QUANTITY.findall(text))
+
+
+def estimate_cost(deployment_id: str, tokens: int) -> float:
+    """
+    Estimated cost in USD of an extraction, assuming an answer about as long
+    as the label text.
+    """
+    cost = SUPPORTED_MODELS[deployment_id]["cost"]
+    return tokens * (cost["prompt"] + cost["completion"]) / 1_000_000
+
+
+class ModelRouter:
+    """
+    Front end of several GPT deployments that picks one per request.
+
+    Short and simple labels go to the cheapest deployment, unless its recent
+    latency is above max_latency. Other labels go to default_deployment.
+    Latencies older than latency_ttl seconds are forgotten, so that a
+    deployment avoided for being slow is tried again once it may have
+    recovered.
+    Deployments that cannot fit the label in one chunk are never picked.
+    The last max_decisions decisions are kept in `decisions`, oldest first.
+    """
+
+    def __init__(
+        self,
+        api_endpoint,
+        api_key,
+        deployment_ids=None,
+        default_deployment="gpt-4o",
+        simple_max_tokens=1500,
+        simple_max_complexity=40,
+        max_latency=30.0,
+        latency_smoothing=0.3,
+        latency_ttl=300.0,
+        max_decisions=1000,
+        **gpt_kwargs,
+    ):
+        deployment_ids = list(deployment_ids or SUPPORTED_MODELS)
+        if default_deployment not in deployment_ids:
+            raise ValueError(
+                f"The default deployment {default_deployment} is not one of {deployment_ids}."
+            )
+
+        self.gpts = {
+            deployment_id: GPT(api_endpoint, api_key, deployment_id, **gpt_kwargs)
+            for deployment_id in deployment_ids
+        }
+        self.default_deployment = default_deployment
+        self.simple_max_tokens = simple_max_tokens
+        self.simple_max_complexity = simple_max_complexity
+        self.max_latency = max_latency
+        self.latency_smoothing = latency_smoothing
+        self.latency_ttl = latency_ttl
+
+        # Exponential moving average of the latency of each deployment, and
+        # the time.monotonic() of its last sample. Only the picked deployment
+        # is measured, so the average of an avoided one would never change.
+        self.latencies: dict[str, float] = {}
+        self.measured_at: dict[str, float] = {}
+        # Bounded, as a long-running router makes one decision per label
+        self.decisions: deque[dict] = deque(maxlen=max_decisions)
+        self._lock = threading.Lock()
+
+    @property
+    def history(self) -> list[dict]:
+        """LM calls of every deployment, as in GPT.lm.history."""
+        return [entry for gpt in self.gpts.values() for entry in gpt.lm.history]
+
+    def route(self, text: str) -> dict:
+        """
+        Pick the deployment for a text, without calling it.
+        """
+        tokens = estimate_tokens(text)
+        complexity = label_complexity(text)
+
+        candidates = [
+            d for d in self.gpts if tokens <= SUPPORTED_MODELS[d]["chunk_tokens"]
+        ] or list(self.gpts)
+
+        with self._lock:
+            latencies = {d: l for d, l in self.latencies.items() if not self._expired(d)}
+
+        if tokens <= self.simple_max_tokens and complexity <= self.simple_max_complexity:
+            ranked = sorted(
+                candidates,
+                key=lambda d: (estimate_cost(d, tokens), latencies.get(d, 0.0)),
+            )
+            fast = [d for d in ranked if latencies.get(d, 0.0) <= self.max_latency]
+            deployment = (fast or ranked)[0]
+            reason = "simple" if deployment == ranked[0] else "simple, cheapest too slow"
+        elif self.default_deployment in candidates:
+            deployment = self.default_deployment
+            reason = "complex"
+        else:
+            deployment = max(candidates, key=lambda d: SUPPORTED_MODELS[d]["chunk_tokens"])
+            reason = "complex, too long for default"
+
+        return {
+            "deployment": deployment,
+            "reason": reason,
+            "tokens": tokens,
+            "complexity": complexity,
+            "estimated_cost": estimate_cost(deployment, tokens),
+            "latencies": latencies,
+            "elapsed": None,
+        }
+
+    def _expired(self, deployment: str) -> bool:
+        measured_at = self.measured_at.get(deployment)
+        return measured_at is not None and time.monotonic() - measured_at > self.latency_ttl
+
+    def _record_latency(self, deployment: str, elapsed: float):
+        with self._lock:
+            previous = self.latencies.get(deployment)
+            # An expired average says nothing about the deployment any more
+            if previous is None or self._expired(deployment):
+                self.latencies[deployment] = elapsed
+            else:
+                self.latencies[deployment] = (
+                    self.latency_smoothing * elapsed
+                    + (1 - self.latency_smoothing) * previous
+                )
+            self.measured_at[deployment] = time.monotonic()
+
+    def create_inspection(self, text) -> Prediction:
+        decision = self.route(text)
+        with self._lock:
+            self.decisions.append(decision)
+
+        start_time = time.perf_counter()
+        try:
+            return self.gpts[decision["deployment"]].create_inspection(text)
+        finally:
+            decision["elapsed"] = time.perf_counter() - start_time
+            self._record_latency(decision["deployment"], decision["elapsed"])
+
+    async def acreate_inspection(self, text) -> Prediction:
+        decision = self.route(text)
+        with self._lock:
+            self.decisions.append(decision)
+
+        start_time = time.perf_counter()
+        try:
+            return await self.gpts[decision["deployment"]].acreate_inspection(text)
+        finally:
+            decision["elapsed"] = time.perf_counter() - start_time
+            self._record_latency(decision["deployment"], decision["elapsed"])
@@ -0,0 +1,174 @@
+import asyncio
+import threading
+import time
+import warnings
+from collections import deque
+
+from pipeline.chunking import estimate_tokens
+
+
+def estimate_request_tokens(messages: list[dict], text: str) -> int:
+    """
+    Tokens counted against the quota for a request: its prompt, plus an
+    answer about as long as the label text, which the inspection repeats.
+    """
+    prompt = sum(estimate_tokens(str(m.get("content", ""))) for m in messages)
+    return prompt + estimate_tokens(text)
+
+
+class RateLimiter:
+    """
+    Admits requests against tokens-per-minute and requests-per-minute budgets,
+    over a sliding window. Requests over budget wait until enough of the
+    window has expired. Sync (threads) and async callers share the budgets.
+    A request larger than the whole token budget is admitted alone.
+    """
+
+    def __init__(
+        self,
+        tokens_per_minute: int | None = None,
+        requests_per_minute: int | None = None,
+        window: float = 60.0,
+        clock=time.monotonic,
+    ):
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.window = window
+        self.clock = clock
+
+        self._admitted = deque()  # (time, tokens) of the requests in the window
+        self._window_tokens = 0
+        self._lock = threading.Lock()
+
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.admitted_requests = 0
+        self.admitted_tokens = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _expire(self, now: float):
+        while self._admitted and self._admitted[0][0] <= now - self.window:
+            _, tokens = self._admitted.popleft()
+            self._window_tokens -= tokens
+
+    def _delay(self, tokens: int, now: float) -> float:
+        # Seconds to wait before the request fits in both budgets
+        self._expire(now)
+        delays = [0.0]
+        if self.requests_per_minute and len(self._admitted) >= self.requests_per_minute:
+            oldest = self._admitted[len(self._admitted) - self.requests_per_minute][0]
+            delays.append(oldest + self.window - now)
+        if self.tokens_per_minute and self._admitted:
+            excess = self._window_tokens + tokens - self.tokens_per_minute
+            for admitted_at, admitted_tokens in self._admitted:
+                if excess <= 0:
+                    break
+                excess -= admitted_tokens
+                delays.append(admitted_at + self.window - now)
+        return max(delays)
+
+    def _try_admit(self, tokens: int) -> float:
+        with self._lock:
+            now = self.clock()
+            delay = self._delay(tokens, now)
+            if delay <= 0:
+                self._admitted.append((now, tokens))
+                self._window_tokens += tokens
+                self.admitted_requests += 1
+                self.admitted_tokens += tokens
+            return delay
+
+    def _enqueue(self):
+        with self._lock:
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def _dequeue(self, waited: float):
+        with self._lock:
+            self.queue_depth -= 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+
+    def acquire(self, tokens: int, sleep=time.sleep) -> float:
+        """Block until the request is admitted. Returns the time waited."""
+        start = self.clock()
+        self._enqueue()
+        try:
+            while (delay := self._try_admit(tokens)) > 0:
+                sleep(delay)
+        finally:
+            waited = self.clock() - start
+            self._dequeue(waited)
+        return waited
+
+    async def aacquire(self, tokens: int) -> float:
+        """Async variant of acquire, yielding to the event loop while waiting."""
+        start = self.clock()
+        self._enqueue()
+        try:
+            while (delay := self._try_admit(tokens)) > 0:
+                await asyncio.sleep(delay)
+        finally:
+            waited = self.clock() - start
+            self._dequeue(waited)
+        return waited
+
+    def metrics(self) -> dict:
+        with self._lock:
+            self._expire(self.clock())
+            return {
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "admitted_requests": self.admitted_requests,
+                "admitted_tokens": self.admitted_tokens,
+                "window_requests": len(self._admitted),
+                "window_tokens": self._window_tokens,
+                "total_wait_seconds": self.total_wait,
+                "max_wait_seconds": self.max_wait,
+                "average_wait_seconds": (
+                    self.total_wait / self.admitted_requests if self.admitted_requests else 0.0
+                ),
+            }
+
+
+_limiters: dict[tuple[str, str], RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(
+    api_endpoint: str,
+    deployment_id: str,
+    tokens_per_minute: int | None = None,
+    requests_per_minute: int | None = None,
+) -> RateLimiter:
+    """
+    The process-wide rate limiter of a deployment, shared by every GPT using
+    it since the quota is per deployment. Deployments of the same name on
+    other endpoints have their own. The budgets are the ones of the first
+    call; other budgets given later are ignored, with a warning.
+    """
+    key = (api_endpoint, deployment_id)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = RateLimiter(tokens_per_minute, requests_per_minute)
+            return limiter
+    for name, budget in (
+        ("tokens_per_minute", tokens_per_minute),
+        ("requests_per_minute", requests_per_minute),
+    ):
+        if budget is not None and budget != getattr(limiter, name):
+            warnings.warn(
+                f"The rate limiter of {deployment_id} at {api_endpoint} already has "
+                f"{name}={getattr(limiter, name)}, ignoring {budget}.",
+                stacklevel=2,
+            )
+    return limiter
+
+
+def scheduler_metrics() -> dict[tuple[str, str], dict]:
+    """Queue and wait metrics of every deployment, by (api_endpoint, deployment_id)."""
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {key: limiter.metrics() for key, limiter in limiters.items()}
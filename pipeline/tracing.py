@@ -0,0 +1,97 @@
+import contextlib
+import json
+import threading
+
+_lock = threading.Lock()
+_tracer_provider = None
+_hide_payloads = False
+
+
+def instrument(
+    endpoint: str,
+    project_name: str = "gpt-fertiscan",
+    sampling_ratio: float = 1.0,
+    batch: bool = True,
+    hide_payloads: bool = False,
+):
+    """
+    Register a Phoenix tracer provider and instrument DSPy, once per process.
+    Later calls return the provider of the first one, whatever their arguments.
+
+    sampling_ratio is the fraction of traces that are recorded and exported.
+    batch exports spans from a background thread instead of on every call.
+    hide_payloads drops prompts, responses and messages from the spans, which
+    are by far their largest attributes.
+    """
+    global _tracer_provider, _hide_payloads
+
+    if not 0.0 <= sampling_ratio <= 1.0:
+        raise ValueError("The sampling ratio must be between 0 and 1.")
+
+    with _lock:
+        if _tracer_provider is not None:
+            return _tracer_provider
+
+        # Tracing dependencies are only loaded when tracing is enabled
+        from openinference.instrumentation import TraceConfig
+        from openinference.instrumentation.dspy import DSPyInstrumentor
+        from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+        from phoenix.otel import register
+
+        tracer_provider = register(
+            project_name=project_name,
+            endpoint=endpoint,  # gRPC endpoint given by Phoenix when starting the server (default is "http://localhost:4317")
+            batch=batch,
+            sampler=ParentBased(TraceIdRatioBased(sampling_ratio)),
+        )
+
+        config = TraceConfig(
+            hide_inputs=hide_payloads,
+            hide_outputs=hide_payloads,
+            hide_input_messages=hide_payloads,
+            hide_output_messages=hide_payloads,
+            hide_input_text=hide_payloads,
+            hide_output_text=hide_payloads,
+        )
+        DSPyInstrumentor().instrument(tracer_provider=tracer_provider, config=config)
+
+        _tracer_provider = tracer_provider
+        _hide_payloads = hide_payloads
+        return tracer_provider
+
+
+@contextlib.contextmanager
+def lm_span(lm, messages: list[dict], kwargs: dict):
+    """
+    Span of an LM request sent without going through dspy.LM.__call__, such
+    as the async ones, with the attributes of the spans of the instrumented
+    calls. Yields a function to call with the outputs of the request.
+    Nothing is recorded while tracing is disabled.
+    """
+    if _tracer_provider is None:
+        yield lambda outputs: None
+        return
+
+    from openinference.semconv.trace import OpenInferenceSpanKindValues, SpanAttributes
+
+    attributes = {
+        SpanAttributes.OPENINFERENCE_SPAN_KIND: OpenInferenceSpanKindValues.LLM.value,
+        SpanAttributes.LLM_MODEL_NAME: lm.model,
+        SpanAttributes.LLM_INVOCATION_PARAMETERS: json.dumps(
+            {k: v for k, v in kwargs.items() if not k.startswith("api_")}
+        ),
+    }
+    if not _hide_payloads:
+        attributes[SpanAttributes.INPUT_VALUE] = json.dumps(messages)
+        attributes[SpanAttributes.INPUT_MIME_TYPE] = "application/json"
+
+    def record(outputs):
+        if not _hide_payloads:
+            span.set_attribute(SpanAttributes.OUTPUT_VALUE, json.dumps(outputs))
+            span.set_attribute(SpanAttributes.OUTPUT_MIME_TYPE, "application/json")
+
+    tracer = _tracer_provider.get_tracer(__name__)
+    with tracer.start_as_current_span(
+        f"{type(lm).__name__}.acall", attributes=attributes
+    ) as span:
+        yield record
@@ -0,0 +1,156 @@
+import threading
+
+
+def _usage_value(usage, name: str) -> int:
+    if isinstance(usage, dict):
+        return usage.get(name) or 0
+    return getattr(usage, name, None) or 0
+
+
+def cached_prompt_tokens(usage) -> int:
+    """
+    Number of prompt tokens read from the prompt cache, from the usage of a
+    completion. Azure OpenAI reports them in prompt_tokens_details.
+    """
+    if isinstance(usage, dict):
+        details = usage.get("prompt_tokens_details")
+    else:
+        details = getattr(usage, "prompt_tokens_details", None)
+    if details is None:
+        return 0
+    return _usage_value(details, "cached_tokens")
+
+
+def attempt_usage(usage, latency: float) -> dict:
+    """
+    Record of one LM request, from the usage reported with its completion.
+    """
+    usage = usage or {}
+    return {
+        "latency": latency,
+        "prompt_tokens": _usage_value(usage, "prompt_tokens"),
+        "completion_tokens": _usage_value(usage, "completion_tokens"),
+        "cached_tokens": cached_prompt_tokens(usage),
+    }
+
+
+class CallUsage:
+    """
+    LM usage of one extraction: one record per underlying LM request, in the
+    order they were made. An extraction is made of one or more calls, e.g.
+    one per chunk; every request of a call after its first one is a retry
+    caused by an answer that failed to parse or validate.
+    """
+
+    def __init__(self, attempts: list[dict], calls: int = 1):
+        self.attempts = attempts
+        self.calls = calls
+
+    @classmethod
+    def combine(cls, usages: list["CallUsage"]) -> "CallUsage":
+        return cls(
+            [attempt for usage in usages for attempt in usage.attempts],
+            sum(usage.calls for usage in usages),
+        )
+
+    @property
+    def requests(self) -> int:
+        return len(self.attempts)
+
+    @property
+    def retries(self) -> int:
+        return max(self.requests - self.calls, 0)
+
+    @property
+    def prompt_tokens(self) -> int:
+        return sum(a["prompt_tokens"] for a in self.attempts)
+
+    @property
+    def completion_tokens(self) -> int:
+        return sum(a["completion_tokens"] for a in self.attempts)
+
+    @property
+    def cached_tokens(self) -> int:
+        return sum(a["cached_tokens"] for a in self.attempts)
+
+    @property
+    def latencies(self) -> list[float]:
+        return [a["latency"] for a in self.attempts]
+
+    @property
+    def salvaged(self) -> dict[str, str]:
+        """Fields salvaged from the answer of the last request, if it was malformed."""
+        return self.attempts[-1].get("salvaged", {}) if self.attempts else {}
+
+    def to_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "latencies": self.latencies,
+        }
+
+    def __repr__(self):
+        return f"CallUsage({self.to_dict()})"
+
+
+class UsageAggregator:
+    """
+    Thread-safe totals of the LM usage of every extraction, per deployment.
+    """
+
+    COUNTERS = (
+        "extractions",
+        "requests",
+        "retries",
+        "prompt_tokens",
+        "completion_tokens",
+        "cached_tokens",
+        "latency_seconds",
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals: dict[str, dict] = {}
+
+    def record(self, deployment_id: str, usage: CallUsage):
+        with self._lock:
+            totals = self._totals.setdefault(
+                deployment_id, dict.fromkeys(self.COUNTERS, 0)
+            )
+            totals["extractions"] += 1
+            totals["requests"] += usage.requests
+            totals["retries"] += usage.retries
+            totals["prompt_tokens"] += usage.prompt_tokens
+            totals["completion_tokens"] += usage.completion_tokens
+            totals["cached_tokens"] += usage.cached_tokens
+            totals["latency_seconds"] += sum(usage.latencies)
+
+    def snapshot(self) -> dict[str, dict]:
+        """Copy of the totals, per deployment."""
+        with self._lock:
+            return {deployment: dict(totals) for deployment, totals in self._totals.items()}
+
+    def reset(self):
+        with self._lock:
+            self._totals.clear()
+
+    def to_prometheus(self) -> str:
+        """
+        Totals in the Prometheus text exposition format, to be served on a
+        metrics endpoint.
+        """
+        lines = []
+        snapshot = self.snapshot()
+        for counter in self.COUNTERS:
+            name = f"fertiscan_llm_{counter}_total"
+            lines.append(f"# TYPE {name} counter")
+            for deployment, totals in sorted(snapshot.items()):
+                lines.append(f'{name}{{deployment="{deployment}"}} {totals[counter]}')
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide usage of every GPT instance
+USAGE = UsageAggregator()
@@ -0,0 +1,66 @@
+import argparse
+import gc
+import time
+
+from pipeline.codec import decode_inspection, encode_inspection
+from pipeline.inspection import FertilizerInspection, validate_inspections
+from scripts.benchmark_inspection_validation import synthetic_corpus
+
+
+def measure(function, items: list, repeat: int) -> tuple[float, list]:
+    """
+    Best time, in seconds, to apply the function to every item, and the
+    outputs. As with timeit, garbage collection is disabled while timing.
+    """
+    best = float("inf")
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            outputs = [function(item) for item in items]
+            best = min(best, time.perf_counter() - start_time)
+    finally:
+        gc.enable()
+    return best, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the serialization of inspections.")
+    parser.add_argument("--size", type=int, default=10_000, help="Number of synthetic inspections.")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    inspections = validate_inspections(synthetic_corpus(args.size))
+
+    codecs = [
+        (
+            "pydantic json, indent=2",
+            lambda i: i.model_dump_json(indent=2).encode(),
+            FertilizerInspection.model_validate_json,
+        ),
+        (
+            "pydantic json",
+            lambda i: i.model_dump_json().encode(),
+            FertilizerInspection.model_validate_json,
+        ),
+        ("codec json", encode_inspection, decode_inspection),
+        (
+            "codec msgpack",
+            lambda i: encode_inspection(i, "msgpack"),
+            lambda d: decode_inspection(d, "msgpack"),
+        ),
+    ]
+
+    print(f"{'codec':<26} {'encode/s':>10} {'decode/s':>10} {'bytes':>8}")
+    for name, encode, decode in codecs:
+        encode_time, encoded = measure(encode, inspections, args.repeat)
+        decode_time, decoded = measure(decode, encoded, args.repeat)
+        assert decoded == inspections, name
+        size = sum(len(data) for data in encoded) / len(encoded)
+        print(
+            f"{name:<26} {args.size / encode_time:>10.0f} {args.size / decode_time:>10.0f} {size:>8.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
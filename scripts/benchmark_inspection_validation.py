@@ -0,0 +1,142 @@
+import argparse
+import json
+import random
+import time
+
+from pipeline.inspection import (
+    FertilizerInspection,
+    validate_inspections,
+    validate_inspections_json,
+    validate_inspections_ndjson,
+)
+
+NUTRIENTS = [
+    ("Total Nitrogen (N)", "Azote total (N)"),
+    ("Available Phosphate (P2O5)", "Phosphate assimilable (P2O5)"),
+    ("Soluble Potash (K2O)", "Potasse soluble (K2O)"),
+    ("Iron (Fe)", "Fer (Fe)"),
+    ("Zinc (Zn)", "Zinc (Zn)"),
+    ("Seaweed extract", "Extrait d'algues"),
+]
+
+PHONE_NUMBERS = [
+    "+1 800 555 0199",
+    "1 (866) 337-2943",
+    "416-555-0123",
+    "(514) 555-0142",
+    "not a phone",
+    None,
+]
+
+
+def synthetic_inspection(rng: random.Random) -> dict:
+    """
+    Raw LLM output for a random but realistic label, with the messy values
+    (units in numbers, phone formats, missing fields) the validators clean.
+    """
+    npk = "-".join(str(rng.randint(0, 30)) for _ in range(3))
+    nutrients = rng.sample(NUTRIENTS, rng.randint(2, len(NUTRIENTS)))
+    values = [f"{rng.uniform(0, 30):.1f}" for _ in nutrients]
+
+    def analysis(language: int, title: str) -> dict:
+        return {
+            "title": title,
+            "nutrients": [
+                {"nutrient": names[language], "value": f"{value} %", "unit": "%"}
+                for names, value in zip(nutrients, values)
+            ],
+        }
+
+    return {
+        "organizations": [
+            {
+                "name": f"Company {rng.randint(1, 500)} Inc.",
+                "address": f"{rng.randint(1, 999)} Main St, Springfield",
+                "website": f"company{rng.randint(1, 500)}.com",
+                "phone_number": rng.choice(PHONE_NUMBERS),
+            }
+            for _ in range(rng.randint(1, 2))
+        ],
+        "fertiliser_name": f"SuperGrow {npk}",
+        "registration_number": [
+            {
+                "identifier": f"{rng.randint(1000000, 9999999)}{rng.choice('ABCX')}",
+                "type": rng.choice(["fertilizer_product", "ingredient_component", None]),
+            }
+        ],
+        "lot_number": f"L{rng.randint(100000, 999999)}",
+        "weight": [
+            {"value": f"{rng.randint(1, 50)} kg", "unit": "kg"},
+            {"value": rng.randint(2, 110), "unit": "lb"},
+        ],
+        "density": {"value": f"{rng.uniform(0.5, 2):.2f} g/cm³", "unit": "g/cm³"},
+        "volume": rng.choice([None, {"value": "20.8", "unit": "L"}]),
+        "npk": rng.choice([npk, f"{npk} NPK", None]),
+        "guaranteed_analysis_en": analysis(0, rng.choice(["Guaranteed minimum analysis", "Guaranteed analysis"])),
+        "guaranteed_analysis_fr": analysis(1, rng.choice(["Analyse minimale garantie", "Analyse garantie"])),
+        "cautions_en": rng.choice([None, ["Keep out of reach of children."]]),
+        "cautions_fr": rng.choice([None, ["Tenir hors de la portée des enfants."]]),
+        "instructions_en": ["Dissolve 50g in 10L of water.", "Apply every 2 weeks."],
+        "instructions_fr": ["Dissoudre 50 g dans 10 L d'eau.", "Appliquer aux 2 semaines."],
+        "ingredients_en": [{"nutrient": "Bone meal", "value": None, "unit": None}],
+        "ingredients_fr": [{"nutrient": "Farine d'os", "value": None, "unit": None}],
+    }
+
+
+def synthetic_corpus(size: int, seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    return [synthetic_inspection(rng) for _ in range(size)]
+
+
+def benchmark(function, corpus: list, repeat: int = 3) -> float:
+    """Best time, in seconds, to run the function over the whole corpus."""
+    best = float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function(corpus)
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+
+def with_invalid_items(corpus: list[dict], every: int = 100) -> list[dict]:
+    """The corpus with one item in every `every` made invalid, as a bad LLM answer."""
+    return [
+        {**raw, "organizations": "not a list"} if i % every == 0 else raw
+        for i, raw in enumerate(corpus)
+    ]
+
+
+def validate_one_by_one(corpus: list[dict]) -> list[FertilizerInspection]:
+    return [FertilizerInspection.model_validate(raw) for raw in corpus]
+
+
+def load_one_by_one(blobs: list[bytes]) -> list[FertilizerInspection]:
+    return [FertilizerInspection.model_validate(json.loads(blob)) for blob in blobs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FertilizerInspection validation.")
+    parser.add_argument("--size", type=int, default=10_000, help="Number of synthetic inspections.")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = synthetic_corpus(args.size)
+    blobs = [json.dumps(raw).encode() for raw in corpus]
+    document = b"[" + b",".join(blobs) + b"]"
+    mixed = with_invalid_items(corpus)
+
+    cases = [
+        ("model_validate", lambda: validate_one_by_one(corpus)),
+        ("validate_inspections", lambda: validate_inspections(corpus)),
+        ("validate_inspections, 1% invalid", lambda: validate_inspections(mixed)),
+        ("json.loads + model_validate", lambda: load_one_by_one(blobs)),
+        ("validate_inspections_json", lambda: validate_inspections_json(document)),
+        ("validate_inspections_ndjson", lambda: list(validate_inspections_ndjson(blobs))),
+    ]
+    for name, function in cases:
+        elapsed = benchmark(lambda _: function(), corpus, args.repeat)
+        print(f"{name}: {elapsed:.3f} s for {args.size} inspections, {elapsed / args.size * 1e6:.1f} µs per inspection")
+
+
+if __name__ == "__main__":
+    main()
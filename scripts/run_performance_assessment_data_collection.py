@@ -1,3 +1,4 @@
+import argparse
 import csv
 import datetime
 import json
@@ -8,7 +9,8 @@ import time
 
 from dotenv import load_dotenv
 
-from pipeline import GPT, OCR, LabelStorage, analyze
+from pipeline import GPT, OCR, LabelStorage, ModelRouter, analyze
+from pipeline.gpt import EXTRACTION_MODES, prompt_cache_usage
 from tests import levenshtein_similarity
 
 ACCURACY_THRESHOLD = 80.0
@@ -89,8 +91,23 @@ def calculate_accuracy(
     return accuracy_results
 
 
+def sum_token_usage(history: list[dict]) -> tuple[int, int]:
+    prompt_tokens = 0
+    completion_tokens = 0
+    for entry in history:
+        usage = entry.get("usage") or {}
+        prompt_tokens += usage.get("prompt_tokens") or 0
+        completion_tokens += usage.get("completion_tokens") or 0
+    return prompt_tokens, completion_tokens
+
+
 def run_test_case(
-    test_case_number: int, image_paths: list[str], expected_json_path: str
+    test_case_number: int,
+    image_paths: list[str],
+    expected_json_path: str,
+    mode: str = "reasoning",
+    route: bool = False,
+    lean_schema: bool = True,
 ) -> dict[str, any]:
     # Copy images to temporary files to prevent deletion due to LabelStorage behavior
     copied_image_paths = []
@@ -107,11 +124,23 @@ def run_test_case(
         storage.add_image(image_path)
 
     ocr = OCR(os.getenv("AZURE_API_ENDPOINT"), os.getenv("AZURE_API_KEY"))
-    gpt = GPT(
-        os.getenv("AZURE_OPENAI_ENDPOINT"),
-        os.getenv("AZURE_OPENAI_KEY"),
-        os.getenv("AZURE_OPENAI_DEPLOYMENT"),
-    )
+    if route:
+        # Every supported deployment is used, the router picks one per label
+        gpt = ModelRouter(
+            os.getenv("AZURE_OPENAI_ENDPOINT"),
+            os.getenv("AZURE_OPENAI_KEY"),
+            default_deployment=os.getenv("AZURE_OPENAI_DEPLOYMENT"),
+            mode=mode,
+            lean_schema=lean_schema,
+        )
+    else:
+        gpt = GPT(
+            os.getenv("AZURE_OPENAI_ENDPOINT"),
+            os.getenv("AZURE_OPENAI_KEY"),
+            os.getenv("AZURE_OPENAI_DEPLOYMENT"),
+            mode=mode,
+            lean_schema=lean_schema,
+        )
 
     # Run performance test
     print("\tRunning analysis for test case...")
@@ -121,6 +150,9 @@ def run_test_case(
     )  # <-- the `analyse` function deletes the images it processes so we don't need to clean up our image copies
     performance = time.time() - start_time
     print(f"\tAnalysis completed in {performance:.2f} seconds.")
+    history = gpt.history if route else gpt.lm.history
+    prompt_tokens, completion_tokens = sum_token_usage(history)
+    cached_tokens = prompt_cache_usage(history)["cached_tokens"]
 
     # Process actual output
     actual_fields = extract_leaf_fields(json.loads(actual_output.model_dump_json()))
@@ -136,13 +168,22 @@ def run_test_case(
     # Return results
     return {
         "test_case_number": test_case_number,
+        "mode": mode,
         "performance": performance,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cached_tokens": cached_tokens,
+        # More than one call per label means that the extraction was retried
+        "lm_calls": len(history),
         "accuracy_results": accuracy_results,
+        "routing": gpt.decisions[-1] if route and gpt.decisions else None,
     }
 
 
-def generate_csv_report(results: list[dict[str, any]]) -> None:
+def generate_csv_report(results: list[dict[str, any]], mode: str | None = None) -> None:
     timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M")
+    if mode:
+        timestamp = f"{timestamp}_{mode}"
     os.makedirs("reports", exist_ok=True)
     report_path = os.path.join("reports", f"test_results_{timestamp}.csv")
 
@@ -155,6 +196,8 @@ def generate_csv_report(results: list[dict[str, any]]) -> None:
                 "Pass/Fail",
                 "Accuracy Score",
                 "Pipeline Speed (seconds)",
+                "Cached Prompt Tokens",
+                "LM Calls",
                 "Expected Value",
                 "Actual Value",
             ]
@@ -171,6 +214,8 @@ def generate_csv_report(results: list[dict[str, any]]) -> None:
                         data["pass_fail"],
                         f"{data['score']:.2f}",
                         f"{performance:.4f}",
+                        result["cached_tokens"],
+                        result["lm_calls"],
                         data["expected_value"],
                         data["actual_value"],
                     ]
@@ -179,7 +224,73 @@ def generate_csv_report(results: list[dict[str, any]]) -> None:
     return report_path
 
 
+def generate_routing_report(results: list[dict[str, any]], mode: str | None = None) -> str:
+    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M")
+    if mode:
+        timestamp = f"{timestamp}_{mode}"
+    os.makedirs("reports", exist_ok=True)
+    report_path = os.path.join("reports", f"routing_{timestamp}.csv")
+
+    with open(report_path, mode="w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(
+            [
+                "Test Case",
+                "Deployment",
+                "Reason",
+                "Tokens",
+                "Complexity",
+                "Estimated Cost (USD)",
+                "LLM Speed (seconds)",
+                "Pass Rate",
+            ]
+        )
+
+        for result in results:
+            decision = result.get("routing")
+            if not decision:
+                continue
+            fields = list(result["accuracy_results"].values())
+            pass_rate = sum(f["pass_fail"] == "Pass" for f in fields) / len(fields) if fields else 0.0
+            writer.writerow(
+                [
+                    result["test_case_number"],
+                    decision["deployment"],
+                    decision["reason"],
+                    decision["tokens"],
+                    decision["complexity"],
+                    f"{decision['estimated_cost']:.6f}",
+                    f"{decision['elapsed'] or 0.0:.4f}",
+                    f"{pass_rate:.2f}",
+                ]
+            )
+    print(f"Routing report generated and saved to: {report_path}")
+    return report_path
+
+
+def parse_args(modes=EXTRACTION_MODES) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run the performance assessment.")
+    parser.add_argument(
+        "--mode",
+        choices=modes,
+        default="reasoning",
+        help="Extraction mode of the LLM: with or without a reasoning step.",
+    )
+    parser.add_argument(
+        "--route",
+        action="store_true",
+        help="Route each label to one of the supported deployments instead of AZURE_OPENAI_DEPLOYMENT.",
+    )
+    parser.add_argument(
+        "--full-schema",
+        action="store_true",
+        help="Send the full JSON schema of the inspection in the prompt instead of its compact rendering.",
+    )
+    return parser.parse_args()
+
+
 def main() -> None:
+    args = parse_args()
     print("Script execution started.")
 
     load_dotenv()
@@ -205,13 +316,17 @@ def main() -> None:
     for idx, (image_paths, expected_json_path) in enumerate(test_cases, 1):
         print(f"Processing test case {idx}...")
         try:
-            result = run_test_case(idx, image_paths, expected_json_path)
+            result = run_test_case(
+                idx, image_paths, expected_json_path, args.mode, args.route, not args.full_schema
+            )
             results.append(result)
         except Exception as e:
             print(f"Error processing test case {idx}: {e}")
             continue  # I'd rather continue processing the other test cases than stop the script for now
 
-    generate_csv_report(results)
+    generate_csv_report(results, args.mode)
+    if args.route:
+        generate_routing_report(results, args.mode)
     print("Script execution completed.")
 
 
@@ -4,6 +4,13 @@ import pandas as pd
 CSV_FILE = "test_results_202410221641.csv"
 CSV_FOLDER = "reports"
 
+# Optional per test case columns of the test case table: aggregated column,
+# name in the report and description
+TEST_CASE_COLUMNS = [
+    ('Cached_Prompt_Tokens', 'Cached Prompt Tokens', 'the prompt tokens of the test case served from the prompt cache.'),
+    ('LM_Calls', 'LM Calls', 'the number of requests sent to the LLM for the test case, more than one when the extraction was retried.'),
+]
+
 
 def load_csv(csv_folder, csv_file):
     csv_file_path = os.path.join(csv_folder, csv_file)
@@ -39,10 +46,16 @@ def calculate_field_stats(df, original_field_order):
     return field_stats
 
 def calculate_test_case_stats(df):
-    test_case_stats = df.groupby('Test Case').agg(
-        Overall_Pass_Rate=('Pass', 'mean'),
-        Average_Accuracy_Score=('Accuracy Score', 'mean')
-    ).reset_index()
+    columns = {
+        'Overall_Pass_Rate': ('Pass', 'mean'),
+        'Average_Accuracy_Score': ('Accuracy Score', 'mean'),
+    }
+    # Reports written before these columns were added don't have them
+    if 'Cached Prompt Tokens' in df.columns:
+        columns['Cached_Prompt_Tokens'] = ('Cached Prompt Tokens', 'first')
+    if 'LM Calls' in df.columns:
+        columns['LM_Calls'] = ('LM Calls', 'first')
+    test_case_stats = df.groupby('Test Case').agg(**columns).reset_index()
     
     return test_case_stats
 
@@ -82,14 +95,22 @@ def generate_markdown_report(field_stats, test_case_stats, total_pass_rate, aver
     markdown_report += "The following table provides an overview of the overall pass rate and average accuracy score for each test case.\n\n"
     markdown_report += "`Overall Pass Rate`: the percentage of fields that passed the accuracy threshold(default is 80%) in the given test case.\n\n"
     markdown_report += "`Average Accuracy Score`: the average accuracy score for all fields in the given test case.\n\n"
-    markdown_report += "| Test Case | Overall Pass Rate | Average Accuracy Score |\n"
-    markdown_report += "|-----------|-------------------|------------------------|\n"
+    extra_columns = [
+        (column, name, description)
+        for column, name, description in TEST_CASE_COLUMNS
+        if column in test_case_stats.columns
+    ]
+    for _, name, description in extra_columns:
+        markdown_report += f"`{name}`: {description}\n\n"
+    markdown_report += "| Test Case | Overall Pass Rate | Average Accuracy Score |" + "".join(f" {name} |" for _, name, _ in extra_columns) + "\n"
+    markdown_report += "|-----------|-------------------|------------------------|" + "".join("-" * (len(name) + 2) + "|" for _, name, _ in extra_columns) + "\n"
     
     for _, row in test_case_stats.iterrows():
         test_case = row['Test Case']
         overall_pass_rate = f"{row['Overall_Pass_Rate']:.2f}"
         avg_accuracy = f"{row['Average_Accuracy_Score']:.2f}"
-        markdown_report += f"| {test_case} | {overall_pass_rate} | {avg_accuracy} |\n"
+        extra_values = "".join(f" {int(row[column])} |" for column, _, _ in extra_columns)
+        markdown_report += f"| {test_case} | {overall_pass_rate} | {avg_accuracy} |{extra_values}\n"
     
     # Overall Pipeline Metrics
     markdown_report += "\n## Overall Pipeline Metrics\n\n"
@@ -103,6 +124,55 @@ def generate_markdown_report(field_stats, test_case_stats, total_pass_rate, aver
     
     return markdown_report
 
+def generate_mode_comparison_report(results):
+    # results are the dictionaries returned by run_test_case, for several modes
+    modes = list(dict.fromkeys(result["mode"] for result in results))
+    by_mode = {mode: [r for r in results if r["mode"] == mode] for mode in modes}
+
+    def mean(values):
+        values = list(values)
+        return sum(values) / len(values) if values else 0.0
+
+    markdown_report = "# Extraction Mode Comparison Report\n\n"
+
+    markdown_report += "## Overall Metrics\n\n"
+    markdown_report += "`Prompt Tokens` and `Completion Tokens`: the average number of tokens sent to and generated by the LLM per test case.\n\n"
+    markdown_report += "`Cached Tokens`: the average number of prompt tokens served from the prompt cache per test case.\n\n"
+    markdown_report += "`LM Calls`: the average number of requests sent to the LLM per test case, above 1 when extractions were retried.\n\n"
+    markdown_report += "| Mode | Test Cases | Average Pipeline Speed (seconds) | Prompt Tokens | Cached Tokens | Completion Tokens | LM Calls | Pass Rate |\n"
+    markdown_report += "|------|------------|----------------------------------|---------------|---------------|-------------------|----------|-----------|\n"
+
+    for mode, mode_results in by_mode.items():
+        fields = [f for r in mode_results for f in r["accuracy_results"].values()]
+        speed = mean(r["performance"] for r in mode_results)
+        prompt_tokens = mean(r["prompt_tokens"] for r in mode_results)
+        cached_tokens = mean(r["cached_tokens"] for r in mode_results)
+        completion_tokens = mean(r["completion_tokens"] for r in mode_results)
+        lm_calls = mean(r["lm_calls"] for r in mode_results)
+        pass_rate = mean(f["pass_fail"] == "Pass" for f in fields)
+        markdown_report += f"| {mode} | {len(mode_results)} | {speed:.2f} | {prompt_tokens:.0f} | {cached_tokens:.0f} | {completion_tokens:.0f} | {lm_calls:.2f} | {pass_rate:.2f} |\n"
+
+    markdown_report += "\n## Field-Level Accuracy\n\n"
+    markdown_report += "The average accuracy score of each field, per mode.\n\n"
+    markdown_report += "| Field Name | " + " | ".join(modes) + " |\n"
+    markdown_report += "|------------|" + "|".join("-" * (len(mode) + 2) for mode in modes) + "|\n"
+
+    field_names = list(dict.fromkeys(
+        name for r in results for name in r["accuracy_results"]
+    ))
+    for field_name in field_names:
+        scores = []
+        for mode_results in by_mode.values():
+            values = [
+                r["accuracy_results"][field_name]["score"]
+                for r in mode_results
+                if field_name in r["accuracy_results"]
+            ]
+            scores.append(f"{mean(values):.2f}" if values else "N/A")
+        markdown_report += f"| {field_name} | " + " | ".join(scores) + " |\n"
+
+    return markdown_report
+
 def save_report(markdown_content, report_file):
     with open(report_file, "w") as f:
         f.write(markdown_content)
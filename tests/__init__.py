@@ -1,3 +1,4 @@
+import json
 import Levenshtein
 import requests
 
@@ -28,3 +29,14 @@ def curl_file(url:str, path: str): # pragma: no cover
     data = requests.get(url).content
     with open(path, 'wb') as handler:
         handler.write(data)
+
+
+def fake_completion(inspection: dict, reasoning: str = "The label was read.") -> str:
+    """
+    Build an LLM answer in the format expected by the ProduceLabelForm signature.
+    """
+    return (
+        f"[[ ## reasoning ## ]]\n{reasoning}\n\n"
+        f"[[ ## inspection ## ]]\n{json.dumps(inspection)}\n\n"
+        "[[ ## completed ## ]]"
+    )
@@ -0,0 +1,295 @@
+"""
+Local stand-in for an Azure OpenAI deployment, used to load test GPT offline.
+
+The server answers chat completions with the expected inspections of
+test_data/labels, formatted like an LLM answer to ProduceLabelForm (a JSON
+object when a response_format is requested). Latency, generation speed,
+server errors and rate limiting can be configured.
+
+Run it with `python -m tests.stub_lm_server --port 8000` and point GPT at it:
+
+    GPT(api_endpoint="http://localhost:8000", api_key="stub", deployment_id="gpt-4o")
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pipeline.chunking import estimate_tokens
+from pipeline.inspection import FertilizerInspection
+from tests import fake_completion
+
+LABELS_FOLDER = "test_data/labels"
+
+
+def to_inspection(expected: dict) -> FertilizerInspection:
+    """
+    Convert an expected_output.json (flat company_*/manufacturer_* keys) into
+    the FertilizerInspection returned by the pipeline.
+    """
+    values = dict(expected)
+    organizations = []
+    for prefix in ("company", "manufacturer"):
+        organization = {
+            key: values.pop(f"{prefix}_{key}", None)
+            for key in ("name", "address", "website", "phone_number")
+        }
+        if any(organization.values()):
+            organizations.append(organization)
+    values["organizations"] = organizations
+
+    registration_number = values.get("registration_number")
+    if isinstance(registration_number, str):
+        values["registration_number"] = [{"identifier": registration_number}]
+
+    for key in ("ingredients_en", "ingredients_fr"):
+        values[key] = [
+            {"nutrient": i.get("nutrient", i.get("ingredient")), **i}
+            for i in values.get(key) or []
+        ]
+
+    return FertilizerInspection.model_validate(values)
+
+
+def load_inspections(labels_folder: str = LABELS_FOLDER) -> list[dict]:
+    """
+    Load the expected inspection of every label, sorted by label folder.
+    """
+    inspections = []
+    for label in sorted(os.listdir(labels_folder)):
+        path = os.path.join(labels_folder, label, "expected_output.json")
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                inspection = to_inspection(json.load(file))
+            inspections.append(inspection.model_dump(mode="json"))
+    return inspections
+
+
+class StubLMServer:
+    """
+    OpenAI-compatible chat completions server running in a background thread.
+
+    latency: seconds waited before answering.
+    tokens_per_second: generation speed, adds completion_tokens / speed seconds.
+    error_rate: fraction of requests answered with a 500.
+    rate_limit_rate: fraction of requests answered with a 429.
+    seed: seed of the error injection, so that runs are reproducible.
+    """
+
+    def __init__(
+        self,
+        inspections: list[dict] | None = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        tokens_per_second: float | None = None,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.inspections = inspections if inspections is not None else load_inspections()
+        if not self.inspections:
+            raise ValueError("The stub LM server needs at least one inspection to serve.")
+
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+
+        self.stats = {"requests": 0, "errors": 0, "rate_limited": 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StubLMServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def pick_inspection(self, prompt: str) -> dict:
+        """
+        The label named in the prompt, or a label chosen from a hash of the
+        prompt, so that the same prompt always gets the same answer.
+        """
+        for inspection in self.inspections:
+            name = inspection.get("fertiliser_name")
+            if name and name in prompt:
+                return inspection
+        digest = hashlib.sha256(prompt.encode()).digest()
+        return self.inspections[int.from_bytes(digest[:8], "big") % len(self.inspections)]
+
+    def _draw_failure(self) -> int | None:
+        with self._lock:
+            self.stats["requests"] += 1
+            draw = self._random.random()
+            if draw < self.rate_limit_rate:
+                self.stats["rate_limited"] += 1
+                return 429
+            if draw < self.rate_limit_rate + self.error_rate:
+                self.stats["errors"] += 1
+                return 500
+        return None
+
+    def _completion(self, messages: list[dict], response_format: dict | None = None) -> str:
+        prompt = "\n".join(str(m.get("content", "")) for m in messages)
+        inspection = self.pick_inspection(prompt)
+        reasoning = "[[ ## reasoning ## ]]" in prompt  # direct mode has no reasoning
+        if response_format:
+            # Structured output: the fields as one JSON object
+            answer = {"reasoning": "The label was read."} if reasoning else {}
+            answer["inspection"] = inspection
+            return json.dumps(answer)
+        completion = fake_completion(inspection)
+        if not reasoning:
+            completion = completion.split("\n\n", 1)[1]
+        return completion
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, body, headers=None):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                if not self.path.split("?")[0].endswith("/chat/completions"):
+                    self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                    return
+
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+
+                failure = server._draw_failure()
+                if failure == 429:
+                    self._send_json(
+                        429,
+                        {"error": {"code": "429", "message": "Rate limit is exceeded."}},
+                        {"Retry-After": "0"},
+                    )
+                    return
+                if failure == 500:
+                    self._send_json(500, {"error": {"message": "Injected server error."}})
+                    return
+
+                messages = request.get("messages", [])
+                completion = server._completion(messages, request.get("response_format"))
+                usage = {
+                    "prompt_tokens": sum(estimate_tokens(str(m.get("content", ""))) for m in messages),
+                    "completion_tokens": estimate_tokens(completion),
+                }
+                usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+                delay = server.latency
+                if server.tokens_per_second:
+                    delay += usage["completion_tokens"] / server.tokens_per_second
+                time.sleep(delay)
+
+                response = {
+                    "id": f"chatcmpl-stub-{hashlib.sha256(completion.encode()).hexdigest()[:12]}",
+                    "created": int(time.time()),
+                    "model": request.get("model", "stub"),
+                    "usage": usage,
+                }
+                if request.get("stream"):
+                    self._stream(response, completion)
+                    return
+
+                response["object"] = "chat.completion"
+                response["choices"] = [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": completion},
+                    }
+                ]
+                self._send_json(200, response)
+
+            def _stream(self, response, completion):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                pieces = [completion[i : i + 64] for i in range(0, len(completion), 64)]
+                for i, piece in enumerate(pieces):
+                    last = i == len(pieces) - 1
+                    chunk = {
+                        "id": response["id"],
+                        "object": "chat.completion.chunk",
+                        "created": response["created"],
+                        "model": response["model"],
+                        "choices": [
+                            {
+                                "index": 0,
+                                "delta": {"role": "assistant", "content": piece},
+                                "finish_reason": "stop" if last else None,
+                            }
+                        ],
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.write(b"data: [DONE]\n\n")
+
+        return Handler
+
+
+def main():  # pragma: no cover
+    parser = argparse.ArgumentParser(description="Serve the expected inspections as an LLM.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--tokens-per-second", type=float, default=None)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = StubLMServer(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=args.seed,
+    )
+    print(f"Stub LM server listening on {server.url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        server._server.server_close()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,164 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import dspy
+
+from pipeline import analyze_document
+from pipeline.artifacts import ArtifactBuffer, DirectorySink
+from pipeline.inspection import FertilizerInspection
+
+
+class FakeOCR:
+    def extract_text(self, document):
+        return SimpleNamespace(content="# SuperGrow 20-20-20")
+
+
+class FakeGPT:
+    def __init__(self, error=None):
+        self.error = error
+
+    def create_inspection(self, text):
+        if self.error:
+            raise self.error
+        return dspy.Prediction(
+            reasoning="Read.", inspection=FertilizerInspection(npk="20-20-20")
+        )
+
+
+class TestArtifactBuffer(unittest.TestCase):
+    def test_ring(self):
+        buffer = ArtifactBuffer(maxlen=2)
+
+        for run_id in ["a", "b", "c"]:
+            buffer.record(run_id, "md", run_id)
+
+        self.assertEqual(len(buffer), 2)
+        self.assertEqual(buffer.get("a"), {})
+        self.assertEqual(buffer.get("c"), {"md": "c"})
+
+    def test_lazy_content(self):
+        buffer = ArtifactBuffer()
+        rendered = []
+
+        buffer.record("a", "json", lambda: rendered.append(1) or "{}")
+
+        self.assertEqual(rendered, [])
+        self.assertEqual(buffer.get("a"), {"json": "{}"})
+
+    def test_flush_only_on_error(self):
+        flushed = []
+        buffer = ArtifactBuffer(sink=lambda run_id, artifacts: flushed.append((run_id, artifacts)))
+
+        with buffer.recording("a") as record:
+            record("md", "text")
+        with self.assertRaises(RuntimeError):
+            with buffer.recording("b") as record:
+                record("md", "other text")
+                raise RuntimeError()
+
+        self.assertEqual(flushed, [("b", {"md": "other text"})])
+        self.assertEqual(buffer.get("b"), {})
+
+    def test_async_sink(self):
+        flushed = []
+
+        async def sink(run_id, artifacts):
+            flushed.append(run_id)
+
+        buffer = ArtifactBuffer(sink=sink)
+        buffer.record("a", "md", "text")
+        buffer.flush("a")
+        buffer.record("b", "md", "text")
+        asyncio.run(buffer.aflush("b"))
+
+        self.assertEqual(flushed, ["a", "b"])
+
+    def test_cancelled_runs_are_evicted(self):
+        buffer = ArtifactBuffer(maxlen=2)
+
+        async def run(run_id):
+            async with buffer.arecording(run_id) as record:
+                record("md", run_id)
+                await asyncio.sleep(10)
+
+        async def cancel_all():
+            tasks = [asyncio.create_task(run(str(i))) for i in range(50)]
+            await asyncio.sleep(0.01)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run(cancel_all())
+
+        self.assertEqual(buffer._active, set())
+        self.assertEqual(len(buffer), 2)
+
+    def test_interrupted_run_is_not_active(self):
+        buffer = ArtifactBuffer(maxlen=1)
+
+        with self.assertRaises(KeyboardInterrupt):
+            with buffer.recording("a") as record:
+                record("md", "text")
+                raise KeyboardInterrupt()
+        buffer.record("b", "md", "text")
+
+        self.assertEqual(buffer._active, set())
+        self.assertEqual(buffer.get("a"), {})
+
+
+class TestAnalyzeArtifacts(unittest.TestCase):
+    def setUp(self):
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.log_dir_path = os.path.join(self.log_dir.name, "logs")
+
+    def tearDown(self):
+        self.log_dir.cleanup()
+
+    def test_no_disk_io_on_success(self):
+        artifacts = ArtifactBuffer()
+
+        inspection = analyze_document(
+            b"document", FakeOCR(), FakeGPT(), self.log_dir_path, artifacts
+        )
+
+        self.assertEqual(inspection.npk, "20-20-20")
+        self.assertFalse(os.path.exists(self.log_dir_path))
+        self.assertEqual(len(artifacts), 1)
+
+    def test_logs_written_on_error(self):
+        with self.assertRaises(ValueError):
+            analyze_document(
+                b"document",
+                FakeOCR(),
+                FakeGPT(ValueError("LLM failed")),
+                self.log_dir_path,
+                ArtifactBuffer(),
+            )
+
+        files = os.listdir(self.log_dir_path)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].endswith(".md"))
+
+    def test_sink_of_the_buffer(self):
+        flushed = []
+        artifacts = ArtifactBuffer(sink=lambda run_id, a: flushed.append(a))
+
+        with self.assertRaises(ValueError):
+            analyze_document(
+                b"document", FakeOCR(), FakeGPT(ValueError()), self.log_dir_path, artifacts
+            )
+
+        self.assertEqual(flushed, [{"md": "# SuperGrow 20-20-20"}])
+        self.assertFalse(os.path.exists(self.log_dir_path))
+
+    def test_directory_sink(self):
+        DirectorySink(self.log_dir_path)("run", {"md": "text", "json": "{}"})
+
+        self.assertEqual(sorted(os.listdir(self.log_dir_path)), ["run.json", "run.md"])
+
+
+if __name__ == "__main__":
+    unittest.main()
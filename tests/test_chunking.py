@@ -0,0 +1,53 @@
+import unittest
+
+from pipeline.chunking import estimate_tokens, split_sections, split_text
+
+
+class TestChunking(unittest.TestCase):
+    def setUp(self):
+        self.sections = [
+            "# GreenGrow 20-20-20\nRegistration Number 2018007A",
+            "## Guaranteed analysis\nTotal Nitrogen (N) 20%\nSoluble Potash (K2O) 20%",
+            "## Cautions\nKeep out of reach of children.",
+            "## Analyse garantie\nAzote total (N) 20%\nPotasse soluble (K2O) 20%",
+        ]
+        self.text = "\n\n".join(self.sections)
+
+    def test_estimate_tokens(self):
+        self.assertEqual(estimate_tokens(""), 0)
+        self.assertEqual(estimate_tokens("a" * 400), 101)
+
+    def test_split_sections(self):
+        self.assertEqual(split_sections(self.text), self.sections)
+
+    def test_split_sections_on_headings(self):
+        text = "# Title\nline\n## Section\nother line"
+        self.assertEqual(split_sections(text), ["# Title\nline", "## Section\nother line"])
+
+    def test_short_text_is_not_split(self):
+        self.assertEqual(split_text(self.text, max_tokens=1000), [self.text])
+
+    def test_split_text_respects_budget(self):
+        chunks = split_text(self.text, max_tokens=30)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(estimate_tokens(chunk), 30)
+        # Sections are never cut when they fit in the budget
+        self.assertEqual("\n\n".join(chunks), self.text)
+
+    def test_split_oversized_section(self):
+        text = "\n".join(f"Ingredient {i} 5%" for i in range(50))
+        chunks = split_text(text, max_tokens=20)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(estimate_tokens(chunk), 20)
+
+    def test_split_single_long_line(self):
+        chunks = split_text("x" * 1000, max_tokens=50)
+        self.assertEqual("".join(chunks), "x" * 1000)
+        for chunk in chunks:
+            self.assertLessEqual(estimate_tokens(chunk), 50)
+
+
+if __name__ == "__main__":
+    unittest.main()
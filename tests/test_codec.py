@@ -0,0 +1,122 @@
+import json
+import unittest
+
+from pipeline.codec import FORMATS, SCHEMA_VERSION, decode_inspection, encode_inspection
+from pipeline.inspection import FertilizerInspection, GuaranteedAnalysis
+
+INSPECTION = FertilizerInspection.model_validate(
+    {
+        "organizations": [{"name": "GreenGrow Inc.", "phone_number": "(757) 321-4567"}],
+        "fertiliser_name": "SuperGrow 20-20-20",
+        "registration_number": [{"identifier": "2018007A", "type": "fertilizer_product"}],
+        "weight": [{"value": "25 kg", "unit": "kg"}],
+        "density": {"value": 1.2, "unit": None},
+        "npk": "20-20-20",
+        "guaranteed_analysis_en": {
+            "title": "Guaranteed minimum analysis",
+            "nutrients": [{"nutrient": "Total Nitrogen (N)", "value": "20 %", "unit": "%"}],
+        },
+        "cautions_en": ["Keep out of reach of children."],
+        "instructions_fr": ["Dissoudre dans l'eau."],
+    }
+)
+
+
+class TestCodec(unittest.TestCase):
+    def test_round_trip(self):
+        data = encode_inspection(INSPECTION)
+
+        self.assertEqual(decode_inspection(data), INSPECTION)
+
+    def test_nested_models(self):
+        decoded = decode_inspection(encode_inspection(INSPECTION))
+
+        self.assertIsInstance(decoded.guaranteed_analysis_en, GuaranteedAnalysis)
+        self.assertIsNone(decoded.volume)
+        self.assertEqual(decoded.model_dump_json(), INSPECTION.model_dump_json())
+
+    def test_fields_set(self):
+        inspection = FertilizerInspection(lot_number="L1", npk=None, density={"value": 1.2, "unit": None})
+
+        for format in FORMATS:
+            with self.subTest(format=format):
+                decoded = decode_inspection(encode_inspection(inspection, format), format)
+
+                self.assertEqual(decoded.model_fields_set, {"lot_number", "npk", "density"})
+                self.assertEqual(decoded.density.model_fields_set, {"value", "unit"})
+                self.assertEqual(
+                    decoded.model_dump(exclude_unset=True),
+                    inspection.model_dump(exclude_unset=True),
+                )
+
+    def test_empty_inspection(self):
+        data = encode_inspection(FertilizerInspection())
+
+        self.assertEqual(decode_inspection(data), FertilizerInspection())
+        self.assertEqual(decode_inspection(data).model_fields_set, set())
+
+    def test_unset_fields_are_left_out(self):
+        self.assertLess(
+            len(encode_inspection(INSPECTION)), len(INSPECTION.model_dump_json())
+        )
+
+    def test_data_is_validated(self):
+        envelope = json.loads(encode_inspection(INSPECTION))
+        envelope[1]["npk"] = "not an npk"
+
+        decoded = decode_inspection(json.dumps(envelope).encode())
+
+        self.assertIsNone(decoded.npk)
+
+    def test_other_schema_version(self):
+        envelope = json.loads(encode_inspection(INSPECTION))
+        envelope[0] = SCHEMA_VERSION + 1
+
+        with self.assertRaises(ValueError):
+            decode_inspection(json.dumps(envelope).encode())
+        with self.assertRaises(ValueError):
+            decode_inspection(b'{"npk": "20-20-20"}')
+
+    def test_envelope_with_spaces(self):
+        data = json.dumps(json.loads(encode_inspection(INSPECTION)), indent=1).encode()
+
+        self.assertEqual(decode_inspection(data), INSPECTION)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            encode_inspection(INSPECTION, format="xml")
+
+    def test_layout_matches_schema_version(self):
+        # Changing these fields changes the encoded layout: bump SCHEMA_VERSION
+        # and update this list
+        self.assertEqual(SCHEMA_VERSION, 2)
+        self.assertEqual(
+            list(FertilizerInspection.model_fields),
+            [
+                "organizations",
+                "fertiliser_name",
+                "registration_number",
+                "lot_number",
+                "weight",
+                "density",
+                "volume",
+                "npk",
+                "guaranteed_analysis_en",
+                "guaranteed_analysis_fr",
+                "cautions_en",
+                "cautions_fr",
+                "instructions_en",
+                "instructions_fr",
+                "ingredients_en",
+                "ingredients_fr",
+            ],
+        )
+
+    def test_msgpack_round_trip(self):
+        data = encode_inspection(INSPECTION, format="msgpack")
+
+        self.assertEqual(decode_inspection(data, format="msgpack"), INSPECTION)
+
+
+if __name__ == "__main__":
+    unittest.main()
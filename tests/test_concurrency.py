@@ -0,0 +1,363 @@
+import asyncio
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from types import SimpleNamespace
+
+import dspy
+from PIL import Image
+
+from pipeline import analyze, analyze_async, analyze_document, analyze_document_async
+from pipeline.artifacts import ArtifactBuffer
+from pipeline.gpt import GPT
+from pipeline.inspection import FertilizerInspection
+from pipeline.label import LabelStorage
+from tests.stub_lm_server import StubLMServer, load_inspections
+
+ANALYSES = 300
+
+
+def pause():
+    # Lets the other threads run in the middle of a stage
+    time.sleep(random.random() / 1000)
+
+
+class EchoOCR:
+    """Local OCR stand-in: the text of a document is the document."""
+
+    def extract_text(self, document):
+        pause()
+        return SimpleNamespace(content=document.decode())
+
+
+class EchoGPT:
+    """Local LLM stand-in: the name of the fertiliser is the text, and every
+    text ending in 0 fails."""
+
+    def create_inspection(self, text):
+        pause()
+        if text.endswith("0"):
+            raise RuntimeError(text)
+        return dspy.Prediction(
+            reasoning=text, inspection=FertilizerInspection(fertiliser_name=text)
+        )
+
+
+class AsyncEchoOCR:
+    """EchoOCR with an async API, tracking the analyses in flight."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def extract_text_async(self, document):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(random.random() / 100)
+        self.in_flight -= 1
+        return SimpleNamespace(content=document.decode())
+
+
+class AsyncEchoGPT(EchoGPT):
+    async def acreate_inspection(self, text):
+        await asyncio.sleep(random.random() / 100)
+        return self.create_inspection(text)
+
+
+class CountingStorage(LabelStorage):
+    """The document is the number of images it was built from."""
+
+    def get_document(self, format="pdf", images=None):
+        pause()
+        return str(len(images)).encode()
+
+
+def png() -> bytes:
+    output = BytesIO()
+    Image.new("RGB", (1, 1)).save(output, format="PNG")
+    return output.getvalue()
+
+
+class TestConcurrentAnalyze(unittest.TestCase):
+    def setUp(self):
+        self.log_dir = tempfile.TemporaryDirectory()
+        # Fewer runs than the concurrent analyses, none may be lost
+        self.artifacts = ArtifactBuffer(maxlen=8)
+
+    def tearDown(self):
+        self.log_dir.cleanup()
+
+    def analyze_document(self, i: int):
+        try:
+            inspection = analyze_document(
+                f"label {i}".encode(),
+                EchoOCR(),
+                EchoGPT(),
+                self.log_dir.name,
+                self.artifacts,
+            )
+        except RuntimeError as error:
+            return error
+        return inspection.fertiliser_name
+
+    def check_results(self, results: list):
+        for i, result in enumerate(results):
+            if i % 10 == 0:
+                self.assertIsInstance(result, RuntimeError)
+            else:
+                self.assertEqual(result, f"label {i}")
+
+        # One log per failed analysis, none overwritten
+        logs = set()
+        for name in os.listdir(self.log_dir.name):
+            with open(os.path.join(self.log_dir.name, name)) as file:
+                logs.add(file.read())
+        self.assertEqual(logs, {f"label {i}" for i in range(0, ANALYSES, 10)})
+        self.assertEqual(len(os.listdir(self.log_dir.name)), ANALYSES // 10)
+
+    def test_threads(self):
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            results = list(executor.map(self.analyze_document, range(ANALYSES)))
+
+        self.check_results(results)
+
+    def test_asyncio_tasks(self):
+        async def run():
+            return await asyncio.gather(
+                *(asyncio.to_thread(self.analyze_document, i) for i in range(ANALYSES))
+            )
+
+        self.check_results(asyncio.run(run()))
+
+    def test_shared_storage(self):
+        storage = CountingStorage()
+        analyzed = []
+        lock = threading.Lock()
+        image = png()
+
+        class CountingGPT:
+            def create_inspection(self, text):
+                pause()
+                with lock:
+                    analyzed.append(int(text))
+                return dspy.Prediction(inspection=FertilizerInspection())
+
+        def add_and_analyze(i):
+            storage.add_image(image)
+            try:
+                analyze(storage, EchoOCR(), CountingGPT(), self.log_dir.name, self.artifacts)
+            except ValueError:
+                # Every image was taken by other analyses
+                pass
+
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            list(executor.map(add_and_analyze, range(ANALYSES)))
+
+        # Every image is analyzed exactly once, or still waiting in the storage
+        self.assertEqual(sum(analyzed) + len(storage.images), ANALYSES)
+        self.assertEqual(os.listdir(self.log_dir.name), [])
+
+    def test_failed_analysis_restores_images(self):
+        storage = CountingStorage()
+        # The document of ten images reads "10", which EchoGPT rejects
+        for _ in range(10):
+            storage.add_image(png())
+
+        with self.assertRaises(RuntimeError):
+            analyze(storage, EchoOCR(), EchoGPT(), self.log_dir.name, self.artifacts)
+
+        self.assertEqual(len(storage.images), 10)
+
+
+class TestAnalyzeAsync(TestConcurrentAnalyze):
+    def analyze_document(self, i: int):
+        # Blocking OCRs and LLMs are run in threads
+        return asyncio.run(self.analyze_document_async(i, EchoOCR(), EchoGPT()))
+
+    async def analyze_document_async(self, i: int, ocr, gpt):
+        try:
+            inspection = await analyze_document_async(
+                f"label {i}".encode(), ocr, gpt, self.log_dir.name, self.artifacts
+            )
+        except RuntimeError as error:
+            return error
+        return inspection.fertiliser_name
+
+    def test_one_event_loop(self):
+        ocr = AsyncEchoOCR()
+
+        async def run():
+            return await asyncio.gather(
+                *(
+                    self.analyze_document_async(i, ocr, AsyncEchoGPT())
+                    for i in range(ANALYSES)
+                )
+            )
+
+        self.check_results(asyncio.run(run()))
+        self.assertGreater(ocr.max_in_flight, ANALYSES / 2)
+
+    def test_shared_storage(self):
+        storage = CountingStorage()
+        analyzed = []
+        image = png()
+
+        class CountingGPT:
+            async def acreate_inspection(self, text):
+                await asyncio.sleep(random.random() / 100)
+                analyzed.append(int(text))
+                return dspy.Prediction(inspection=FertilizerInspection())
+
+        async def add_and_analyze():
+            storage.add_image(image)
+            try:
+                await analyze_async(
+                    storage, AsyncEchoOCR(), CountingGPT(), self.log_dir.name, self.artifacts
+                )
+            except ValueError:
+                # Every image was taken by other analyses
+                pass
+
+        async def run():
+            await asyncio.gather(*(add_and_analyze() for _ in range(ANALYSES)))
+
+        asyncio.run(run())
+
+        self.assertEqual(sum(analyzed) + len(storage.images), ANALYSES)
+        self.assertEqual(os.listdir(self.log_dir.name), [])
+
+    def test_failed_analysis_restores_images(self):
+        storage = CountingStorage()
+        for _ in range(10):
+            storage.add_image(png())
+
+        with self.assertRaises(RuntimeError):
+            asyncio.run(
+                analyze_async(storage, AsyncEchoOCR(), AsyncEchoGPT(), self.log_dir.name, self.artifacts)
+            )
+
+        self.assertEqual(len(storage.images), 10)
+        self.assertEqual(len(os.listdir(self.log_dir.name)), 1)
+
+    def test_cancelled_analysis_restores_images(self):
+        storage = CountingStorage()
+        for _ in range(3):
+            storage.add_image(png())
+
+        class SlowGPT:
+            async def acreate_inspection(self, text):
+                await asyncio.sleep(10)
+
+        async def run():
+            task = asyncio.create_task(
+                analyze_async(storage, AsyncEchoOCR(), SlowGPT(), self.log_dir.name, self.artifacts)
+            )
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(run())
+
+        self.assertEqual(len(storage.images), 3)
+        self.assertEqual(self.artifacts._active, set())
+
+    def test_analyze_async(self):
+        storage = CountingStorage()
+        for _ in range(3):
+            storage.add_image(png())
+
+        inspection = asyncio.run(
+            analyze_async(storage, AsyncEchoOCR(), AsyncEchoGPT(), self.log_dir.name, self.artifacts)
+        )
+
+        self.assertEqual(inspection.fertiliser_name, "3")
+        self.assertEqual(storage.images, [])
+
+
+class TestConcurrentGPT(unittest.TestCase):
+    """A real GPT, shared by every analysis, against the stub LM server."""
+
+    ANALYSES = 48
+
+    def setUp(self):
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.artifacts = ArtifactBuffer(maxlen=8)
+        # Labels whose name is in no other name, so each prompt picks its own
+        names = [i["fertiliser_name"] for i in load_inspections() if i["fertiliser_name"]]
+        self.inspections = [
+            {"fertiliser_name": name}
+            for name in names
+            if not any(name in other for other in names if other != name)
+        ]
+        self.server = StubLMServer(self.inspections, latency=0.01).start()
+        self.gpt = GPT(
+            api_endpoint=self.server.url,
+            api_key="stub",
+            deployment_id="gpt-4o",
+            max_concurrency=4,
+        )
+
+    def tearDown(self):
+        self.server.stop()
+        self.log_dir.cleanup()
+
+    def label(self, i: int) -> bytes:
+        name = self.inspections[i % len(self.inspections)]["fertiliser_name"]
+        return f"label {i}: {name}".encode()
+
+    def check_results(self, results: list):
+        for i, inspection in enumerate(results):
+            self.assertEqual(
+                inspection.fertiliser_name,
+                self.inspections[i % len(self.inspections)]["fertiliser_name"],
+            )
+        self.assertEqual(self.server.stats["requests"], self.ANALYSES)
+        self.assertEqual(os.listdir(self.log_dir.name), [])
+
+    def analyze_document(self, i: int):
+        return analyze_document(
+            self.label(i), EchoOCR(), self.gpt, self.log_dir.name, self.artifacts
+        )
+
+    def test_threads(self):
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(self.analyze_document, range(self.ANALYSES)))
+
+        self.check_results(results)
+
+    def test_asyncio_tasks(self):
+        async def run():
+            return await asyncio.gather(
+                *(
+                    analyze_document_async(
+                        self.label(i), AsyncEchoOCR(), self.gpt, self.log_dir.name, self.artifacts
+                    )
+                    for i in range(self.ANALYSES)
+                )
+            )
+
+        self.check_results(asyncio.run(run()))
+
+    def test_event_loops_in_threads(self):
+        # Each thread runs its own event loop on the same GPT
+        def analyze_document(i):
+            return asyncio.run(
+                analyze_document_async(
+                    self.label(i), AsyncEchoOCR(), self.gpt, self.log_dir.name, self.artifacts
+                )
+            )
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(analyze_document, range(self.ANALYSES)))
+
+        self.check_results(results)
+
+
+if __name__ == "__main__":
+    unittest.main()
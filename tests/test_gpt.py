@@ -1,13 +1,37 @@
+import asyncio
 import json
 import os
+import tempfile
+import typing
 import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
 
 from dotenv import load_dotenv
-from pydantic import ValidationError
+import dspy
+from dspy.utils import DummyLM
+from pydantic import BaseModel, ValidationError
 
-from pipeline.gpt import GPT
-from pipeline.inspection import FertilizerInspection
-from tests import levenshtein_similarity
+from pipeline.gpt import (
+    GPT,
+    INSPECTION_SECTIONS,
+    JSONAdapter,
+    ProduceLabelForm,
+    lean_schema,
+    prompt_cache_usage,
+    structured_output_format,
+)
+from pipeline.chunking import estimate_tokens
+from pipeline.inspection import FertilizerInspection, NutrientValue
+from pipeline.label import LabelStorage
+from pipeline.ocr import OCR
+from pipeline.usage import USAGE
+from scripts.run_performance_assessment_data_collection import (
+    calculate_accuracy,
+    extract_leaf_fields,
+    find_test_cases,
+)
+from tests import fake_completion, levenshtein_similarity
 
 
 class TestLanguageModel(unittest.TestCase):
@@ -129,6 +153,925 @@ class TestLanguageModel(unittest.TestCase):
 
         self.check_json(inspection.model_dump())
 
+    def test_lean_schema_does_not_regress(self):
+        # Mean accuracy of the fields, from 0 to 100, over the labels of test_data
+        ocr = OCR(os.getenv("AZURE_API_ENDPOINT"), os.getenv("AZURE_API_KEY"))
+        full = GPT(
+            api_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=os.getenv("AZURE_OPENAI_KEY"),
+            deployment_id=os.getenv("AZURE_OPENAI_DEPLOYMENT"),
+            lean_schema=False,
+        )
+
+        scores = {self.gpt: [], full: []}
+        for image_paths, expected_json_path in find_test_cases("test_data/labels"):
+            storage = LabelStorage()
+            for image_path in image_paths:
+                with open(image_path, "rb") as file:
+                    storage.add_image(file.read())
+            text = ocr.extract_text(storage.get_document()).content
+            with open(expected_json_path) as file:
+                expected_fields = extract_leaf_fields(json.load(file))
+
+            for gpt, gpt_scores in scores.items():
+                inspection = gpt.create_inspection(text).inspection
+                actual_fields = extract_leaf_fields(json.loads(inspection.model_dump_json()))
+                accuracy = calculate_accuracy(expected_fields, actual_fields)
+                gpt_scores += [result["score"] for result in accuracy.values()]
+
+        lean_score, full_score = (sum(s) / len(s) for s in scores.values())
+        # At most two points lower
+        self.assertGreaterEqual(lean_score, full_score - 2)
+
+
+def fake_response(content, usage=None):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+        usage=usage,
+    )
+
+
+def fake_stream(content, size=7):
+    return [
+        SimpleNamespace(
+            choices=[SimpleNamespace(delta=SimpleNamespace(content=content[i : i + size]))]
+        )
+        for i in range(0, len(content), size)
+    ]
+
+
+class TestAsyncCreateInspection(unittest.TestCase):
+    def setUp(self):
+        self.gpt = GPT(
+            api_endpoint="http://localhost",
+            api_key="key",
+            deployment_id="gpt-4o",
+            max_concurrency=2,
+        )
+        self.inspection = {"fertiliser_name": "SuperGrow", "npk": "20-20-20"}
+
+    def test_acreate_inspection(self):
+        async def acompletion(**kwargs):
+            return fake_response(fake_completion(self.inspection))
+
+        with patch("pipeline.gpt.litellm.acompletion", side_effect=acompletion):
+            prediction = asyncio.run(self.gpt.acreate_inspection("label text"))
+
+        self.assertIsInstance(prediction.inspection, FertilizerInspection)
+        self.assertEqual(prediction.inspection.npk, "20-20-20")
+        self.assertEqual(prediction.reasoning, "The label was read.")
+
+    def test_acreate_inspection_history(self):
+        usage = {"prompt_tokens": 2000, "completion_tokens": 300}
+
+        async def acompletion(**kwargs):
+            return fake_response(fake_completion(self.inspection), usage)
+
+        with patch(
+            "pipeline.gpt.litellm.acompletion", side_effect=acompletion
+        ) as mock_acompletion:
+            asyncio.run(self.gpt.acreate_inspection("label text"))
+
+        # Recorded and cached as the requests made through the LM
+        self.assertEqual(len(self.gpt.lm.history), 1)
+        entry = self.gpt.lm.history[0]
+        self.assertEqual(entry["messages"], mock_acompletion.call_args.kwargs["messages"])
+        self.assertEqual(entry["outputs"], [fake_completion(self.inspection)])
+        self.assertEqual(entry["usage"], usage)
+        self.assertNotIn("api_key", entry["kwargs"])
+        self.assertEqual(
+            mock_acompletion.call_args.kwargs["cache"], {"no-cache": False, "no-store": False}
+        )
+        self.assertEqual(self.gpt.prompt_cache_report()["prompt_tokens"], 2000)
+
+    def test_acreate_inspection_retries_invalid_output(self):
+        responses = iter(
+            ["[[ ## reasoning ## ]]\nNo JSON", fake_completion(self.inspection)]
+        )
+
+        async def acompletion(**kwargs):
+            return fake_response(next(responses))
+
+        with patch(
+            "pipeline.gpt.litellm.acompletion", side_effect=acompletion
+        ) as mock_acompletion:
+            prediction = asyncio.run(self.gpt.acreate_inspection("label text"))
+
+        self.assertEqual(mock_acompletion.call_count, 2)
+        self.assertEqual(prediction.inspection.fertiliser_name, "SuperGrow")
+
+    def test_acreate_inspection_concurrency_limit(self):
+        in_flight = 0
+        max_in_flight = 0
+
+        async def acompletion(**kwargs):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return fake_response(fake_completion(self.inspection))
+
+        async def run():
+            return await asyncio.gather(
+                *(self.gpt.acreate_inspection("label text") for _ in range(8))
+            )
+
+        with patch("pipeline.gpt.litellm.acompletion", side_effect=acompletion):
+            predictions = asyncio.run(run())
+
+        self.assertEqual(len(predictions), 8)
+        self.assertEqual(max_in_flight, 2)
+
+    def test_acreate_inspection_in_consecutive_event_loops(self):
+        in_flight = 0
+        max_in_flight = 0
+
+        async def acompletion(**kwargs):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return fake_response(fake_completion(self.inspection))
+
+        async def run():
+            return await asyncio.gather(
+                *(self.gpt.acreate_inspection("label text") for _ in range(8))
+            )
+
+        with patch("pipeline.gpt.litellm.acompletion", side_effect=acompletion):
+            # Requests wait on the semaphore in both loops
+            for _ in range(2):
+                predictions = asyncio.run(run())
+                self.assertEqual(len(predictions), 8)
+
+        self.assertEqual(max_in_flight, 2)
+
+    def test_acreate_inspection_cancellation(self):
+        async def acompletion(**kwargs):
+            await asyncio.sleep(10)
+
+        async def run():
+            task = asyncio.create_task(self.gpt.acreate_inspection("label text"))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            # The slot taken by the cancelled request must be released.
+            self.assertFalse(self.gpt.semaphore.locked())
+            self.assertEqual(self.gpt.semaphore._value, 2)
+
+        with patch("pipeline.gpt.litellm.acompletion", side_effect=acompletion):
+            asyncio.run(run())
+
+
+class TestCreateInspections(unittest.TestCase):
+    def setUp(self):
+        self.gpt = GPT(
+            api_endpoint="http://localhost",
+            api_key="key",
+            deployment_id="gpt-4o",
+        )
+        self.gpt.lm = DummyLM(
+            {
+                f"label {i}": {
+                    "reasoning": "The label was read.",
+                    "inspection": json.dumps({"lot_number": f"LOT{i}"}),
+                }
+                for i in range(10)
+            }
+        )
+
+    def test_create_inspections_keeps_order(self):
+        texts = [f"label {i}" for i in range(10)]
+        batch = self.gpt.create_inspections(texts, max_workers=4)
+
+        self.assertEqual(len(batch.results), 10)
+        self.assertEqual(batch.errors, {})
+        self.assertEqual(
+            [p.inspection.lot_number for p in batch.predictions],
+            [f"LOT{i}" for i in range(10)],
+        )
+        self.assertGreater(batch.throughput, 0)
+
+    def test_create_inspections_reports_errors(self):
+        batch = self.gpt.create_inspections(["label 1", "unknown", "label 2"])
+
+        self.assertEqual(list(batch.errors), [1])
+        self.assertIsNone(batch.predictions[1])
+        self.assertEqual(batch.predictions[0].inspection.lot_number, "LOT1")
+        self.assertEqual(batch.predictions[2].inspection.lot_number, "LOT2")
+
+
+class TestCreateInspectionChunked(unittest.TestCase):
+    def setUp(self):
+        self.gpt = GPT(
+            api_endpoint="http://localhost",
+            api_key="key",
+            deployment_id="gpt-3.5-turbo",
+        )
+        self.gpt.lm = DummyLM(
+            {
+                "Registration Number": {
+                    "reasoning": "First page.",
+                    "inspection": json.dumps(
+                        {"fertiliser_name": "SuperGrow", "cautions_en": ["Wear gloves."]}
+                    ),
+                },
+                "Cautions": {
+                    "reasoning": "Second page.",
+                    "inspection": json.dumps(
+                        {"npk": "20-20-20", "cautions_en": ["Wear gloves.", "Keep dry."]}
+                    ),
+                },
+            }
+        )
+
+    def test_create_inspection_chunked(self):
+        text = "# SuperGrow\nRegistration Number 2018007A\n\n# Cautions\nWear gloves.\nKeep dry."
+        prediction = self.gpt.create_inspection_chunked(text, max_chunk_tokens=15)
+
+        self.assertEqual(len(self.gpt.lm.history), 2)
+        self.assertEqual(prediction.inspection.fertiliser_name, "SuperGrow")
+        self.assertEqual(prediction.inspection.npk, "20-20-20")
+        self.assertEqual(prediction.inspection.cautions_en, ["Wear gloves.", "Keep dry."])
+        self.assertEqual(prediction.reasoning, "First page.\n\nSecond page.")
+
+
+class TestStreamInspection(unittest.TestCase):
+    def setUp(self):
+        self.gpt = GPT(
+            api_endpoint="http://localhost",
+            api_key="key",
+            deployment_id="gpt-4o",
+        )
+        self.completion = fake_completion(
+            {
+                "fertiliser_name": "SuperGrow",
+                "registration_number": [
+                    {"identifier": "2018007A", "type": "fertilizer_product"}
+                ],
+                "npk": "20-20-20",
+                "cautions_en": ["Keep out of reach of children."],
+            }
+        )
+
+    def check_inspections(self, inspections):
+        self.assertGreater(len(inspections), 2)
+        # Fields arrive progressively, in the order they are generated
+        self.assertEqual(inspections[0].fertiliser_name, None)
+        first_name = next(i for i, p in enumerate(inspections) if p.fertiliser_name)
+        first_npk = next(i for i, p in enumerate(inspections) if p.npk)
+        self.assertLess(first_name, first_npk)
+        self.assertEqual(inspections[first_npk].cautions_en, None)
+
+        final = inspections[-1]
+        self.assertEqual(final.registration_number[0].identifier, "2018007A")
+        self.assertEqual(final.cautions_en, ["Keep out of reach of children."])
+
+    def test_stream_inspection(self):
+        with patch(
+            "pipeline.gpt.litellm.completion",
+            return_value=iter(fake_stream(self.completion)),
+        ) as mock_completion:
+            inspections = list(self.gpt.stream_inspection("label text"))
+
+        self.assertTrue(mock_completion.call_args.kwargs["stream"])
+        self.check_inspections(inspections)
+
+    def test_astream_inspection(self):
+        async def acompletion(**kwargs):
+            async def chunks():
+                for chunk in fake_stream(self.completion):
+                    yield chunk
+
+            return chunks()
+
+        async def run():
+            return [i async for i in self.gpt.astream_inspection("label text")]
+
+        with patch("pipeline.gpt.litellm.acompletion", side_effect=acompletion):
+            inspections = asyncio.run(run())
+
+        self.check_inspections(inspections)
+
+    def test_stream_parses_completed_values_only(self):
+        inspection = {
+            "fertiliser_name": "SuperGrow 20-20-20",
+            "cautions_en": [f"Caution number {i}, to be read carefully." for i in range(100)],
+        }
+        chunks = fake_stream(fake_completion(inspection), size=4)
+
+        with patch(
+            "pipeline.gpt.litellm.completion", return_value=iter(chunks)
+        ), patch(
+            "pipeline.gpt.FertilizerInspection.model_validate",
+            side_effect=FertilizerInspection.model_validate,
+        ) as model_validate:
+            inspections = list(self.gpt.stream_inspection("label text"))
+
+        self.assertEqual(len(inspections[-1].cautions_en), 100)
+        # One parse per completed value (the name, each caution, the list
+        # and the inspection), not per delta
+        self.assertLessEqual(model_validate.call_count, 104)
+        self.assertLess(model_validate.call_count, len(chunks) / 10)
+
+    def test_stream_inspection_invalid_answer(self):
+        with patch(
+            "pipeline.gpt.litellm.completion",
+            return_value=iter(fake_stream("[[ ## reasoning ## ]]\nNo JSON")),
+        ):
+            with self.assertRaises(ValueError):
+                list(self.gpt.stream_inspection("label text"))
+
+
+class TestExtractionMode(unittest.TestCase):
+    def test_unsupported_mode(self):
+        with self.assertRaises(ValueError):
+            GPT(
+                api_endpoint="http://localhost",
+                api_key="key",
+                deployment_id="gpt-4o",
+                mode="fast",
+            )
+
+    def test_direct_mode_skips_reasoning(self):
+        gpt = GPT(
+            api_endpoint="http://localhost",
+            api_key="key",
+            deployment_id="gpt-4o",
+            mode="direct",
+        )
+        gpt.lm = DummyLM([{"inspection": json.dumps({"npk": "10-52-0"})}])
+
+        prediction = gpt.create_inspection("label text")
+
+        self.assertEqual(prediction.inspection.npk, "10-52-0")
+        self.assertNotIn("reasoning", prediction)
+        messages = gpt.lm.history[0]["messages"]
+        self.assertNotIn("reasoning", messages[0]["content"])
+
+
+class SectionLM(dspy.LM):
+    """Answers each section request with the inspection given for it."""
+
+    def __init__(self, answers):
+        super().__init__("section-dummy")
+        self.answers = answers
+
+    def __call__(self, prompt=None, messages=None, **kwargs):
+        system = messages[0]["content"]
+        for section, inspection in self.answers.items():
+            if f"keys: {', '.join(INSPECTION_SECTIONS[section])}." in system:
+                self.history.append({"messages": messages})
+                return [fake_completion(inspection, reasoning=f"Read {section}.")]
+        return ["No more responses"]
+
+
+class TestCreateInspectionSectioned(unittest.TestCase):
+    def test_sections_cover_inspection(self):
+        fields = [f for section in INSPECTION_SECTIONS.values() for f in section]
+        self.assertCountEqual(fields, FertilizerInspection.model_fields)
+
+    def test_create_inspection_sectioned(self):
+        gpt = GPT(
+            api_endpoint="http://localhost",
+            api_key="key",
+            deployment_id="gpt-4o",
+        )
+        gpt.lm = SectionLM(
+            {
+                "organizations": {
+                    "fertiliser_name": "SuperGrow",
+                    "npk": "20-20-20",
+                    "organizations": [{"name": "GreenGrow", "phone_number": "800 640 9605"}],
+                },
+                "guaranteed_analysis": {
+                    "guaranteed_analysis_en": {
+                        "title": "Guaranteed minimum analysis",
+                        "nutrients": [{"nutrient": "Nitrogen", "value": "20", "unit": "%"}],
+                    },
+                },
+                "cautions_instructions": {"cautions_en": ["Keep dry."], "cautions_fr": None},
+                "ingredients_weights": {"weight": [{"value": "25", "unit": "kg"}]},
+            }
+        )
+
+        prediction = gpt.create_inspection_sectioned("label text")
+        inspection = prediction.inspection
+
+        self.assertEqual(len(gpt.lm.history), len(INSPECTION_SECTIONS))
+        self.assertEqual(inspection.fertiliser_name, "SuperGrow")
+        self.assertEqual(inspection.organizations[0].phone_number, "+18006409605")
+        self.assertTrue(inspection.guaranteed_analysis_en.is_minimal)
+        self.assertEqual(inspection.cautions_en, ["Keep dry."])
+        self.assertEqual(inspection.cautions_fr, [])
+        self.assertEqual(inspection.weight[0].value, 25.0)
+        self.assertIn("organizations: Read organizations.", prediction.reasoning)
+
+
+class TestPromptPrefix(unittest.TestCase):
+    def setUp(self):
+        self.gpt = GPT(
+            api_endpoint="http://localhost",
+            api_key="key",
+            deployment_id="gpt-4o",
+        )
+
+    def test_prefix_does_not_drift(self):
+        other = GPT(
+            api_endpoint="http://localhost",
+            api_key="key",
+            deployment_id="gpt-4o",
+        )
+        prefix = self.gpt.prompt_prefix()
+
+        self.assertEqual(prefix, self.gpt.prompt_prefix())
+        self.assertEqual(prefix, other.prompt_prefix())
+        for text in ["SuperGrow 20-20-20", "Engrais 10-52-0\n\n# Lot 1234"]:
+            system, user = self.gpt.format_messages(text)
+            self.assertTrue((system["content"] + user["content"]).startswith(prefix))
+
+    def test_text_is_last_input(self):
+        system, user = self.gpt.format_messages("SuperGrow 20-20-20")
+
+        self.assertNotIn("SuperGrow", system["content"])
+        text_start = user["content"].index("SuperGrow 20-20-20")
+        self.assertNotIn("[[ ## requirements ## ]]", user["content"][text_start:])
+
+    def test_create_inspection_prefix(self):
+        self.gpt.lm = DummyLM(
+            [{"reasoning": "Read.", "inspection": json.dumps({"npk": "20-20-20"})}] * 2
+        )
+
+        self.gpt.create_inspection("SuperGrow 20-20-20")
+        self.gpt.create_inspection("Engrais 10-52-0")
+
+        prefix = self.gpt.prompt_prefix()
+        for entry in self.gpt.lm.history:
+            system, user = entry["messages"]
+            self.assertTrue((system["content"] + user["content"]).startswith(prefix))
+
+    def test_prompt_cache_usage(self):
+        history = [
+            {"usage": {"prompt_tokens": 2000, "prompt_tokens_details": {"cached_tokens": 1536}}},
+            {"usage": {"prompt_tokens": 2000, "prompt_tokens_details": None}},
+            {"usage": {}},
+        ]
+
+        report = prompt_cache_usage(history)
+
+        self.assertEqual(report["prompt_tokens"], 4000)
+        self.assertEqual(report["cached_tokens"], 1536)
+        self.assertEqual(report["uncached_tokens"], 2464)
+        self.assertEqual(report["calls"][0]["uncached_tokens"], 464)
+        self.assertAlmostEqual(report["hit_ratio"], 0.384)
+
+
+class TestLeanSchema(unittest.TestCase):
+    def gpt(self, lean_schema, **kwargs):
+        return GPT(
+            api_endpoint="http://localhost",
+            api_key="key",
+            deployment_id="gpt-4o",
+            lean_schema=lean_schema,
+            **kwargs,
+        )
+
+    def prompt_tokens(self, gpt):
+        return sum(
+            estimate_tokens(message["content"])
+            for message in gpt.format_messages("SuperGrow 20-20-20")
+        )
+
+    def test_fewer_prompt_tokens(self):
+        for structured_output in (True, False):
+            lean = self.prompt_tokens(self.gpt(True, structured_output=structured_output))
+            full = self.prompt_tokens(self.gpt(False, structured_output=structured_output))
+
+            # Even when the full prompt is served from the cache at half
+            # price, which the lean one never is (see lean_schema)
+            self.assertLess(lean, full / 2)
+
+    def test_every_field_is_described(self):
+        system, _ = self.gpt(True).format_messages("SuperGrow 20-20-20")
+
+        self.assertNotIn("JSON Schema", system["content"])
+        self.assertNotIn("$defs", system["content"])
+        models = [FertilizerInspection]
+        seen = set()
+        while models:
+            model = models.pop()
+            seen.add(model)
+            for name, field in model.model_fields.items():
+                self.assertIn(f"{name}: ", system["content"])
+                if field.description:
+                    self.assertIn(field.description.rstrip("."), system["content"])
+                # Nested models, also inside Optional[...] and List[...]
+                annotations = [field.annotation]
+                while annotations:
+                    annotation = annotations.pop()
+                    annotations += typing.get_args(annotation)
+                    if (
+                        isinstance(annotation, type)
+                        and issubclass(annotation, BaseModel)
+                        and annotation not in seen
+                    ):
+                        models.append(annotation)
+        # e.g. the nutrients of a guaranteed analysis, in a list
+        self.assertIn(NutrientValue, seen)
+
+    def test_rendered_once(self):
+        self.assertIs(lean_schema(FertilizerInspection), lean_schema(FertilizerInspection))
+        self.assertIn("npk: string", lean_schema(FertilizerInspection))
+
+    def test_create_inspection(self):
+        gpt = self.gpt(True, structured_output=False)
+        gpt.lm = DummyLM(
+            [{"reasoning": "Read.", "inspection": json.dumps({"npk": "20-20-20"})}]
+        )
+
+        prediction = gpt.create_inspection("SuperGrow 20-20-20")
+
+        self.assertEqual(prediction.inspection.npk, "20-20-20")
+        system = gpt.lm.history[-1]["messages"][0]["content"]
+        self.assertIn(lean_schema(FertilizerInspection), system)
+
+
+class ScriptedLM(dspy.LM):
+    """Returns the given answers in order and records the request arguments."""
+
+    def __init__(self, answers, usage=None):
+        super().__init__("scripted-dummy")
+        self.answers = iter(answers)
+        self.usage = usage or {}
+        self.requests = []
+
+    def __call__(self, prompt=None, messages=None, **kwargs):
+        self.requests.append(kwargs)
+        self.history.append({"messages": messages, "usage": self.usage})
+        return [next(self.answers)]
+
+
+class TestStructuredOutput(unittest.TestCase):
+    def setUp(self):
+        self.inspection = {"fertiliser_name": "SuperGrow", "npk": "20-20-20"}
+        self.answer = json.dumps({"reasoning": "Read.", "inspection": self.inspection})
+
+    def gpt(self, deployment_id="gpt-4o", **kwargs):
+        return GPT(
+            api_endpoint="http://localhost",
+            api_key="key",
+            deployment_id=deployment_id,
+            **kwargs,
+        )
+
+    def assert_strict(self, schema):
+        if isinstance(schema, dict):
+            self.assertNotIn("default", schema)
+            if "properties" in schema:
+                self.assertFalse(schema["additionalProperties"])
+                self.assertEqual(schema["required"], list(schema["properties"]))
+            for value in schema.values():
+                self.assert_strict(value)
+        elif isinstance(schema, list):
+            for value in schema:
+                self.assert_strict(value)
+
+    def test_structured_output_format(self):
+        signature = dspy.TypedChainOfThought(ProduceLabelForm)._prepare_signature()
+
+        response_format = structured_output_format(signature)
+
+        self.assertEqual(response_format["type"], "json_schema")
+        self.assertTrue(response_format["json_schema"]["strict"])
+        schema = response_format["json_schema"]["schema"]
+        self.assertEqual(list(schema["properties"]), ["reasoning", "inspection"])
+        self.assert_strict(schema)
+
+    def test_create_inspection_without_retry(self):
+        gpt = self.gpt()
+        gpt.lm = ScriptedLM([self.answer])
+
+        prediction = gpt.create_inspection("label text")
+
+        self.assertEqual(prediction.inspection.npk, "20-20-20")
+        self.assertEqual(prediction.retries, 0)
+        response_format = gpt.lm.requests[0]["response_format"]
+        self.assertEqual(response_format["type"], "json_schema")
+        self.assertIn("Respond with a JSON object", gpt.lm.history[0]["messages"][-1]["content"])
+
+    def test_json_object_deployment(self):
+        gpt = self.gpt("gpt-3.5-turbo", mode="direct")
+        gpt.lm = ScriptedLM([json.dumps({"inspection": self.inspection})])
+
+        prediction = gpt.create_inspection("label text")
+
+        self.assertEqual(prediction.inspection.fertiliser_name, "SuperGrow")
+        self.assertEqual(gpt.lm.requests[0]["response_format"], {"type": "json_object"})
+
+    def test_retries_are_counted(self):
+        gpt = self.gpt(structured_output=False)
+        invalid = "[[ ## reasoning ## ]]\nRead.\n\n[[ ## inspection ## ]]\nNo JSON"
+        # TypedPredictor asks the LM for an example of the schema before retrying
+        example = "[[ ## json_object ## ]]\n{}"
+        gpt.lm = ScriptedLM([invalid, example, fake_completion(self.inspection)])
+
+        prediction = gpt.create_inspection("label text")
+
+        self.assertEqual(prediction.retries, 2)
+        self.assertNotIn("response_format", gpt.lm.requests[0])
+
+    def test_acreate_inspection_response_format(self):
+        async def acompletion(**kwargs):
+            return fake_response(self.answer)
+
+        gpt = self.gpt()
+        with patch("pipeline.gpt.litellm.acompletion", side_effect=acompletion) as mock_acompletion:
+            prediction = asyncio.run(gpt.acreate_inspection("label text"))
+
+        self.assertEqual(prediction.inspection.npk, "20-20-20")
+        self.assertEqual(prediction.retries, 0)
+        self.assertEqual(
+            mock_acompletion.call_args.kwargs["response_format"]["type"], "json_schema"
+        )
+
+    def test_stream_json_answer(self):
+        gpt = self.gpt()
+        with patch("pipeline.gpt.litellm.completion", return_value=fake_stream(self.answer, 8)):
+            partials = list(gpt.stream_inspection("label text"))
+
+        self.assertEqual(partials[-1].npk, "20-20-20")
+        self.assertGreater(len(partials), 1)
+
+    def test_parse_falls_back_to_chat_format(self):
+        signature = dspy.TypedChainOfThought(ProduceLabelForm)._prepare_signature()
+        adapter = JSONAdapter({"type": "json_schema"})
+
+        values = adapter.parse(signature, fake_completion(self.inspection), _parse_values=False)
+
+        self.assertEqual(json.loads(values["inspection"]), self.inspection)
+
+
+class TestUsageRecord(unittest.TestCase):
+    def setUp(self):
+        USAGE.reset()
+        self.gpt = GPT(
+            api_endpoint="http://localhost",
+            api_key="key",
+            deployment_id="gpt-4o",
+            structured_output=False,
+        )
+        self.inspection = {"npk": "20-20-20"}
+        self.usage = {
+            "prompt_tokens": 2000,
+            "completion_tokens": 300,
+            "prompt_tokens_details": {"cached_tokens": 1024},
+        }
+
+    def tearDown(self):
+        USAGE.reset()
+
+    def test_create_inspection_usage(self):
+        invalid = "[[ ## reasoning ## ]]\nRead.\n\n[[ ## inspection ## ]]\nNo JSON"
+        example = "[[ ## json_object ## ]]\n{}"
+        self.gpt.lm = ScriptedLM(
+            [invalid, example, fake_completion(self.inspection)], usage=self.usage
+        )
+
+        prediction = self.gpt.create_inspection("label text")
+
+        usage = prediction.usage
+        self.assertEqual(usage.requests, 3)
+        self.assertEqual(usage.retries, 2)
+        self.assertEqual(usage.prompt_tokens, 6000)
+        self.assertEqual(usage.completion_tokens, 900)
+        self.assertEqual(usage.cached_tokens, 3072)
+        self.assertEqual(len(usage.latencies), 3)
+        totals = USAGE.snapshot()["gpt-4o"]
+        self.assertEqual(totals["extractions"], 1)
+        self.assertEqual(totals["requests"], 3)
+        self.assertEqual(totals["retries"], 2)
+
+    def test_acreate_inspection_usage(self):
+        responses = iter(
+            [
+                fake_response("[[ ## reasoning ## ]]\nNo JSON", SimpleNamespace(**self.usage)),
+                fake_response(fake_completion(self.inspection), self.usage),
+            ]
+        )
+
+        async def acompletion(**kwargs):
+            return next(responses)
+
+        with patch("pipeline.gpt.litellm.acompletion", side_effect=acompletion):
+            prediction = asyncio.run(self.gpt.acreate_inspection("label text"))
+
+        self.assertEqual(prediction.usage.to_dict()["requests"], 2)
+        self.assertEqual(prediction.usage.retries, 1)
+        self.assertEqual(prediction.usage.prompt_tokens, 4000)
+        self.assertEqual(prediction.usage.cached_tokens, 2048)
+        self.assertEqual(USAGE.snapshot()["gpt-4o"]["completion_tokens"], 600)
+
+    def test_failed_extraction_is_recorded(self):
+        async def acompletion(**kwargs):
+            return fake_response("[[ ## reasoning ## ]]\nNo JSON")
+
+        with patch("pipeline.gpt.litellm.acompletion", side_effect=acompletion):
+            with self.assertRaises(ValueError):
+                asyncio.run(self.gpt.acreate_inspection("label text"))
+
+        self.assertEqual(USAGE.snapshot()["gpt-4o"]["requests"], 3)
+
+    def test_chunked_extraction_is_recorded_once(self):
+        self.gpt.lm = DummyLM(
+            {
+                "Registration Number": {
+                    "reasoning": "First page.",
+                    "inspection": json.dumps({"fertiliser_name": "SuperGrow"}),
+                },
+                "Cautions": {
+                    "reasoning": "Second page.",
+                    "inspection": json.dumps({"cautions_en": ["Keep dry."]}),
+                },
+            }
+        )
+        text = "# SuperGrow\nRegistration Number 2018007A\n\n# Cautions\nWear gloves.\nKeep dry."
+
+        prediction = self.gpt.create_inspection_chunked(text, max_chunk_tokens=15)
+
+        totals = USAGE.snapshot()["gpt-4o"]
+        self.assertEqual(totals["extractions"], 1)
+        self.assertEqual(totals["requests"], 2)
+        self.assertEqual(totals["retries"], 0)
+        self.assertEqual(prediction.usage.requests, 2)
+        self.assertEqual(prediction.retries, 0)
+
+    def test_sectioned_extraction_is_recorded_once(self):
+        self.gpt.lm = SectionLM({section: {} for section in INSPECTION_SECTIONS})
+
+        self.gpt.create_inspection_sectioned("label text")
+
+        totals = USAGE.snapshot()["gpt-4o"]
+        self.assertEqual(totals["extractions"], 1)
+        self.assertEqual(totals["requests"], len(INSPECTION_SECTIONS))
+        self.assertEqual(totals["retries"], 0)
+
+
+class TestBatchJob(unittest.TestCase):
+    def setUp(self):
+        self.gpt = GPT(
+            api_endpoint="http://localhost",
+            api_key="key",
+            deployment_id="gpt-4o",
+        )
+        self.fixture = os.path.join(os.path.dirname(__file__), "fixtures", "batch_output.jsonl")
+
+    def test_write_batch_file(self):
+        texts = ["SuperGrow 20-20-20", "Engrais 10-52-0"]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "batch_input.jsonl")
+            custom_ids = self.gpt.write_batch_file(texts, path, ["label-1", "label-2"])
+            with open(path, "r", encoding="utf-8") as file:
+                requests = [json.loads(line) for line in file]
+
+        self.assertEqual(custom_ids, ["label-1", "label-2"])
+        for request, text in zip(requests, texts):
+            self.assertEqual(request["method"], "POST")
+            self.assertEqual(request["url"], "/chat/completions")
+            body = request["body"]
+            self.assertEqual(body["model"], "gpt-4o")
+            self.assertEqual(body["messages"], self.gpt.format_messages(text))
+            self.assertEqual(body["response_format"]["type"], "json_schema")
+            self.assertNotIn("api_key", body)
+
+    def test_batch_requests_ids(self):
+        requests = self.gpt.batch_requests(["a", "b"])
+        self.assertEqual([r["custom_id"] for r in requests], ["0", "1"])
+
+        with self.assertRaises(ValueError):
+            self.gpt.batch_requests(["a", "b"], ["same", "same"])
+
+    def test_read_batch_results(self):
+        results = self.gpt.read_batch_results(self.fixture)
+
+        self.assertEqual(list(results), ["label-1", "label-2", "label-3", "label-4"])
+        inspection = results["label-1"].inspection
+        self.assertEqual(inspection.fertiliser_name, "SuperGrow 20-20-20")
+        self.assertEqual(inspection.organizations[0].phone_number, "+18005550199")
+        self.assertEqual(inspection.weight[1].value, 55.0)
+        self.assertEqual(results["label-1"].usage.cached_tokens, 1920)
+        self.assertIsInstance(results["label-2"], ValueError)
+        self.assertIn("Rate limit", str(results["label-3"]))
+        self.assertIn("batch_expired", str(results["label-4"]))
+
+
+class TestSalvage(unittest.TestCase):
+    def setUp(self):
+        self.gpt = GPT(
+            api_endpoint="http://localhost",
+            api_key="key",
+            deployment_id="gpt-4o",
+        )
+        # Cut off at max_tokens in the middle of the second registration number
+        self.truncated = (
+            '{"reasoning": "Read.", "inspection": {"fertiliser_name": "SuperGrow", '
+            '"npk": "20-20-20", "registration_number": [{"identifier": "2018007A"}, {"identi'
+        )
+
+    def test_truncated_json_answer_is_salvaged(self):
+        self.gpt.lm = ScriptedLM([self.truncated])
+
+        prediction = self.gpt.create_inspection("label text")
+
+        self.assertEqual(prediction.retries, 0)
+        self.assertEqual(prediction.reasoning, "Read.")
+        inspection = prediction.inspection
+        self.assertEqual(inspection.npk, "20-20-20")
+        self.assertEqual(
+            [r.identifier for r in inspection.registration_number], ["2018007A"]
+        )
+        self.assertEqual(prediction.salvaged["registration_number"], "truncated")
+        self.assertEqual(prediction.salvaged["lot_number"], "missing")
+        self.assertNotIn("npk", prediction.salvaged)
+
+    def test_trailing_comma_is_salvaged(self):
+        gpt = GPT(
+            api_endpoint="http://localhost",
+            api_key="key",
+            deployment_id="gpt-4o",
+            structured_output=False,
+        )
+        gpt.lm = ScriptedLM(
+            [fake_completion({"npk": "20-20-20"}).replace('"20-20-20"}', '"20-20-20",}')]
+        )
+
+        prediction = gpt.create_inspection("label text")
+
+        self.assertEqual(prediction.retries, 0)
+        self.assertEqual(prediction.inspection.npk, "20-20-20")
+        self.assertEqual(prediction.salvaged, {})
+
+    def test_valid_answer_is_not_salvaged(self):
+        self.gpt.lm = ScriptedLM(
+            [json.dumps({"reasoning": "Read.", "inspection": {"npk": "20-20-20"}})]
+        )
+
+        prediction = self.gpt.create_inspection("label text")
+
+        self.assertEqual(prediction.salvaged, {})
+
+    def test_answer_cut_before_inspection_fails(self):
+        self.gpt.lm = ScriptedLM(['{"reasoning": "Read the lab'])
+
+        with self.assertRaises(ValueError):
+            self.gpt.create_inspection("label text")
+
+    def test_answer_cut_at_the_start_is_retried(self):
+        # TypedPredictor asks the LM for an example of the schema before retrying
+        self.gpt.lm = ScriptedLM(
+            [
+                '{"reasoning": "Read.", "inspection": {"organiz',
+                "[[ ## json_object ## ]]\n{}",
+                json.dumps({"reasoning": "Read.", "inspection": {"npk": "20-20-20"}}),
+            ]
+        )
+
+        prediction = self.gpt.create_inspection("label text")
+
+        self.assertEqual(prediction.retries, 2)
+        self.assertEqual(prediction.inspection.npk, "20-20-20")
+        self.assertEqual(prediction.salvaged, {})
+
+    def test_acreate_inspection_retries_answer_cut_at_the_start(self):
+        responses = iter(
+            [
+                '{"reasoning": "Read.", "inspection": {"organiz',
+                json.dumps({"reasoning": "Read.", "inspection": {"npk": "20-20-20"}}),
+            ]
+        )
+
+        async def acompletion(**kwargs):
+            return fake_response(next(responses))
+
+        with patch("pipeline.gpt.litellm.acompletion", side_effect=acompletion) as mock_acompletion:
+            prediction = asyncio.run(self.gpt.acreate_inspection("label text"))
+
+        self.assertEqual(mock_acompletion.call_count, 2)
+        self.assertEqual(prediction.inspection.npk, "20-20-20")
+
+    def test_acreate_inspection_salvages(self):
+        async def acompletion(**kwargs):
+            return fake_response(self.truncated)
+
+        with patch("pipeline.gpt.litellm.acompletion", side_effect=acompletion) as mock_acompletion:
+            prediction = asyncio.run(self.gpt.acreate_inspection("label text"))
+
+        self.assertEqual(mock_acompletion.call_count, 1)
+        self.assertEqual(prediction.inspection.npk, "20-20-20")
+        self.assertEqual(prediction.salvaged["registration_number"], "truncated")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,79 @@
+import subprocess
+import sys
+import unittest
+
+import pipeline
+
+# Modules that must only be loaded when the class needing them is used
+HEAVY_MODULES = [
+    "dspy",
+    "litellm",
+    "phoenix",
+    "openinference",
+    "azure",
+    "reportlab",
+]
+
+# Cumulative import time budgets, in microseconds (see `python -X importtime`)
+IMPORT_TIME_BUDGETS = {
+    "import pipeline": 100_000,
+    "from pipeline import FertilizerInspection, LabelStorage": 1_000_000,
+}
+
+
+def import_times(statement: str) -> dict[str, int]:
+    """
+    Run a statement in a fresh interpreter with -X importtime and return the
+    cumulative import time of every module it loaded. Nested imports keep
+    their indentation in the module name.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.rstrip()[1:]] = int(cumulative)
+    return times
+
+
+def pipeline_import_time(times: dict[str, int]) -> int:
+    # Submodules loaded lazily show up as top-level imports of their own
+    return sum(
+        cumulative
+        for name, cumulative in times.items()
+        if name.startswith("pipeline")
+    )
+
+
+class TestImportTime(unittest.TestCase):
+    def test_import_time_budget(self):
+        for statement, budget in IMPORT_TIME_BUDGETS.items():
+            with self.subTest(statement=statement):
+                times = import_times(statement)
+                self.assertLess(pipeline_import_time(times), budget, times)
+
+    def test_heavy_modules_are_lazy(self):
+        for statement in IMPORT_TIME_BUDGETS:
+            with self.subTest(statement=statement):
+                loaded = {name.strip().split(".")[0] for name in import_times(statement)}
+                self.assertEqual(loaded & set(HEAVY_MODULES), set())
+
+    def test_lazy_attributes(self):
+        from pipeline.gpt import GPT
+        from pipeline.ocr import OCR
+
+        self.assertIs(pipeline.GPT, GPT)
+        self.assertIs(pipeline.OCR, OCR)
+        self.assertIn("GPT", dir(pipeline))
+        with self.assertRaises(AttributeError):
+            pipeline.Unknown
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,8 @@
+import json
 import unittest
+from unittest.mock import patch
+
+from pydantic import ValidationError
 
 from pipeline.inspection import (
     FertilizerInspection,
@@ -8,6 +12,16 @@ from pipeline.inspection import (
     Specification,
     Organization,
     Value,
+    PartialJSON,
+    _close_partial_json,
+    close_partial_json,
+    merge_inspections,
+    normalize_phone_number,
+    repair_json,
+    salvage_inspection,
+    validate_inspections,
+    validate_inspections_json,
+    validate_inspections_ndjson,
 )
 
 
@@ -299,6 +313,11 @@ class TestRegistrationNumber(unittest.TestCase):
         for registration_type in self.invalid_registration_type_data:
             with self.subTest(registration_type=registration_type):
                 self.assertIsNone(RegistrationNumber(identifier="1234567A", type=registration_type).type)
+
+    def test_unhashable_registration_type(self):
+        for registration_type in (["fertilizer_product"], {"k": 1}):
+            with self.subTest(registration_type=registration_type):
+                self.assertIsNone(RegistrationNumber(identifier="1234567A", type=registration_type).type)
     
 
 class TestGuaranteedAnalysis(unittest.TestCase):
@@ -427,9 +446,325 @@ class TestOrganizationPhoneNumberFormat(unittest.TestCase):
         instance = Organization(phone_number="12345")
         self.assertIsNone(instance.phone_number)
 
+    def test_phone_number_not_a_string(self):
+        for phone_number in (["(757) 321-4567"], {"k": 1}):
+            with self.subTest(phone_number=phone_number):
+                with self.assertRaises(ValidationError):
+                    Organization(phone_number=phone_number)
+
+    def test_phone_number_normalization_is_memoized(self):
+        normalize_phone_number.cache_clear()
+        for _ in range(3):
+            instance = Organization(phone_number="(757) 321-4567")
+            self.assertEqual(instance.phone_number, "+17573214567")
+
+        info = normalize_phone_number.cache_info()
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.hits, 2)
+
+
+class TestBulkValidation(unittest.TestCase):
+    def setUp(self):
+        self.raws = [
+            {"npk": "20-20-20", "weight": [{"value": "25 kg", "unit": "kg"}]},
+            {"organizations": "Acme"},
+            {"registration_number": [{"identifier": "2018007A"}]},
+        ]
+
+    def assert_results(self, results):
+        self.assertEqual(len(results), 3)
+        self.assertEqual(
+            results[0], FertilizerInspection.model_validate(self.raws[0])
+        )
+        self.assertIsInstance(results[1], ValidationError)
+        self.assertEqual(
+            results[2].registration_number[0].identifier, "2018007A"
+        )
+
+    def test_validate_inspections(self):
+        results = validate_inspections([self.raws[0], self.raws[2]])
+
+        self.assertEqual(
+            results,
+            [FertilizerInspection.model_validate(r) for r in (self.raws[0], self.raws[2])],
+        )
+
+    def test_validate_inspections_with_invalid_item(self):
+        self.assert_results(validate_inspections(self.raws))
+
+    def test_validate_inspections_json(self):
+        self.assert_results(validate_inspections_json(json.dumps(self.raws).encode()))
+
+    def test_validate_inspections_json_not_an_array(self):
+        with self.assertRaises(ValidationError):
+            validate_inspections_json(b'{"npk": "20-20-20"}')
+
+    def test_validate_inspections_ndjson(self):
+        lines = [json.dumps(raw).encode() + b"\n" for raw in self.raws]
+        lines.insert(1, b"\n")
+        lines.append(b'{"npk": ')
+
+        results = list(validate_inspections_ndjson(lines, batch_size=2))
+
+        self.assertEqual(len(results), 4)
+        self.assert_results(results[:3])
+        self.assertIsInstance(results[3], ValidationError)
+
+    def test_each_item_is_validated_once(self):
+        from pipeline import inspection
+
+        validated = []
+
+        class CountingAdapter:
+            def validate_python(self, raw):
+                validated.append(raw)
+                return inspection.FertilizerInspection.model_validate(raw)
+
+        # A few invalid answers among valid ones
+        raws = [self.raws[i % 3] for i in range(30)]
+        with patch.object(inspection, "_INSPECTION", CountingAdapter()):
+            results = validate_inspections(raws)
+            validate_inspections_json(json.dumps(raws))
+
+        self.assertEqual(len(validated), 2 * len(raws))
+        self.assertEqual(sum(isinstance(r, ValidationError) for r in results), 10)
+
+    def test_unhashable_values_fail_one_item(self):
+        raws = [
+            {"registration_number": [{"identifier": "2018007A", "type": {"k": 1}}]},
+            {"organizations": [{"phone_number": ["(757) 321-4567"]}]},
+            self.raws[0],
+        ]
+
+        results = validate_inspections(raws)
+
+        self.assertIsNone(results[0].registration_number[0].type)
+        self.assertIsInstance(results[1], ValidationError)
+        self.assertEqual(results[2].npk, "20-20-20")
+
+
+class TestSalvageInspection(unittest.TestCase):
+    def test_repair_complete_json(self):
+        self.assertEqual(repair_json('{"a": [1, 2]}'), ({"a": [1, 2]}, 0))
+
+    def test_repair_trailing_commas(self):
+        repaired = repair_json('```json\n{"a": [1, 2,], "b": "x, ]",}\n```')
+
+        self.assertEqual(repaired, ({"a": [1, 2], "b": "x, ]"}, 0))
+
+    def test_repair_truncated_json(self):
+        self.assertEqual(repair_json('{"a": [1, 2'), ({"a": [1]}, 2))
+        self.assertEqual(repair_json('{"a": [1, 2], "b": "tex'), ({"a": [1, 2]}, 1))
+
+    def test_repair_without_json(self):
+        self.assertIsNone(repair_json("No JSON"))
+
+    def test_salvage_truncated_list(self):
+        inspection, salvaged = salvage_inspection(
+            '{"npk": "20-20-20", "weight": [{"value": 2, "unit": "kg"}, {"value": 3'
+        )
+
+        self.assertEqual(inspection.npk, "20-20-20")
+        self.assertEqual(len(inspection.weight), 1)
+        self.assertEqual(salvaged["weight"], "truncated")
+        self.assertEqual(salvaged["cautions_fr"], "missing")
+        self.assertNotIn("npk", salvaged)
+
+    def test_salvage_drops_invalid_items(self):
+        inspection, salvaged = salvage_inspection(
+            {
+                "fertiliser_name": "SuperGrow",
+                "cautions_en": "Not a list",
+                "guaranteed_analysis_en": {
+                    "title": "Guaranteed analysis",
+                    "nutrients": [{"nutrient": "N", "value": 1}, {"value": 2}],
+                },
+            }
+        )
+
+        self.assertEqual(inspection.fertiliser_name, "SuperGrow")
+        self.assertIsNone(inspection.cautions_en)
+        self.assertEqual(len(inspection.guaranteed_analysis_en.nutrients), 1)
+        self.assertEqual(
+            salvaged, {"cautions_en": "invalid", "guaranteed_analysis_en": "invalid"}
+        )
+
+    def test_salvage_without_json(self):
+        with self.assertRaises(ValueError):
+            salvage_inspection("No JSON")
+
+    def test_salvage_nothing_recovered(self):
+        with self.assertRaises(ValueError):
+            salvage_inspection('{"organiz')
+        with self.assertRaises(ValueError):
+            salvage_inspection('{"npk": "not an npk", "lot_num')
+
+
+class TestMergeInspections(unittest.TestCase):
+    def setUp(self):
+        self.first = FertilizerInspection(
+            fertiliser_name="SuperGrow",
+            organizations=[Organization(name="GreenGrow Inc.")],
+            registration_number=[RegistrationNumber(identifier="2018007A")],
+            weight=[Value(value=25, unit="kg")],
+            density=Value(value=None, unit=None),
+            guaranteed_analysis_en=GuaranteedAnalysis(
+                title="Guaranteed minimum analysis",
+                nutrients=[NutrientValue(nutrient="Nitrogen", value=20, unit="%")],
+            ),
+            cautions_en=["Keep out of reach of children."],
+        )
+        self.second = FertilizerInspection(
+            fertiliser_name="SuperGrow 20-20-20",
+            npk="20-20-20",
+            organizations=[Organization(name="GreenGrow Inc."), Organization(name="AgroTech")],
+            weight=[Value(value=25, unit="kg"), Value(value=55, unit="lb")],
+            density=Value(value=1.2, unit="g/cm³"),
+            guaranteed_analysis_en=GuaranteedAnalysis(
+                nutrients=[
+                    NutrientValue(nutrient="Nitrogen", value=20, unit="%"),
+                    NutrientValue(nutrient="Soluble Potash", value=20, unit="%"),
+                ],
+            ),
+            cautions_en=["Keep out of reach of children.", "Wear gloves."],
+        )
+
+    def test_merge_lists_are_unioned_without_duplicates(self):
+        merged = merge_inspections([self.first, self.second])
+        self.assertEqual([o.name for o in merged.organizations], ["GreenGrow Inc.", "AgroTech"])
+        self.assertEqual(merged.weight, [Value(value=25, unit="kg"), Value(value=55, unit="lb")])
+        self.assertEqual(merged.cautions_en, ["Keep out of reach of children.", "Wear gloves."])
+        self.assertEqual(len(merged.registration_number), 1)
+
+    def test_merge_prefers_non_null_scalars(self):
+        merged = merge_inspections([self.first, self.second])
+        self.assertEqual(merged.fertiliser_name, "SuperGrow")
+        self.assertEqual(merged.npk, "20-20-20")
+        self.assertEqual(merged.density, Value(value=1.2, unit="g/cm³"))
+
+    def test_merge_nested_sections(self):
+        merged = merge_inspections([self.first, self.second])
+        analysis = merged.guaranteed_analysis_en
+        self.assertEqual(analysis.title, "Guaranteed minimum analysis")
+        self.assertTrue(analysis.is_minimal)
+        self.assertEqual(
+            [n.nutrient for n in analysis.nutrients], ["Nitrogen", "Soluble Potash"]
+        )
+
+    def test_merge_is_deterministic(self):
+        merged = merge_inspections([self.first, self.second])
+        again = merge_inspections([self.first, self.second])
+        self.assertEqual(merged.model_dump_json(), again.model_dump_json())
+
+    def test_merge_empty(self):
+        self.assertEqual(merge_inspections([]), FertilizerInspection())
+        self.assertEqual(
+            merge_inspections([FertilizerInspection(), self.first]).fertiliser_name,
+            "SuperGrow",
+        )
+
+    def test_merge_normalized_duplicates(self):
+        other = FertilizerInspection(
+            organizations=[
+                Organization(name="greengrow inc", website="www.greengrow.ca"),
+            ],
+            registration_number=[RegistrationNumber(identifier="2018007A", type="fertilizer_product")],
+            guaranteed_analysis_en=GuaranteedAnalysis(
+                nutrients=[NutrientValue(nutrient="NITROGEN", value=20, unit="%")],
+            ),
+            cautions_en=["keep out of reach of children"],
+        )
+
+        merged = merge_inspections([self.first, other])
+
+        self.assertEqual(len(merged.organizations), 1)
+        self.assertEqual(merged.organizations[0].name, "GreenGrow Inc.")
+        self.assertEqual(merged.organizations[0].website, "www.greengrow.ca")
+        self.assertEqual(len(merged.registration_number), 1)
+        self.assertEqual(merged.registration_number[0].type, "fertilizer_product")
+        self.assertEqual(len(merged.guaranteed_analysis_en.nutrients), 1)
+        self.assertEqual(merged.cautions_en, ["Keep out of reach of children."])
+
+    def test_merge_policies(self):
+        third = FertilizerInspection(fertiliser_name="SuperGrow 20-20-20", npk="10-10-10")
+
+        last = merge_inspections([self.first, self.second, third], policy="last")
+        self.assertEqual(last.fertiliser_name, "SuperGrow 20-20-20")
+        self.assertEqual(last.npk, "10-10-10")
+
+        most_common = merge_inspections(
+            [self.first, self.second, third], policy="most_common"
+        )
+        self.assertEqual(most_common.fertiliser_name, "SuperGrow 20-20-20")
+        self.assertEqual(most_common.npk, "20-20-20")
+
+        by_field = merge_inspections(
+            [self.first, self.second, third], policy={"npk": "last", "*": "first"}
+        )
+        self.assertEqual(by_field.fertiliser_name, "SuperGrow")
+        self.assertEqual(by_field.npk, "10-10-10")
+
+    def test_merge_unsupported_policy(self):
+        with self.assertRaises(ValueError):
+            merge_inspections([self.first], policy="vote")
+        with self.assertRaises(ValueError):
+            merge_inspections([self.first], policy={"npk": "vote"})
+
+    def test_merge_many(self):
+        inspections = [self.first, self.second] * 2000
+
+        merged = merge_inspections(inspections)
+
+        self.assertEqual(merged, merge_inspections([self.first, self.second]))
+
+
+class TestClosePartialJson(unittest.TestCase):
+    def test_complete_document(self):
+        self.assertEqual(close_partial_json('{"npk": "20-20-20"}'), '{"npk": "20-20-20"}')
+
+    def test_text_around_document(self):
+        self.assertEqual(close_partial_json('```json\n{"npk": "1-2-3"}\n```'), '{"npk": "1-2-3"}')
+
+    def test_no_document(self):
+        self.assertIsNone(close_partial_json("The label was read."))
+
+    def test_incomplete_values_are_dropped(self):
+        cases = {
+            '{"fertiliser_name": "Super': "{}",
+            '{"fertiliser_name": "SuperGrow", "np': '{"fertiliser_name": "SuperGrow"}',
+            '{"weight": [{"value": 25, "unit": "kg"}, {"value": 5': '{"weight": [{"value": 25, "unit": "kg"}, {}]}',
+            '{"cautions_en": ["Keep dry.", "Wear': '{"cautions_en": ["Keep dry."]}',
+            '{"name": "A \\"quoted\\" name", ': '{"name": "A \\"quoted\\" name"}',
+            "[1, 2, tr": "[1, 2]",
+        }
+        for partial, expected in cases.items():
+            with self.subTest(partial=partial):
+                self.assertEqual(close_partial_json(partial), expected)
+
+    def test_every_prefix_is_valid_json(self):
+        document = json.dumps(
+            {
+                "organizations": [{"name": "GreenGrow", "phone_number": None}],
+                "weight": [{"value": 25.5, "unit": "kg"}],
+                "is_minimal": True,
+            }
+        )
+        for i in range(len(document) + 1):
+            partial = close_partial_json(document[:i])
+            if partial is not None:
+                json.loads(partial)
+
+    def test_incremental(self):
+        document = 'The answer: {"cautions_en": ["Keep \\"dry\\".", "Wear gloves."], "weight": [{"value": 25}]} done'
+        for size in (1, 3, 7):
+            with self.subTest(size=size):
+                partial = PartialJSON()
+                for i in range(0, len(document), size):
+                    partial.feed(document[i : i + size])
+                    self.assertEqual(
+                        partial.closed(), _close_partial_json(document[: i + size])
+                    )
 
-if __name__ == "__main__":
-    unittest.main()
 
 if __name__ == "__main__":
     unittest.main()
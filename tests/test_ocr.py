@@ -1,5 +1,8 @@
+import asyncio
 import os
 import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
 
 from tests import curl_file
 from pipeline import save_text_to_file
@@ -99,3 +102,59 @@ class TestOCR(unittest.TestCase):
                 file_path = os.path.join(self.log_dir_path, file)
                 os.remove(file_path)
             os.rmdir(self.log_dir_path)
+
+
+class FakeAsyncClient:
+    """Stand-in for the aio DocumentIntelligenceClient."""
+
+    instances = []
+
+    def __init__(self, endpoint, credential, error=None):
+        self.endpoint = endpoint
+        self.credential = credential
+        self.error = error
+        self.closed = False
+        FakeAsyncClient.instances.append(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.closed = True
+
+    async def begin_analyze_document(self, model_id, body, output_content_format):
+        if self.error:
+            raise self.error
+        self.document = body.bytes_source
+
+        async def result():
+            return SimpleNamespace(content="# SuperGrow 20-20-20")
+
+        return SimpleNamespace(result=result)
+
+
+class TestAsyncTextExtraction(unittest.TestCase):
+    def setUp(self):
+        FakeAsyncClient.instances = []
+        self.ocr = OCR("https://localhost", "key")
+
+    def test_extract_text_async(self):
+        with patch("azure.ai.documentintelligence.aio.DocumentIntelligenceClient", FakeAsyncClient):
+            result = asyncio.run(self.ocr.extract_text_async(b"document"))
+
+        self.assertEqual(result.content, "# SuperGrow 20-20-20")
+        (client,) = FakeAsyncClient.instances
+        self.assertEqual(client.endpoint, "https://localhost")
+        self.assertIs(client.credential, self.ocr.credential)
+        self.assertEqual(client.document, b"document")
+        self.assertTrue(client.closed)
+
+    def test_errors_propagate_and_close_the_client(self):
+        def failing_client(endpoint, credential):
+            return FakeAsyncClient(endpoint, credential, error=RuntimeError("Quota exceeded"))
+
+        with patch("azure.ai.documentintelligence.aio.DocumentIntelligenceClient", failing_client):
+            with self.assertRaisesRegex(RuntimeError, "Quota exceeded"):
+                asyncio.run(self.ocr.extract_text_async(b"document"))
+
+        self.assertTrue(FakeAsyncClient.instances[0].closed)
@@ -5,12 +5,24 @@ import shutil
 import csv
 import tempfile
 from unittest.mock import patch, MagicMock
+
+import pandas as pd
+
 from scripts.run_performance_assessment_data_collection import (
     extract_leaf_fields,
     find_test_cases,
     calculate_accuracy,
     run_test_case,
     generate_csv_report,
+    generate_routing_report,
+    sum_token_usage,
+)
+from scripts.run_performance_assessment_data_visualization import (
+    calculate_field_stats,
+    calculate_overall_metrics,
+    calculate_test_case_stats,
+    generate_markdown_report,
+    generate_mode_comparison_report,
 )
 
 class TestExtractLeafFields(unittest.TestCase):
@@ -306,6 +318,118 @@ class TestRunTestCase(unittest.TestCase):
         os.unlink(temp_image.name)
         os.unlink(temp_json.name)
 
+    @patch("scripts.run_performance_assessment_data_collection.LabelStorage")
+    @patch("scripts.run_performance_assessment_data_collection.OCR")
+    @patch("scripts.run_performance_assessment_data_collection.GPT")
+    @patch("scripts.run_performance_assessment_data_collection.analyze")
+    def test_run_test_case_mode_and_tokens(self, mock_analyze, MockGPT, MockOCR, MockLabelStorage):
+        mock_analyze.return_value.model_dump_json.return_value = json.dumps({"field_1": "value_1"})
+        MockGPT.return_value.lm.history = [
+            {"usage": {"prompt_tokens": 1000, "completion_tokens": 200}},
+            {
+                "usage": {
+                    "prompt_tokens": 1100,
+                    "completion_tokens": 250,
+                    "prompt_tokens_details": {"cached_tokens": 1024},
+                }
+            },
+        ]
+
+        temp_image = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
+        temp_json = tempfile.NamedTemporaryFile(delete=False, suffix=".json")
+        with open(temp_json.name, 'w') as f:
+            json.dump({"field_1": "value_1"}, f)
+
+        result = run_test_case(1, [temp_image.name], temp_json.name, mode="direct")
+
+        self.assertEqual(MockGPT.call_args.kwargs["mode"], "direct")
+        self.assertEqual(result["mode"], "direct")
+        self.assertEqual(result["prompt_tokens"], 2100)
+        self.assertEqual(result["completion_tokens"], 450)
+        self.assertEqual(result["cached_tokens"], 1024)
+        self.assertEqual(result["lm_calls"], 2)
+
+        os.unlink(temp_image.name)
+        os.unlink(temp_json.name)
+
+
+class TestSumTokenUsage(unittest.TestCase):
+    def test_sum_token_usage(self):
+        history = [
+            {"usage": {"prompt_tokens": 10, "completion_tokens": 5}},
+            {"usage": {}},
+            {"usage": 0},
+        ]
+        self.assertEqual(sum_token_usage(history), (10, 5))
+
+
+class TestGenerateModeComparisonReport(unittest.TestCase):
+    def test_generate_mode_comparison_report(self):
+        def result(mode, performance, completion_tokens, score, lm_calls=1):
+            return {
+                "test_case_number": 1,
+                "mode": mode,
+                "performance": performance,
+                "prompt_tokens": 1000,
+                "cached_tokens": 768,
+                "completion_tokens": completion_tokens,
+                "lm_calls": lm_calls,
+                "accuracy_results": {
+                    "npk": {"score": score, "pass_fail": "Pass" if score >= 80 else "Fail"},
+                },
+            }
+
+        report = generate_mode_comparison_report(
+            [
+                result("reasoning", 20.0, 900, 100.0),
+                result("direct", 10.0, 400, 50.0, lm_calls=2),
+            ]
+        )
+
+        self.assertIn("| reasoning | 1 | 20.00 | 1000 | 768 | 900 | 1.00 | 1.00 |", report)
+        self.assertIn("| direct | 1 | 10.00 | 1000 | 768 | 400 | 2.00 | 0.00 |", report)
+        self.assertIn("| Field Name | reasoning | direct |", report)
+        self.assertIn("| npk | 100.00 | 50.00 |", report)
+
+
+class TestGenerateMarkdownReport(unittest.TestCase):
+    def report(self, df):
+        df["Pass"] = df["Pass/Fail"] == "Pass"
+        df["Missing"] = df["Actual Value"] == "FIELD_NOT_FOUND"
+        return generate_markdown_report(
+            calculate_field_stats(df, df["Field Name"].unique()),
+            calculate_test_case_stats(df),
+            *calculate_overall_metrics(df),
+            df["Test Case"].nunique(),
+        )
+
+    def test_usage_columns(self):
+        df = pd.DataFrame(
+            {
+                "Test Case": [1, 1, 2],
+                "Field Name": ["npk", "weight", "npk"],
+                "Pass/Fail": ["Pass", "Fail", "Pass"],
+                "Accuracy Score": [100.0, 50.0, 90.0],
+                "Cached Prompt Tokens": [1024, 1024, 0],
+                "LM Calls": [1, 1, 3],
+                "Actual Value": ["20-20-20", "5 kg", "10-10-10"],
+            }
+        )
+
+        report = self.report(df)
+
+        self.assertIn(
+            "| Test Case | Overall Pass Rate | Average Accuracy Score | Cached Prompt Tokens | LM Calls |",
+            report,
+        )
+        self.assertIn("| 0.50 | 75.00 | 1024 | 1 |", report)
+        self.assertIn("| 1.00 | 90.00 | 0 | 3 |", report)
+
+        # Reports written before these columns
+        report = self.report(df.drop(columns=["Cached Prompt Tokens", "LM Calls"]))
+
+        self.assertIn("| Test Case | Overall Pass Rate | Average Accuracy Score |\n", report)
+
 
 class TestGenerateCSVReport(unittest.TestCase):
     def setUp(self):
@@ -313,6 +437,8 @@ class TestGenerateCSVReport(unittest.TestCase):
             {
                 'test_case_number': 1,
                 'performance': 5.44,
+                'cached_tokens': 1024,
+                'lm_calls': 2,
                 'accuracy_results': {
                     'field_1': {
                         'score': 100.0,
@@ -356,6 +482,8 @@ class TestGenerateCSVReport(unittest.TestCase):
             "Pass/Fail",
             "Accuracy Score",
             "Pipeline Speed (seconds)",
+            "Cached Prompt Tokens",
+            "LM Calls",
             "Expected Value",
             "Actual Value"
         ])
@@ -367,10 +495,47 @@ class TestGenerateCSVReport(unittest.TestCase):
             'Pass',
             '100.00',
             '5.4400',
+            '1024',
+            '2',
             'value_1',
             'value_1'
         ])
 
 
+class TestGenerateRoutingReport(unittest.TestCase):
+    @patch("os.makedirs")
+    @patch("os.path.join", return_value=os.path.join(tempfile.gettempdir(), "routing.csv"))
+    def test_generate_routing_report(self, mock_join, mock_makedirs):
+        results = [
+            {
+                "test_case_number": 1,
+                "accuracy_results": {
+                    "npk": {"pass_fail": "Pass"},
+                    "lot_number": {"pass_fail": "Fail"},
+                },
+                "routing": {
+                    "deployment": "gpt-3.5-turbo",
+                    "reason": "simple",
+                    "tokens": 300,
+                    "complexity": 12,
+                    "estimated_cost": 0.0006,
+                    "elapsed": 2.5,
+                },
+            },
+            {"test_case_number": 2, "accuracy_results": {}, "routing": None},
+        ]
+
+        report_path = generate_routing_report(results)
+
+        with open(report_path, "r") as f:
+            rows = list(csv.reader(f))
+        os.unlink(report_path)
+
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(
+            rows[1], ["1", "gpt-3.5-turbo", "simple", "300", "12", "0.000600", "2.5000", "0.50"]
+        )
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,283 @@
+import asyncio
+import glob
+import json
+import os
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import dspy
+from dspy.utils import DummyLM
+
+from pipeline.gpt import GPT, PRE_EXTRACTED_SIGNATURE, structured_output_format
+from pipeline.inspection import FertilizerInspection
+from pipeline.pre_extraction import SCHEMA_FIELDS, cross_check, pre_extract, prefill
+from tests import fake_completion
+
+LABEL = """
+# GreenGrow Inc.
+123 Green Road, Farmville, ON
+www.GreenGrow.ca | Tel: 1-800-555-0199 | info@greengrow.ca
+# SuperGrow 20-20-20
+Registration No. 2018007A Lot: L12345 (2024-05-01)
+Net weight 25 kg (55 lbs)
+Dissolve 50 g in 10 L of water.
+"""
+
+
+class TestPreExtract(unittest.TestCase):
+    def test_pre_extract(self):
+        extracted = pre_extract(LABEL)
+
+        self.assertEqual(extracted["npk"], "20-20-20")
+        self.assertEqual(
+            extracted["registration_number"], [{"identifier": "2018007A", "type": None}]
+        )
+        self.assertEqual(
+            extracted["weight"],
+            [{"value": 25.0, "unit": "kg"}, {"value": 55.0, "unit": "lb"}],
+        )
+        self.assertEqual(extracted["phone_number"], ["+18005550199"])
+        self.assertEqual(extracted["website"], ["www.greengrow.ca"])
+
+    def test_ambiguous_npk(self):
+        self.assertIsNone(pre_extract("SuperGrow 20-20-20 and BloomMax 10-52-10")["npk"])
+
+    def test_dates_and_phones_are_not_npk(self):
+        self.assertIsNone(pre_extract("Made on 2024-05-01, call 800-555-0199")["npk"])
+
+    def test_thousands_separator(self):
+        self.assertEqual(
+            pre_extract("Net weight 1,000 kg (2,204 lb)")["weight"],
+            [{"value": 1000.0, "unit": "kg"}, {"value": 2204.0, "unit": "lb"}],
+        )
+        self.assertEqual(
+            pre_extract("Poids net 2,5 kg")["weight"], [{"value": 2.5, "unit": "kg"}]
+        )
+
+    def test_weight_units(self):
+        self.assertEqual(
+            pre_extract("Net weight 25 Kgs\nPoids net 327 g\nDensity 1.2 g/L")["weight"],
+            [{"value": 25.0, "unit": "kg"}, {"value": 327.0, "unit": "g"}],
+        )
+        # Doses in grams are not weights
+        self.assertEqual(pre_extract(LABEL)["weight"][-1], {"value": 55.0, "unit": "lb"})
+
+    def test_corpus_weight_units(self):
+        # Every unit of the weights of the corpus, e.g. "Kgs" and "g"
+        for path in sorted(glob.glob("test_data/labels/*/expected_output.json")):
+            with open(path) as file:
+                weights = json.load(file)["weight"]
+            for weight in weights:
+                if weight["value"] is None:
+                    continue
+                with self.subTest(path=path, weight=weight):
+                    text = f"Net weight {weight['value']} {weight['unit']}"
+                    self.assertEqual(
+                        pre_extract(text)["weight"],
+                        [
+                            {
+                                "value": float(weight["value"]),
+                                "unit": weight["unit"].lower().rstrip("s"),
+                            }
+                        ],
+                    )
+
+    def test_dates_next_to_npk(self):
+        for text in [
+            "Lot 12-10-23\nSuperGrow 20-20-20",
+            "SuperGrow 20-20-20\nPacked 12-05-23",
+            "Exp. date: 31-12-25 SuperGrow 20-20-20",
+        ]:
+            with self.subTest(text=text):
+                self.assertEqual(pre_extract(text)["npk"], "20-20-20")
+
+    def test_npk_context(self):
+        text = "Replaces SuperGrow 14-14-14\nGuaranteed analysis 20-20-20"
+
+        self.assertEqual(pre_extract(text)["npk"], "20-20-20")
+
+    def test_cross_check(self):
+        inspection = FertilizerInspection.model_validate(
+            {
+                "npk": "20-20-2",
+                "registration_number": [{"identifier": "2018007A"}],
+                "weight": [{"value": 25, "unit": "kg"}, {"value": 55, "unit": "lbs"}],
+                "organizations": [{"phone_number": "1-800-555-0100"}],
+            }
+        )
+
+        discrepancies = cross_check(inspection, pre_extract(LABEL))
+
+        self.assertEqual(set(discrepancies), {"npk", "phone_number"})
+        self.assertEqual(discrepancies["npk"], {"llm": ["20-20-2"], "text": ["20-20-20"]})
+
+    def test_prefill(self):
+        inspection = FertilizerInspection.model_validate(
+            {"npk": "20-20-20", "organizations": [{"name": "GreenGrow Inc."}]}
+        )
+
+        inspection = prefill(inspection, pre_extract(LABEL))
+
+        self.assertEqual(inspection.registration_number[0].identifier, "2018007A")
+        self.assertEqual(len(inspection.weight), 2)
+        self.assertEqual(inspection.organizations[0].phone_number, "+18005550199")
+        self.assertEqual(inspection.organizations[0].website, "www.greengrow.ca")
+
+
+class EchoLM(dspy.LM):
+    """Gives the same answer to every request and records the messages."""
+
+    def __init__(self, answer):
+        super().__init__("echo-dummy")
+        self.answer = answer
+        self.requests = []
+
+    def __call__(self, prompt=None, messages=None, **kwargs):
+        self.requests.append(messages)
+        return [self.answer]
+
+
+class TestGPTPreExtraction(unittest.TestCase):
+    def gpt(self, pre_extraction, answer):
+        gpt = GPT(
+            api_endpoint="http://localhost",
+            api_key="key",
+            deployment_id="gpt-4o",
+            structured_output=False,
+            pre_extraction=pre_extraction,
+        )
+        gpt.lm = DummyLM([{"reasoning": "Read.", "inspection": json.dumps(answer)}])
+        return gpt
+
+    def test_unsupported_pre_extraction(self):
+        with self.assertRaises(ValueError):
+            self.gpt("guess", {})
+
+    def test_check(self):
+        gpt = self.gpt("check", {"npk": "20-20-2"})
+
+        prediction = gpt.create_inspection(LABEL)
+
+        self.assertEqual(prediction.inspection.npk, "20-20-2")
+        self.assertIn("npk", prediction.discrepancies)
+
+    def test_prefill(self):
+        gpt = self.gpt("prefill", {"fertiliser_name": "SuperGrow"})
+
+        prediction = gpt.create_inspection(LABEL)
+
+        self.assertEqual(prediction.inspection.fertiliser_name, "SuperGrow")
+        self.assertEqual(prediction.inspection.npk, "20-20-20")
+        self.assertIn("registration_number", prediction.discrepancies)
+
+    def test_replace(self):
+        gpt = self.gpt("replace", {"fertiliser_name": "SuperGrow", "lot_number": "L12345"})
+
+        prediction = gpt.create_inspection(LABEL)
+
+        inspection = prediction.inspection
+        self.assertIsInstance(inspection, FertilizerInspection)
+        self.assertEqual(inspection.fertiliser_name, "SuperGrow")
+        self.assertEqual(inspection.npk, "20-20-20")
+        self.assertEqual(inspection.weight[0].value, 25.0)
+        self.assertEqual(prediction.discrepancies, {})
+
+    def test_acreate_inspection(self):
+        gpt = self.gpt("replace", {})
+
+        async def acompletion(**kwargs):
+            content = fake_completion({"fertiliser_name": "SuperGrow"})
+            return SimpleNamespace(
+                choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+                usage=None,
+            )
+
+        with patch("pipeline.gpt.litellm.acompletion", side_effect=acompletion):
+            prediction = asyncio.run(gpt.acreate_inspection(LABEL))
+
+        self.assertEqual(prediction.inspection.fertiliser_name, "SuperGrow")
+        self.assertEqual(prediction.inspection.npk, "20-20-20")
+        self.assertEqual(prediction.discrepancies, {})
+
+    def test_stream_inspection(self):
+        gpt = self.gpt("replace", {})
+        content = fake_completion({"fertiliser_name": "SuperGrow"})
+        chunks = [
+            SimpleNamespace(
+                choices=[SimpleNamespace(delta=SimpleNamespace(content=content[i : i + 7]))]
+            )
+            for i in range(0, len(content), 7)
+        ]
+
+        with patch("pipeline.gpt.litellm.completion", return_value=iter(chunks)):
+            inspections = list(gpt.stream_inspection(LABEL))
+
+        self.assertIsInstance(inspections[-1], FertilizerInspection)
+        self.assertEqual(inspections[-1].fertiliser_name, "SuperGrow")
+        for inspection in inspections:
+            self.assertEqual(inspection.npk, "20-20-20")
+
+    def test_create_inspection_sectioned(self):
+        gpt = self.gpt("replace", {})
+        gpt.lm = EchoLM(fake_completion({"fertiliser_name": "SuperGrow", "npk": "1-1-1"}))
+
+        prediction = gpt.create_inspection_sectioned(LABEL)
+
+        self.assertEqual(prediction.inspection.fertiliser_name, "SuperGrow")
+        self.assertEqual(prediction.inspection.npk, "20-20-20")
+        for messages in gpt.lm.requests:
+            keys = messages[0]["content"].split("Only extract the following keys: ")[1]
+            for name in SCHEMA_FIELDS:
+                self.assertNotIn(name, keys.split(".")[0].split(", "))
+
+    def test_batch_requests_use_the_schema(self):
+        gpt = GPT(
+            api_endpoint="http://localhost",
+            api_key="key",
+            deployment_id="gpt-4o",
+            pre_extraction="replace",
+        )
+
+        (request,) = gpt.batch_requests([LABEL])
+
+        body = request["body"]
+        self.assertEqual(body["messages"], gpt.format_messages(LABEL))
+        schema = body["response_format"]["json_schema"]["schema"]
+        properties = schema["properties"]["inspection"]["properties"]
+        self.assertIn("fertiliser_name", properties)
+        for name in SCHEMA_FIELDS:
+            self.assertNotIn(name, properties)
+
+    def test_read_batch_results(self):
+        gpt = GPT(
+            api_endpoint="http://localhost",
+            api_key="key",
+            deployment_id="gpt-4o",
+            pre_extraction="replace",
+        )
+        fixture = os.path.join(os.path.dirname(__file__), "fixtures", "batch_output.jsonl")
+
+        with self.assertRaises(ValueError):
+            gpt.read_batch_results(fixture)
+        results = gpt.read_batch_results(
+            fixture, {custom_id: LABEL for custom_id in ["label-1", "label-2", "label-3", "label-4"]}
+        )
+
+        inspection = results["label-1"].inspection
+        self.assertEqual(inspection.fertiliser_name, "SuperGrow 20-20-20")
+        self.assertEqual(inspection.npk, "20-20-20")
+        self.assertEqual(inspection.registration_number[0].identifier, "2018007A")
+        self.assertNotIn("npk", results["label-1"].discrepancies)
+
+    def test_replaced_fields_leave_the_schema(self):
+        schema = structured_output_format(PRE_EXTRACTED_SIGNATURE)["json_schema"]["schema"]
+        properties = schema["properties"]["inspection"]["properties"]
+
+        for name in SCHEMA_FIELDS:
+            self.assertNotIn(name, properties)
+        self.assertIn("fertiliser_name", properties)
+
+
+if __name__ == "__main__":
+    unittest.main()
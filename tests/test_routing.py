@@ -0,0 +1,158 @@
+import asyncio
+import json
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from dspy.utils import DummyLM
+
+from pipeline.routing import ModelRouter, estimate_cost, label_complexity
+from tests import fake_completion
+
+SIMPLE_LABEL = """
+# SuperGrow 20-20-20
+Registration Number 2018007A
+25 kg
+"""
+
+COMPLEX_LABEL = "\n\n".join(
+    f"# Section {i}\nTotal Nitrogen (N) {i}%\nAzote total (N) {i}%" for i in range(30)
+)
+
+
+class TestModelRouter(unittest.TestCase):
+    def setUp(self):
+        self.router = ModelRouter(
+            api_endpoint="http://localhost",
+            api_key="key",
+            default_deployment="gpt-4o",
+        )
+        for deployment_id, gpt in self.router.gpts.items():
+            gpt.lm = DummyLM(
+                [{"reasoning": deployment_id, "inspection": json.dumps({"npk": "20-20-20"})}]
+                * 3
+            )
+
+    def test_label_complexity(self):
+        self.assertLess(label_complexity(SIMPLE_LABEL), label_complexity(COMPLEX_LABEL))
+
+    def test_estimate_cost(self):
+        self.assertLess(estimate_cost("gpt-3.5-turbo", 1000), estimate_cost("gpt-4o", 1000))
+
+    def test_simple_label_goes_to_cheapest(self):
+        decision = self.router.route(SIMPLE_LABEL)
+
+        self.assertEqual(decision["deployment"], "gpt-3.5-turbo")
+        self.assertEqual(decision["reason"], "simple")
+
+    def test_complex_label_goes_to_default(self):
+        decision = self.router.route(COMPLEX_LABEL)
+
+        self.assertEqual(decision["deployment"], "gpt-4o")
+        self.assertEqual(decision["reason"], "complex")
+
+    def test_long_label_skips_small_deployment(self):
+        self.router.default_deployment = "gpt-3.5-turbo"
+        decision = self.router.route("word " * 4000)
+
+        self.assertEqual(decision["deployment"], "gpt-4o")
+
+    def test_slow_cheap_deployment_is_avoided(self):
+        self.router.latencies["gpt-3.5-turbo"] = self.router.max_latency + 1
+
+        decision = self.router.route(SIMPLE_LABEL)
+
+        self.assertEqual(decision["deployment"], "gpt-4o")
+        self.assertEqual(decision["reason"], "simple, cheapest too slow")
+
+    def test_create_inspection_records_decisions(self):
+        simple = self.router.create_inspection(SIMPLE_LABEL)
+        complex = self.router.create_inspection(COMPLEX_LABEL)
+
+        self.assertEqual(simple.reasoning, "gpt-3.5-turbo")
+        self.assertEqual(complex.reasoning, "gpt-4o")
+        self.assertEqual(
+            [d["deployment"] for d in self.router.decisions], ["gpt-3.5-turbo", "gpt-4o"]
+        )
+        for decision in self.router.decisions:
+            self.assertIsNotNone(decision["elapsed"])
+        self.assertEqual(set(self.router.latencies), {"gpt-3.5-turbo", "gpt-4o"})
+        self.assertEqual(len(self.router.history), 2)
+
+    def test_slow_deployment_is_tried_again(self):
+        self.router._record_latency("gpt-3.5-turbo", self.router.max_latency + 1)
+        self.assertEqual(self.router.route(SIMPLE_LABEL)["deployment"], "gpt-4o")
+
+        # Once the sample is older than latency_ttl, the deployment is picked
+        # again and measured, and stays picked while it is fast
+        self.router.measured_at["gpt-3.5-turbo"] -= self.router.latency_ttl + 1
+        for _ in range(2):
+            prediction = self.router.create_inspection(SIMPLE_LABEL)
+            self.assertEqual(prediction.reasoning, "gpt-3.5-turbo")
+
+        self.assertLess(self.router.latencies["gpt-3.5-turbo"], self.router.max_latency)
+
+    def test_decisions_are_bounded(self):
+        router = ModelRouter(api_endpoint="http://localhost", api_key="key", max_decisions=2)
+        for gpt in router.gpts.values():
+            gpt.lm = DummyLM(
+                [{"reasoning": "Read.", "inspection": json.dumps({"npk": "20-20-20"})}] * 3
+            )
+
+        for text in [SIMPLE_LABEL, COMPLEX_LABEL, SIMPLE_LABEL]:
+            router.create_inspection(text)
+
+        self.assertEqual(
+            [d["deployment"] for d in router.decisions], ["gpt-4o", "gpt-3.5-turbo"]
+        )
+
+    def test_acreate_inspection_records_decisions(self):
+        for deployment_id, gpt in self.router.gpts.items():
+            gpt.lm.model = deployment_id
+
+        async def acompletion(model, **kwargs):
+            content = fake_completion({"npk": "20-20-20"}, reasoning=model.split("/")[-1])
+            return SimpleNamespace(
+                choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+                usage=None,
+            )
+
+        async def run():
+            return await asyncio.gather(
+                self.router.acreate_inspection(SIMPLE_LABEL),
+                self.router.acreate_inspection(COMPLEX_LABEL),
+            )
+
+        with patch("pipeline.gpt.litellm.acompletion", side_effect=acompletion):
+            simple, complex = asyncio.run(run())
+
+        self.assertEqual(simple.reasoning, "gpt-3.5-turbo")
+        self.assertEqual(complex.reasoning, "gpt-4o")
+        self.assertEqual(
+            [d["deployment"] for d in self.router.decisions], ["gpt-3.5-turbo", "gpt-4o"]
+        )
+        self.assertEqual(set(self.router.latencies), {"gpt-3.5-turbo", "gpt-4o"})
+
+    def test_acreate_inspection_failure_is_timed(self):
+        async def acompletion(**kwargs):
+            raise RuntimeError("Deployment unavailable")
+
+        with patch("pipeline.gpt.litellm.acompletion", side_effect=acompletion):
+            with self.assertRaises(RuntimeError):
+                asyncio.run(self.router.acreate_inspection(SIMPLE_LABEL))
+
+        self.assertIsNotNone(self.router.decisions[-1]["elapsed"])
+        self.assertIn("gpt-3.5-turbo", self.router.latencies)
+
+    def test_unknown_default_deployment(self):
+        with self.assertRaises(ValueError):
+            ModelRouter(
+                api_endpoint="http://localhost",
+                api_key="key",
+                deployment_ids=["gpt-3.5-turbo"],
+                default_deployment="gpt-4o",
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import threading
+import time
+import unittest
+import warnings
+
+from dspy.utils import DummyLM
+
+import pipeline.scheduling
+from pipeline.gpt import GPT
+from pipeline.scheduling import (
+    RateLimiter,
+    estimate_request_tokens,
+    get_rate_limiter,
+    scheduler_metrics,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_requests_per_minute(self):
+        limiter = RateLimiter(requests_per_minute=2, clock=self.clock)
+
+        waits = [limiter.acquire(10, sleep=self.clock.sleep) for _ in range(3)]
+
+        self.assertEqual(waits, [0.0, 0.0, 60.0])
+        self.assertEqual(limiter.metrics()["window_requests"], 1)
+
+    def test_tokens_per_minute(self):
+        limiter = RateLimiter(tokens_per_minute=100, clock=self.clock)
+
+        limiter.acquire(60, sleep=self.clock.sleep)
+        self.clock.now = 10.0
+        limiter.acquire(30, sleep=self.clock.sleep)
+        waited = limiter.acquire(60, sleep=self.clock.sleep)
+
+        # The first request has to leave the window, the second one can stay
+        self.assertEqual(waited, 50.0)
+        self.assertEqual(limiter.metrics()["window_tokens"], 90)
+
+    def test_oversized_request_is_admitted_alone(self):
+        limiter = RateLimiter(tokens_per_minute=100, clock=self.clock)
+
+        limiter.acquire(10, sleep=self.clock.sleep)
+        waited = limiter.acquire(500, sleep=self.clock.sleep)
+
+        self.assertEqual(waited, 60.0)
+
+    def test_no_budget(self):
+        limiter = RateLimiter(clock=self.clock)
+
+        for _ in range(100):
+            self.assertEqual(limiter.acquire(10_000, sleep=self.clock.sleep), 0.0)
+
+    def test_threads_stay_under_budget(self):
+        limiter = RateLimiter(requests_per_minute=2, window=0.2)
+        admitted_at = []
+
+        def run():
+            limiter.acquire(1)
+            admitted_at.append(time.monotonic())
+
+        threads = [threading.Thread(target=run) for _ in range(6)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        admitted_at.sort()
+        self.assertGreaterEqual(admitted_at[-1] - start, 0.4)
+        for i in range(2, len(admitted_at)):
+            self.assertGreaterEqual(admitted_at[i] - admitted_at[i - 2], 0.2 - 0.01)
+        metrics = limiter.metrics()
+        self.assertEqual(metrics["admitted_requests"], 6)
+        self.assertEqual(metrics["queue_depth"], 0)
+        self.assertGreater(metrics["max_queue_depth"], 1)
+        self.assertGreater(metrics["max_wait_seconds"], 0.0)
+
+    def test_aacquire(self):
+        limiter = RateLimiter(tokens_per_minute=100, window=0.2)
+
+        async def run():
+            return await asyncio.gather(*(limiter.aacquire(60) for _ in range(3)))
+
+        waits = asyncio.run(run())
+
+        self.assertLess(min(waits), 0.05)
+        self.assertGreaterEqual(max(waits), 0.4)
+
+
+class TestDeploymentScheduler(unittest.TestCase):
+    def setUp(self):
+        pipeline.scheduling._limiters.clear()
+
+    def tearDown(self):
+        pipeline.scheduling._limiters.clear()
+
+    def test_estimate_request_tokens(self):
+        messages = [{"role": "system", "content": "a" * 400}, {"role": "user", "content": "b" * 40}]
+
+        self.assertEqual(estimate_request_tokens(messages, "b" * 40), 101 + 11 + 11)
+
+    def test_limiter_is_shared_per_deployment(self):
+        limiter = get_rate_limiter("http://east", "gpt-4o", tokens_per_minute=30_000)
+
+        self.assertIs(get_rate_limiter("http://east", "gpt-4o"), limiter)
+        self.assertEqual(limiter.tokens_per_minute, 30_000)
+        self.assertIsNot(get_rate_limiter("http://east", "gpt-3.5-turbo"), limiter)
+        self.assertIsNot(get_rate_limiter("http://west", "gpt-4o"), limiter)
+        self.assertEqual(
+            set(scheduler_metrics()),
+            {("http://east", "gpt-4o"), ("http://east", "gpt-3.5-turbo"), ("http://west", "gpt-4o")},
+        )
+
+    def test_conflicting_budgets(self):
+        limiter = get_rate_limiter("http://east", "gpt-4o", tokens_per_minute=30_000)
+
+        with self.assertWarns(UserWarning):
+            get_rate_limiter("http://east", "gpt-4o", tokens_per_minute=10_000)
+        # The same budget again is no conflict
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            get_rate_limiter("http://east", "gpt-4o", tokens_per_minute=30_000)
+        self.assertEqual(limiter.tokens_per_minute, 30_000)
+
+    def test_gpt_requests_are_scheduled(self):
+        gpts = [
+            GPT(
+                api_endpoint="http://localhost",
+                api_key="key",
+                deployment_id="gpt-4o",
+                requests_per_minute=1,
+            )
+            for _ in range(2)
+        ]
+        self.assertIs(gpts[0].limiter, gpts[1].limiter)
+        gpts[0].limiter.window = 0.2
+        for gpt in gpts:
+            gpt.lm = DummyLM([{"reasoning": "Read.", "inspection": json.dumps({"npk": "20-20-20"})}])
+
+        start = time.monotonic()
+        for i, gpt in enumerate(gpts):
+            gpt.create_inspection(f"label text {i}")
+        elapsed = time.monotonic() - start
+
+        self.assertGreaterEqual(elapsed, 0.2)
+        metrics = scheduler_metrics()[("http://localhost", "gpt-4o")]
+        self.assertEqual(metrics["admitted_requests"], 2)
+        self.assertGreater(metrics["admitted_tokens"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+from pipeline.gpt import GPT
+from pipeline.inspection import FertilizerInspection
+from tests.stub_lm_server import StubLMServer, load_inspections, to_inspection
+
+
+def post_completion(url: str, content: str = "Hello") -> urllib.request.Request:
+    body = json.dumps({"messages": [{"role": "user", "content": content}]}).encode()
+    return urllib.request.Request(
+        f"{url}/openai/deployments/gpt-4o/chat/completions?api-version=2024-02-15-preview",
+        data=body,
+        headers={"Content-Type": "application/json"},
+    )
+
+
+class TestLoadInspections(unittest.TestCase):
+    def test_load_inspections(self):
+        inspections = load_inspections()
+
+        self.assertGreater(len(inspections), 0)
+        for inspection in inspections:
+            FertilizerInspection.model_validate(inspection)
+
+    def test_to_inspection_organizations(self):
+        inspection = to_inspection(
+            {
+                "company_name": "GreenGrow",
+                "manufacturer_name": "AgroTech",
+                "manufacturer_phone_number": "+1 416 555 0123",
+                "registration_number": "2018007A",
+                "ingredients_en": [{"ingredient": "Bone Meal", "value": None, "unit": None}],
+            }
+        )
+
+        self.assertEqual([o.name for o in inspection.organizations], ["GreenGrow", "AgroTech"])
+        self.assertEqual(inspection.registration_number[0].identifier, "2018007A")
+        self.assertEqual(inspection.ingredients_en[0].nutrient, "Bone Meal")
+
+
+class TestStubLMServer(unittest.TestCase):
+    def setUp(self):
+        self.inspections = load_inspections()[:3]
+        self.name = self.inspections[1]["fertiliser_name"]
+
+    def gpt(self, server, mode="reasoning"):
+        return GPT(
+            api_endpoint=server.url,
+            api_key="stub",
+            deployment_id="gpt-4o",
+            mode=mode,
+        )
+
+    def test_create_inspection(self):
+        with StubLMServer(self.inspections) as server:
+            for mode in ("reasoning", "direct"):
+                prediction = self.gpt(server, mode).create_inspection(
+                    f"{self.name} label read in {mode} mode"
+                )
+                self.assertEqual(prediction.inspection.fertiliser_name, self.name)
+
+        self.assertEqual(server.stats["requests"], 2)
+
+    def test_acreate_inspection_concurrency(self):
+        with StubLMServer(self.inspections, latency=0.2) as server:
+            gpt = self.gpt(server)
+
+            async def run():
+                texts = [f"{self.name} concurrent label {i}" for i in range(8)]
+                return await asyncio.gather(*(gpt.acreate_inspection(t) for t in texts))
+
+            start = time.perf_counter()
+            predictions = asyncio.run(run())
+            elapsed = time.perf_counter() - start
+
+        self.assertEqual({p.inspection.fertiliser_name for p in predictions}, {self.name})
+        self.assertLess(elapsed, 8 * 0.2)
+
+    def test_stream_inspection(self):
+        with StubLMServer(self.inspections) as server:
+            partials = list(self.gpt(server).stream_inspection(f"{self.name} streamed label"))
+
+        self.assertGreater(len(partials), 1)
+        self.assertEqual(partials[-1].fertiliser_name, self.name)
+
+    def test_deterministic_answer(self):
+        server = StubLMServer(self.inspections)
+        self.assertEqual(server.pick_inspection("abc"), server.pick_inspection("abc"))
+        self.assertEqual(server.pick_inspection(f"... {self.name} ..."), self.inspections[1])
+
+    def test_error_injection(self):
+        with StubLMServer(self.inspections, rate_limit_rate=1.0) as server:
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen(post_completion(server.url))
+            self.assertEqual(context.exception.code, 429)
+            self.assertEqual(context.exception.headers["Retry-After"], "0")
+
+        with StubLMServer(self.inspections, error_rate=1.0) as server:
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen(post_completion(server.url))
+            self.assertEqual(context.exception.code, 500)
+
+        self.assertEqual(server.stats, {"requests": 1, "errors": 1, "rate_limited": 0})
+
+    def test_latency_and_usage(self):
+        with StubLMServer(self.inspections, latency=0.1, tokens_per_second=10000) as server:
+            start = time.perf_counter()
+            with urllib.request.urlopen(post_completion(server.url)) as response:
+                body = json.load(response)
+            elapsed = time.perf_counter() - start
+
+        self.assertGreaterEqual(elapsed, 0.1)
+        self.assertGreater(body["usage"]["completion_tokens"], 0)
+        self.assertIn("[[ ## inspection ## ]]", body["choices"][0]["message"]["content"])
+
+
+if __name__ == "__main__":
+    unittest.main()
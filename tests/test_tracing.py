@@ -0,0 +1,121 @@
+import unittest
+from unittest.mock import patch
+
+from openinference.instrumentation import TraceConfig
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.sdk.trace.sampling import ParentBased
+
+import pipeline.tracing
+from pipeline.gpt import GPT
+from pipeline.tracing import instrument, lm_span
+
+
+class TestInstrument(unittest.TestCase):
+    def setUp(self):
+        pipeline.tracing._tracer_provider = None
+        register_patcher = patch("phoenix.otel.register")
+        instrumentor_patcher = patch(
+            "openinference.instrumentation.dspy.DSPyInstrumentor"
+        )
+        self.mock_register = register_patcher.start()
+        self.mock_instrumentor = instrumentor_patcher.start()
+        self.addCleanup(register_patcher.stop)
+        self.addCleanup(instrumentor_patcher.stop)
+
+    def tearDown(self):
+        pipeline.tracing._tracer_provider = None
+
+    def test_instrument_is_idempotent(self):
+        first = instrument(endpoint="http://localhost:4317")
+        second = instrument(endpoint="http://localhost:4317", sampling_ratio=0.5)
+
+        self.assertIs(first, second)
+        self.mock_register.assert_called_once()
+        self.mock_instrumentor.return_value.instrument.assert_called_once()
+
+    def test_instrument_sampling_and_batch(self):
+        instrument(endpoint="http://localhost:4317", sampling_ratio=0.1)
+
+        kwargs = self.mock_register.call_args.kwargs
+        self.assertTrue(kwargs["batch"])
+        self.assertIsInstance(kwargs["sampler"], ParentBased)
+        self.assertIn("0.1", kwargs["sampler"].get_description())
+
+    def test_instrument_hide_payloads(self):
+        instrument(endpoint="http://localhost:4317", hide_payloads=True)
+
+        config = self.mock_instrumentor.return_value.instrument.call_args.kwargs["config"]
+        self.assertIsInstance(config, TraceConfig)
+        self.assertTrue(config.hide_inputs)
+        self.assertTrue(config.hide_outputs)
+        self.assertTrue(config.hide_input_messages)
+        self.assertTrue(config.hide_output_messages)
+
+    def test_invalid_sampling_ratio(self):
+        with self.assertRaises(ValueError):
+            instrument(endpoint="http://localhost:4317", sampling_ratio=2)
+
+    def test_gpt_instruments_once(self):
+        for _ in range(3):
+            GPT(
+                api_endpoint="http://localhost",
+                api_key="key",
+                deployment_id="gpt-4o",
+                phoenix_endpoint="http://localhost:4317",
+                trace_sampling_ratio=0.25,
+                trace_payloads=False,
+            )
+
+        self.mock_register.assert_called_once()
+        config = self.mock_instrumentor.return_value.instrument.call_args.kwargs["config"]
+        self.assertTrue(config.hide_inputs)
+
+
+class TestLMSpan(unittest.TestCase):
+    def setUp(self):
+        self.exporter = InMemorySpanExporter()
+        tracer_provider = TracerProvider()
+        tracer_provider.add_span_processor(SimpleSpanProcessor(self.exporter))
+        self.lm = GPT(api_endpoint="http://localhost", api_key="key", deployment_id="gpt-4o").lm
+        self.messages = [{"role": "user", "content": "label text"}]
+        pipeline.tracing._tracer_provider = tracer_provider
+
+    def tearDown(self):
+        pipeline.tracing._tracer_provider = None
+        pipeline.tracing._hide_payloads = False
+
+    def test_span(self):
+        with lm_span(self.lm, self.messages, self.lm.kwargs) as record_outputs:
+            record_outputs(["answer"])
+
+        (span,) = self.exporter.get_finished_spans()
+        self.assertEqual(span.name, "LM.acall")
+        self.assertEqual(span.attributes["openinference.span.kind"], "LLM")
+        self.assertEqual(span.attributes["llm.model_name"], "azure/gpt-4o")
+        self.assertIn("label text", span.attributes["input.value"])
+        self.assertIn("answer", span.attributes["output.value"])
+        self.assertNotIn("api_key", span.attributes["llm.invocation_parameters"])
+
+    def test_hidden_payloads(self):
+        pipeline.tracing._hide_payloads = True
+
+        with lm_span(self.lm, self.messages, self.lm.kwargs) as record_outputs:
+            record_outputs(["answer"])
+
+        (span,) = self.exporter.get_finished_spans()
+        self.assertNotIn("input.value", span.attributes)
+        self.assertNotIn("output.value", span.attributes)
+
+    def test_tracing_disabled(self):
+        pipeline.tracing._tracer_provider = None
+
+        with lm_span(self.lm, self.messages, self.lm.kwargs) as record_outputs:
+            record_outputs(["answer"])
+
+        self.assertEqual(self.exporter.get_finished_spans(), ())
+
+
+if __name__ == "__main__":
+    unittest.main()
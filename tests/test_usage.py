@@ -0,0 +1,99 @@
+import threading
+import unittest
+from types import SimpleNamespace
+
+from pipeline.usage import CallUsage, UsageAggregator, attempt_usage, cached_prompt_tokens
+
+
+class TestAttemptUsage(unittest.TestCase):
+    def test_attempt_usage(self):
+        usage = SimpleNamespace(
+            prompt_tokens=1200,
+            completion_tokens=150,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=1024),
+        )
+
+        self.assertEqual(
+            attempt_usage(usage, 1.5),
+            {"latency": 1.5, "prompt_tokens": 1200, "completion_tokens": 150, "cached_tokens": 1024},
+        )
+        self.assertEqual(attempt_usage(None, 0.1)["prompt_tokens"], 0)
+
+    def test_cached_prompt_tokens(self):
+        self.assertEqual(cached_prompt_tokens({"prompt_tokens_details": {"cached_tokens": 64}}), 64)
+        self.assertEqual(cached_prompt_tokens({"prompt_tokens_details": None}), 0)
+        self.assertEqual(cached_prompt_tokens({}), 0)
+
+
+class TestCallUsage(unittest.TestCase):
+    def test_call_usage(self):
+        first = CallUsage([attempt_usage({"prompt_tokens": 100, "completion_tokens": 10}, 1.0)])
+        second = CallUsage(
+            [
+                attempt_usage({"prompt_tokens": 200, "completion_tokens": 20}, 2.0),
+                attempt_usage({"prompt_tokens": 300, "completion_tokens": 30}, 3.0),
+            ]
+        )
+
+        usage = CallUsage.combine([first, second])
+
+        self.assertEqual(
+            usage.to_dict(),
+            {
+                "requests": 3,
+                "retries": 1,
+                "prompt_tokens": 600,
+                "completion_tokens": 60,
+                "cached_tokens": 0,
+                "latencies": [1.0, 2.0, 3.0],
+            },
+        )
+        self.assertEqual(CallUsage([]).retries, 0)
+
+
+class TestUsageAggregator(unittest.TestCase):
+    def setUp(self):
+        self.aggregator = UsageAggregator()
+        self.usage = CallUsage(
+            [
+                attempt_usage({"prompt_tokens": 100, "completion_tokens": 10}, 0.5),
+                attempt_usage({"prompt_tokens": 100, "completion_tokens": 10}, 0.5),
+            ]
+        )
+
+    def test_record_from_threads(self):
+        threads = [
+            threading.Thread(target=self.aggregator.record, args=("gpt-4o", self.usage))
+            for _ in range(50)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        totals = self.aggregator.snapshot()["gpt-4o"]
+        self.assertEqual(totals["extractions"], 50)
+        self.assertEqual(totals["requests"], 100)
+        self.assertEqual(totals["retries"], 50)
+        self.assertEqual(totals["prompt_tokens"], 10000)
+        self.assertAlmostEqual(totals["latency_seconds"], 50.0)
+
+    def test_to_prometheus(self):
+        self.aggregator.record("gpt-4o", self.usage)
+        self.aggregator.record("gpt-3.5-turbo", self.usage)
+
+        metrics = self.aggregator.to_prometheus()
+
+        self.assertIn("# TYPE fertiscan_llm_requests_total counter", metrics)
+        self.assertIn('fertiscan_llm_requests_total{deployment="gpt-4o"} 2', metrics)
+        self.assertIn('fertiscan_llm_retries_total{deployment="gpt-3.5-turbo"} 1', metrics)
+
+    def test_reset(self):
+        self.aggregator.record("gpt-4o", self.usage)
+        self.aggregator.reset()
+
+        self.assertEqual(self.aggregator.snapshot(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()